@@ -0,0 +1,120 @@
+#!/www/zelenik/venv/bin/python
+
+from logger import Logger
+
+import db_driver
+from db_driver import pretty_json, timestamp
+
+import os
+import threading
+import time
+import zlib
+
+from pathlib import Path
+
+from datetime import datetime, time as day_time
+
+logger = Logger("archiver")
+
+DIR = '/www/zelenik/'
+
+RUN_EVERY = 10*60 # seconds
+MAX_JITTER = 2*60*60 # seconds after midnight, things are spread over this interval
+ARCHIVES_PER_SECOND = 2
+ARCHIVER_STATUS = 'archiver-status.json'
+
+# stable between restarts so a thing is always archived at the same time of day
+def jitter(thing, max_jitter=MAX_JITTER):
+    if max_jitter <= 0:
+        return 0
+    return zlib.crc32(thing.encode('utf-8')) % max_jitter
+
+def seconds_since_midnight(now):
+    return (now - datetime.combine(now.date(), day_time(0))).total_seconds()
+
+class Archiver:
+    def __init__(self, working_directory=DIR, run_every=RUN_EVERY, max_jitter=MAX_JITTER, archives_per_second=ARCHIVES_PER_SECOND):
+        self.working_directory = working_directory
+        self.db = db_driver.DatabaseDriver(working_directory)
+
+        self.db_path = Path(self.working_directory) / 'db'
+        self.run_every = run_every
+        self.max_jitter = max_jitter
+        self.archives_per_second = archives_per_second
+        self.running = False
+        self.status = {'running': False, 'things_total': 0, 'things_done': 0, 'things_pending': 0, 'archived': 0, 'last_run_started': None, 'last_run_seconds': None}
+
+    def archive_all(self, now=None):
+        log = logger.of('archive_all')
+        if now is None:
+            now = datetime.now()
+        started = time.monotonic()
+
+        things = self.db.get_thing_list()
+        self.status.update({'running': True, 'things_total': len(things), 'things_done': 0, 'things_pending': 0, 'archived': 0, 'last_run_started': timestamp(datetime.utcnow())})
+        self.write_status()
+
+        for thing in things:
+            if seconds_since_midnight(now) < jitter(thing, self.max_jitter):
+                self.status['things_pending'] += 1
+                continue
+
+            histories = self.db.archivable_histories(thing, today=now.date())
+            for history in histories:
+                self.db.archive_history_file(thing, history)
+                self.status['archived'] += 1
+                self.rate_limit()
+
+            self.status['things_done'] += 1
+            if histories:
+                self.write_status()
+
+        self.status.update({'running': False, 'last_run_seconds': round(time.monotonic() - started, 3)})
+        self.write_status()
+
+        log.info('Archived %d histories for %d things, %d things waiting for their time of day' % (self.status['archived'], self.status['things_done'], self.status['things_pending']))
+
+    def rate_limit(self):
+        if self.archives_per_second:
+            time.sleep(1 / self.archives_per_second)
+
+    # replaced whole so readers never see a partially written status
+    def write_status(self):
+        status_path = self.db_path / ARCHIVER_STATUS
+        temp_status_path = status_path.with_suffix('.tmp')
+        with temp_status_path.open('w', encoding='utf-8') as f:
+            f.write(pretty_json(self.status))
+        os.replace(str(temp_status_path), str(status_path))
+
+    def run(self):
+        log = logger.of('run')
+        if not self.running:
+            return
+
+        if not self.db_path.is_dir():
+            log.error('Database path %s is not a directory.' % self.db_path)
+            self.stop()
+            return
+
+        try:
+            self.archive_all()
+        except Exception:
+            log.error('Archiving failed', traceback=True)
+
+        if self.running:
+            t = threading.Timer(self.run_every, self.run)
+            t.start()
+
+    def start(self):
+        logger.of('start').info('Starting')
+        self.running = True
+        t = threading.Timer(1, self.run)
+        t.start()
+
+    def stop(self):
+        logger.of('stop').info('Stopping')
+        self.running = False
+
+if __name__ == '__main__':
+    archiver = Archiver()
+    archiver.start()
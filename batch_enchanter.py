@@ -0,0 +1,187 @@
+from datetime import datetime
+
+import numpy as np
+from scipy import signal
+
+import downsample
+from enchanter import compile_formulas, get_value, accumulated
+
+from logger import Logger
+logger = Logger("batch_enchanter")
+
+# The enchanter formulas over a whole history at once. A sense is a float array with nan where a
+# report does not have it, and a formula leaves nan where the enchanter would not apply it.
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def history_columns(history, keys):
+    columns = {key: np.full(len(history), np.nan) for key in keys}
+    for index, state in enumerate(history):
+        senses = state.get('state', {}).get('senses', {})
+        for key in keys:
+            value = get_value(senses.get(key))
+            if value is not None:
+                columns[key][index] = to_number(value)
+    return columns
+
+# should_reset_at for every report, old_time being the time of the report before
+def resets(reset_at_time, times, old_time):
+    if reset_at_time is None:
+        return np.zeros(len(times), dtype=bool)
+
+    previous = np.r_[old_time, times[:-1]]
+    reset_at = times.astype('datetime64[D]') + np.timedelta64(reset_at_time.hour * 60 + reset_at_time.minute, 'm')
+    return (previous <= reset_at) & ((reset_at < times) | (reset_at - ONE_DAY > previous))
+
+# Runs of reports that accumulate on each other: a run starts at a reset and after a report without
+# the sense, because the enchanter then has no previous value to go on from
+def runs(present, reset, old_present):
+    continues = np.r_[old_present, present[:-1]] & ~reset
+    starts = present & ~continues
+    indices = np.arange(len(present))
+    run_start = np.maximum.accumulate(np.where(starts, indices, 0))
+    # the first run goes on from the old enchanted state unless it starts with the first report
+    from_old = present & ~np.maximum.accumulate(starts)
+    return run_start, from_old
+
+def accumulate_sum(x, present, run_start, from_old, old_value, old_count):
+    cumulative = np.cumsum(np.where(present, x, 0))
+    before = cumulative[run_start] - np.where(present, x, 0)[run_start]
+    counts = np.arange(len(x)) - run_start + 1
+    values = cumulative - before
+    values = np.where(from_old, values + old_value, values)
+    counts = np.where(from_old, counts + old_count, counts)
+    return values, counts
+
+def accumulate_cum_average(x, present, run_start, from_old, old_value, old_count, window):
+    sums, counts = accumulate_sum(x, present, run_start, from_old, old_value * old_count, old_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = sums / counts
+    if window is None:
+        return values, counts
+
+    # once a run has window reports, each moves the average 1/window of the way to the new value
+    windowed = present & (counts > window)
+    counts = np.where(windowed, window, counts)
+    if not windowed.any():
+        return values, counts
+
+    decay = (window - 1) / window
+    index = np.flatnonzero(windowed)
+    ends = np.flatnonzero(np.diff(index) != 1)
+    for segment in np.split(index, ends + 1):
+        first = segment[0]
+        # only a run going on from an old state that already had window reports starts windowed
+        previous = old_value if run_start[first] == first else values[first - 1]
+        values[segment], _ = signal.lfilter([1 / window], [1, -decay], x[segment], zi=[decay * previous])
+
+    return values, counts
+
+# Windowed formulas carry a window of state from report to report and are calculated one report at a
+# time, as the enchanter does. Returns their values and enchanted senses.
+def apply_windowed(formula, x, present, times, old):
+    values = np.full(len(x), np.nan)
+    states = [None] * len(x)
+    for index, now in enumerate(times.astype(datetime)):
+        if present[index]:
+            old = formula.calculate([float(x[index])], old, False, now)
+        elif old is not None:
+            old = formula.advance(old, now)
+        if old is not None:
+            values[index] = old['value']
+            states[index] = old
+    return values, states
+
+def apply(formula, columns, times, old_senses, old_time):
+    inputs = [columns[key] for key in formula.inputs]
+    present = np.logical_and.reduce([~np.isnan(column) for column in inputs])
+
+    if formula.windowed:
+        return apply_windowed(formula, inputs[0], present, times, old_senses.get(formula.name))
+
+    if formula.formula == 'scale':
+        from_low, from_high, to_low, to_high = (formula.config[key] for key in ('from_low', 'from_high', 'to_low', 'to_high'))
+        return (inputs[0] - from_low) / (from_high - from_low) * (to_high - to_low) + to_low, None
+    if formula.formula == 'decorrelate':
+        return inputs[0] - (inputs[1] + formula.config['adjustment']) * formula.config['scale'], None
+    if formula.formula == 'average':
+        return np.sum(inputs, axis=0) / len(inputs), None
+
+    old = old_senses.get(formula.name)
+    reset = resets(formula.reset_at, times, old_time)
+    old_value, old_count = accumulated(old, False)
+    run_start, from_old = runs(present, reset, old is not None and isinstance(old, dict))
+    if formula.formula == 'sum':
+        values, counts = accumulate_sum(inputs[0], present, run_start, from_old, old_value, old_count)
+    else:
+        values, counts = accumulate_cum_average(inputs[0], present, run_start, from_old, old_value, old_count, formula.config.get('window'))
+
+    return np.where(present, values, np.nan), np.where(present, counts, 0)
+
+# Enchants a history of reported states with config. old_enchanted is the enchanted state before
+# the first report and other_senses the senses of other things, as in 'thing:sense'. Returns
+# name - (values, counts) for each formula, counts being None for formulas without them and the
+# enchanted senses for windowed formulas.
+def enchant_arrays(history, config, old_enchanted=None, other_senses=None):
+    formulas = compile_formulas(config)
+    if old_enchanted is None:
+        old_enchanted = {}
+    if other_senses is None:
+        other_senses = {}
+
+    times = downsample.parse_times(history)
+    old_senses = old_enchanted.get('state', {}).get('senses', {})
+    old_time_string = old_enchanted.get('timestamp_utc')
+    if old_time_string is None:
+        old_time = times[0].astype('datetime64[D]').astype(times.dtype) if len(times) else None
+    else:
+        old_time = np.datetime64(old_time_string, 'us')
+
+    names = {formula.name for formula in formulas}
+    keys = {key for formula in formulas for key in formula.inputs if ':' not in key}
+    columns = history_columns(history, keys | names)
+    for formula in formulas:
+        for key in formula.inputs:
+            if ':' in key:
+                value = get_value(other_senses.get(key))
+                columns[key] = np.full(len(history), np.nan if value is None else to_number(value))
+
+    results = {}
+    for formula in formulas:
+        values, counts = apply(formula, columns, times, old_senses, old_time)
+        results[formula.name] = (values, counts)
+        # reports the formula does not apply to keep a reported sense of the same name
+        columns[formula.name] = np.where(np.isnan(values), columns[formula.name], values)
+
+    return results
+
+# The enchanted history, unaliased, as Enchanter.enchant would give it report by report
+def enchant_history(history, config, old_enchanted=None, other_senses=None):
+    log = logger.of('enchant_history')
+    results = enchant_arrays(history, config, old_enchanted, other_senses)
+
+    enchanted_history = []
+    for index, reported in enumerate(history):
+        enchanted = dict(reported)
+        enchanted['state'] = dict(reported.get('state', {}))
+        senses = dict(enchanted['state'].get('senses', {}))
+        for name, (values, counts) in results.items():
+            if np.isnan(values[index]):
+                continue
+            if counts is None:
+                senses[name] = float(values[index])
+            elif isinstance(counts, list):
+                senses[name] = counts[index]
+            else:
+                senses[name] = {'value': float(values[index]), 'count': int(counts[index])}
+        enchanted['state']['senses'] = senses
+        enchanted_history.append(enchanted)
+
+    log.info('Enchanted %d reports with %d formulas' % (len(history), len(results)))
+    return enchanted_history
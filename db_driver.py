@@ -1,4 +1,5 @@
 from pathlib import Path
+import os
 import sys
 root_path = Path(__file__).parent.parent
 sys.path.append(str(root_path.absolute()))
@@ -6,39 +7,43 @@ sys.path.append(str(root_path.absolute()))
 from datetime import date
 from zipfile import ZipFile, ZIP_DEFLATED
 import json
-import json_delta
+import json_codec
+import math
 from datetime import datetime, timedelta, date
 import state_processor
 from state_processor import parse_isoformat
+import series
+import rollups
 import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
 
 from logger import Logger
 logger = Logger("db_driver")
 
 NON_ALIASABLE = ['lawake', 'sleep', 'state', 'version', 'voltage', 'wifi', 'delete', 'delta', 'gpio', 'threshold', 'write', 'alias', 'value', 'original', 'b', 'time', 'actions']
 
-history_day_pattern = re.compile('[a-z]*.([0-9-]*).txt')
+history_day_pattern = re.compile('[a-z]*.([0-9-]*).(txt|zip)')
 
 SHOULD_ENCHANT_FLAG = '.should-enchant.flag'
 
+HISTORY_INDEX_SUFFIX = '.idx'
+HISTORY_INDEX_BYTES = 32 * 1024 # distance between offset index entries in a history file
+
+STATE_CACHE_SIZE = 256
+# file timestamps have coarse granularity, a change within the same tick keeps the mtime
+SETTLED_NS = 10**9
+
 def safe_json_loads(s):
     try:
-        return json.loads(s)
+        return json_codec.loads(s)
     except json.decoder.JSONDecodeError:
-        logger.of('safe_json_loads').error("Could not parse %s" % s, traceback = True) 
+        logger.of('safe_json_loads').error("Could not parse %s", s, traceback=True) 
         return None
 
-def change_action_diff_format(path_parts, value, compact_to):
-    # Go from ['actions', 0], 'I2C-8|4|H|10|2'
-    # and to_compact {"actions": {'I2C-8|4|H|10|2', 'I2C-8|4|H|10|3'}}
-    # to ['actions'], ['I2C-8|4|H|10|2', 'I2C-8|4|H|10|3']
-    if len(path_parts) == 2 and path_parts[0] == 'actions':
-        action_list = list(compact_to['actions'])
-        path_parts.pop() # remove changed_index
-        return ['actions'], action_list
-
-    return path_parts, value 
-
 def parse_day_from_history_file(history_name):
     m = history_day_pattern.match(history_name)
     if m:
@@ -49,7 +54,7 @@ def parse_day_from_history_file(history_name):
             pass
 
     log = logger.of("parse_day_from_history_file")
-    log.error("Could not parse day from history file %s. Using two days ago." % history_name)
+    log.error("Could not parse day from history file %s. Using two days ago.", history_name)
     return date.today() - timedelta(days=2)
 
 def read_lines_single_zipped_file(file_path):
@@ -60,15 +65,43 @@ def read_lines_single_zipped_file(file_path):
     
     return text.splitlines()
 
+# index lines are "<timestamp_utc>\t<byte offset of a history line with that timestamp>"
+def read_history_index(index_file):
+    entries = []
+    if not index_file.exists():
+        return entries
+
+    with index_file.open(encoding='utf-8') as f:
+        for line in f:
+            split = line.rstrip('\n').split('\t')
+            if len(split) != 2:
+                continue # partially written
+            try:
+                entries.append((parse_isoformat(split[0]), int(split[1])))
+            except ValueError:
+                continue
+
+    return entries
+
+# history lines are appended in time order, so lines before the last entry not newer than since can be skipped
+def history_offset(index_file, since):
+    offset = 0
+    for time, entry_offset in read_history_index(index_file):
+        if time > since:
+            break
+        offset = entry_offset
+
+    return offset
+
 def is_displayable(s):
     b = s not in NON_ALIASABLE
     return b and not s.startswith('A|') and (not ':' in s)
 
 def pretty_json(d):
-    return json.dumps(d, sort_keys=True, indent=4, separators=(',', ': '), ensure_ascii=False)
+    return json_codec.dumps_pretty(d)
 
 def to_compact_json(s):
-    return json.dumps(s, separators=(',', ':'))
+    return json_codec.dumps_compact(s)
 
 def pretty_list(l):
     return ', '.join(map(str, l))
@@ -79,7 +112,7 @@ def validate_input(thing, state, value):
         if not type(value) is list:
             raise Exception("Expected value to be list, got %s instead" % type(value))
     elif not type(value) is dict:
-        log.error("Called with a non-dict value - %s %s %s. Raising exception" % (thing, state, value))
+        log.error("Called with a non-dict value - %s %s %s. Raising exception", thing, state, value)
         raise Exception("Expected value to be dict, got %s instead" % type(value))
 
 def timestamp(time):
@@ -101,6 +134,108 @@ def flat_map(d, field, default="", strict=False):
 
     return filtered
 
+def is_settled(mtime_ns):
+    return time.time_ns() - mtime_ns > SETTLED_NS
+
+# faster than deepcopy for what json.loads returns
+def copy_json(o):
+    if type(o) is dict:
+        return {key: copy_json(value) for key, value in o.items()}
+    if type(o) is list:
+        return [copy_json(value) for value in o]
+    return o
+
+class StateCache:
+    def __init__(self, max_size=STATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # signature is what the file looked like when value was read, (st_mtime_ns, st_size)
+    def get(self, key, signature):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != signature:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, signature, value):
+        with self.lock:
+            self.entries[key] = (signature, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+class AliasIndex:
+    def __init__(self, alias_directory):
+        self.alias_directory = alias_directory
+        self.lock = threading.Lock()
+        self.signature = None
+        self.thing_by_alias = {}
+        self.aliases_by_thing = {}
+
+    # rebuilt only when an alias symlink was added or removed, which changes the directory mtime
+    def _refresh(self):
+        try:
+            signature = self.alias_directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            signature = None
+
+        if signature is not None and signature == self.signature:
+            return
+
+        self.thing_by_alias = {}
+        self.aliases_by_thing = {}
+        if signature is not None:
+            for existing_alias in self.alias_directory.iterdir():
+                if existing_alias.is_symlink():
+                    self._add(existing_alias.resolve().name, existing_alias.name)
+        self.signature = signature if signature is not None and is_settled(signature) else None
+
+    def _add(self, thing, alias):
+        self.thing_by_alias[alias] = thing
+        self.aliases_by_thing.setdefault(thing, []).append(alias)
+
+    def thing(self, alias):
+        with self.lock:
+            self._refresh()
+            return self.thing_by_alias.get(alias)
+
+    def aliases(self, thing):
+        with self.lock:
+            self._refresh()
+            return list(self.aliases_by_thing.get(thing, []))
+
+    def replace(self, thing, alias, target):
+        with self.lock:
+            self._refresh()
+            if not self.alias_directory.is_dir():
+                self.alias_directory.mkdir()
+                self.alias_directory.chmod(0o774)
+
+            for existing_alias in self.aliases_by_thing.pop(thing, []):
+                (self.alias_directory / existing_alias).unlink()
+                self.thing_by_alias.pop(existing_alias, None)
+
+            symlinked = self.alias_directory / alias
+            symlinked.symlink_to(target)
+            self._add(thing, alias)
+            self.signature = None
+
 def prepare_test_directory(directory_path):
     db_directory = directory_path / "db"
     db_directory.mkdir()
@@ -117,6 +252,12 @@ class DatabaseDriver:
     def __init__(self, working_directory="", directory="db", view='view'):
         self.directory = Path(working_directory) / directory
         self.view = (Path(working_directory) / view)
+        self.state_cache = StateCache()
+        self.alias_index = AliasIndex(self.directory / 'na')
+        self.delta_cache = {}
+        self.delta_lock = threading.Lock()
+        self.history_index_bytes = HISTORY_INDEX_BYTES
+        self.history_indexed = {}
 
     # Level 3: this class callables
     def _prepare_directory(self, directory):
@@ -138,44 +279,64 @@ class DatabaseDriver:
         if not history_path.is_dir():
             history_path.mkdir()
             history_path.chmod(0o774)
-            log.info("Created new history directory for %s" % thing)
+            log.info("Created new history directory for %s", thing)
             log_updated.append('new_history_directory')
         history_state_path = history_path / state
         history_state_file = history_state_path.with_suffix('.%s.txt' % date.today().isoformat())
 
-        if not history_state_file.exists():
-            # if this is the beginning of a new day, put day-2 history in archive
-            log.info("First record for %s for the new day. Archiving more than 2 days old history" % thing)
-            self._archive_history(thing, state)
-            log_updated.append('archive')
-
-        state_file = self._get_state_path(thing, state)
-
-        with history_state_file.open('a+', encoding='utf-8') as f:
-            f.write(to_compact_json(previous_value))
-            f.write('\n')
+        # archiving of old days is done in the background by archiver.py
+        with history_state_file.open('ab') as f:
+            offset = f.tell()
+            f.write(to_compact_json(previous_value).encode('utf-8'))
+            f.write(b'\n')
             log_updated.append('history')
 
+        if self._index_history(thing, state, history_state_file, offset, previous_value.get('timestamp_utc')):
+            log_updated.append('history_index')
+
         return log_updated
 
+    def _index_history(self, thing, state, history_file, offset, timestamp_string):
+        if timestamp_string is None:
+            return False
+
+        index_file = history_file.with_suffix(HISTORY_INDEX_SUFFIX)
+        indexed_file, indexed_offset = self.history_indexed.get((thing, state), (None, None))
+        if indexed_file != index_file:
+            entries = read_history_index(index_file)
+            indexed_offset = entries[-1][1] if entries else None
+
+        if indexed_offset is not None and offset - indexed_offset < self.history_index_bytes:
+            self.history_indexed[(thing, state)] = (index_file, indexed_offset)
+            return False
+
+        with index_file.open('a', encoding='utf-8') as f:
+            f.write('%s\t%d\n' % (timestamp_string, offset))
+        self.history_indexed[(thing, state)] = (index_file, offset)
+        return True
+
     def _get_state_path(self, thing, state):
         p = self.directory / thing / state
         return p.with_suffix(".json")
 
+    def _write_state(self, thing, state_name, value):
+        state_file = self._get_state_path(thing, state_name)
+        self.state_cache.invalidate((thing, state_name))
+        with state_file.open('w', encoding='utf-8') as f:
+            f.write(json_codec.dumps_state(value))
+
     def _get_should_enchant_flag_path(self, thing):
         return self.directory / thing / SHOULD_ENCHANT_FLAG 
 
     def _apply_aliases(self, thing, d, aliases=None):
         log = logger.of('_apply_aliases')
         if aliases is None:
-            a = self._get_state_path(thing, 'displayables')
-            if not a.exists():
-                log.info('No aliases applied because file does not exist')
+            displayables = self.load_state(thing, 'displayables')
+            if not displayables:
+                log.info('No aliases applied because there are no displayables')
                 return d
 
-            with a.open(encoding='utf-8') as f:
-                displayables = json.loads(f.read())
-                aliases = flat_map(displayables, 'alias')
+            aliases = flat_map(displayables, 'alias')
 
         aliased = {}
         
@@ -212,50 +373,77 @@ class DatabaseDriver:
 
         return dealiased 
 
-    def _archive_history(self, thing, state):
-        log = logger.of('_archive_history')
-        year = date.today().year
-        two_days_ago = date.today() - timedelta(days=2)
-        thing_directory = self.directory / thing
-        history_path = thing_directory / "history" 
-        histories = [x for x in history_path.iterdir() if x.match('%s*.txt' % state)]
+    def archivable_histories(self, thing, today=None):
+        if today is None:
+            today = date.today()
+        two_days_ago = today - timedelta(days=2)
+        history_path = self.directory / thing / "history"
+        if not history_path.is_dir():
+            return []
 
-        for history in histories:
-            day = parse_day_from_history_file(history.name)
-            if day > two_days_ago:
-                continue
+        histories = [x for x in history_path.iterdir() if x.match('*.txt')]
+        return sorted(x for x in histories if parse_day_from_history_file(x.name) <= two_days_ago)
+
+    # The days with state_name history, archived or not yet
+    def history_days(self, thing, state_name):
+        history_path = self.directory / thing / "history"
+        if not history_path.is_dir():
+            return []
+
+        files = list(history_path.glob('%s.*.txt' % state_name)) + list(history_path.glob('archive/*/%s.*.zip' % state_name))
+        return sorted({parse_day_from_history_file(x.name) for x in files})
 
-            old_history_file = history
-            with old_history_file.open(encoding='utf-8') as f:
-                lines = f.readlines()
+    def archive_history_file(self, thing, history):
+        log = logger.of('archive_history_file')
+        state = history.name.split('.')[0]
+        day = parse_day_from_history_file(history.name)
 
-            error_free_contents = "\n".join(map(to_compact_json, [x for x in map(safe_json_loads, lines) if x is not None]))
+        with history.open(encoding='utf-8') as f:
+            lines = f.readlines()
 
-            archive_directory = thing_directory / "history" / "archive"
-            if not archive_directory.is_dir():
-                archive_directory.mkdir()
-                archive_directory.chmod(0o774)
-                log.info("Created new archive directory for %s" % thing)
+        self._write_archive(thing, state, day, [x for x in map(safe_json_loads, lines) if x is not None])
 
-            year_directory = archive_directory / str(year)
+        history.unlink() 
+        index_file = history.with_suffix(HISTORY_INDEX_SUFFIX)
+        if index_file.exists():
+            index_file.unlink()
 
-            if not year_directory.is_dir():
-                year_directory.mkdir()
-                year_directory.chmod(0o774)
-                log.info("Created new archive directory for %s year %s" % (thing, year))
+        log.info("Archived %s history from %s for %s", state, day, thing)
 
-            archive_path = year_directory / state
-            archive_file = archive_path.with_suffix(".%s.zip" % day.isoformat())
+    def _write_archive(self, thing, state, day, states):
+        log = logger.of('_write_archive')
+        thing_directory = self.directory / thing
+        contents = "\n".join(map(to_compact_json, states))
 
-            with ZipFile(str(archive_file), 'w', ZIP_DEFLATED) as zf:
-                arcname = '%s.%s.txt' % (state, day.isoformat())
-                zf.writestr(arcname, error_free_contents)
+        archive_directory = thing_directory / "history" / "archive"
+        if not archive_directory.is_dir():
+            archive_directory.mkdir()
+            archive_directory.chmod(0o774)
+            log.info("Created new archive directory for %s", thing)
 
-            old_history_file.unlink() 
+        year_directory = archive_directory / str(day.year)
 
-            log.info("Archived history from %s for %s" % (day, thing))
-        else:
-            log.info("No history for %s older than %s" % (thing, two_days_ago))
+        if not year_directory.is_dir():
+            year_directory.mkdir()
+            year_directory.chmod(0o774)
+            log.info("Created new archive directory for %s year %s", thing, day.year)
+
+        archive_path = year_directory / state
+        archive_file = archive_path.with_suffix(".%s.zip" % day.isoformat())
+
+        # written aside and renamed, readers fall back to the history file until the archive is complete
+        temp_archive_file = archive_file.with_suffix('.tmp')
+        with ZipFile(str(temp_archive_file), 'w', ZIP_DEFLATED) as zf:
+            arcname = '%s.%s.txt' % (state, day.isoformat())
+            zf.writestr(arcname, contents)
+        os.replace(str(temp_archive_file), str(archive_file))
+
+    def archive_histories(self, thing):
+        histories = self.archivable_histories(thing)
+        for history in histories:
+            self.archive_history_file(thing, history)
+
+        return len(histories)
 
     def update(self, state, thing, value):
         if state == 'reported':
@@ -271,7 +459,7 @@ class DatabaseDriver:
         elif state == 'plot-background':
             self._update_plot_background(thing, value)
         else:
-            logger.of('update').error('Unknown update state %s' % state)
+            logger.of('update').error('Unknown update state %s', state)
             raise Exception('Unknown update state %s' % state)
 
         with (self.directory / 'last-modified.txt').open('w', encoding='utf-8') as f:
@@ -291,22 +479,15 @@ class DatabaseDriver:
         thing_directory = self.directory / thing
         if not thing_directory.exists():
             self._prepare_directory(thing_directory)
-            log.info("Created new thing directory for %s" % thing)
+            log.info("Created new thing directory for %s", thing)
             log_updated.append('new_thing')
 
         state = "reported"
-        state_file = self._get_state_path(thing, state)
 
-        if state_file.exists():
-            with state_file.open(encoding='utf-8') as f:
-                previous_value = json.loads(f.read())
+        previous_value = self.load_state(thing, state)
+        if previous_value:
             result = self._append_history(thing, state, previous_value)
             log_updated.extend(result)
-            previous_state = previous_value.get('state', {})
-            previous_timestamp = previous_value.get('timestamp_utc', None)
-        else:
-            previous_state = {}
-            previous_timestamp = None
 
         value = state_processor.explode(value)
         
@@ -316,69 +497,115 @@ class DatabaseDriver:
             log_updated.append('created_desired')
         
         encapsulated_value = encapsulate_and_timestamp(value, "state", time=time)
-        with state_file.open('w', encoding='utf-8') as f:
-            f.write(pretty_json(encapsulated_value))
-            log_updated.append('state')
+        self._write_state(thing, state, encapsulated_value)
+        log_updated.append('state')
+        self._refresh_delta(thing, value.get('config'))
+
+        updated_series = series.append_state(thing_directory, state, value, time)
+        if updated_series:
+            log_updated.append('series')
+
+        updated_rollups = rollups.update_state(thing_directory, state, value, time)
+        if updated_rollups:
+            log_updated.append('rollups')
 
         should_enchant_flag = self._get_should_enchant_flag_path(thing)
 
         should_enchant_flag.touch()
 
-        graphs = [x for x in thing_directory.iterdir() if x.match('graph*.png')]
-        if len(graphs) > 0:
-            for graph in graphs:
-                graph.unlink()
-            log_updated.append('deleted_graph')
+        log.info("[%s] updated %s", thing, pretty_list(log_updated))
 
-        log.info("[%s] updated %s" % (thing, pretty_list(log_updated)))
+    # Called by the enchanter with each enchanted report. Like reported, the previous state goes to
+    # history, so graphs and exports read derived senses instead of replaying the enchanter.
+    def _update_enchanted(self, thing, value):
+        log = logger.of('update_enchanted')
+        log_updated = []
+        thing_directory = self.directory / thing
+        state = 'enchanted'
+
+        previous_value = self.load_state(thing, state)
+        # the same report enchanted again replaces its state, it is already in history and series
+        again = previous_value.get('timestamp_utc') == value['timestamp_utc']
+        if previous_value and not again:
+            log_updated.extend(self._append_history(thing, state, previous_value))
+
+        self._write_state(thing, state, value)
+        log_updated.append('state')
+
+        if not again:
+            time = parse_isoformat(value['timestamp_utc'])
+            if series.append_state(thing_directory, state, value['state'], time):
+                log_updated.append('series')
+            if rollups.update_state(thing_directory, state, value['state'], time):
+                log_updated.append('rollups')
+
+        log.info("[%s] updated %s", thing, pretty_list(log_updated))
 
+    def _compact_config(self, config):
+        return state_processor.compact(self._dealias(config))
+
+    def _delta_signatures(self, thing):
+        return self._state_signature(thing, "desired"), self._state_signature(thing, "reported")
+
+    def _state_signature(self, thing, state_name):
+        try:
+            stat = self._get_state_path(thing, state_name).stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    # desired is written by other processes, reported only by the operator that also answers get
     def get_delta(self, thing):
-        log = logger.of('get_delta')
+        desired_signature, reported_signature = self._delta_signatures(thing)
+        with self.delta_lock:
+            cached = self.delta_cache.get(thing)
+
+        if cached is not None \
+                and desired_signature is not None \
+                and cached['desired'] == desired_signature \
+                and cached['reported'] == reported_signature \
+                and is_settled(desired_signature[0]):
+            return dict(cached['delta'])
+
+        delta, compact_from = self._compute_delta(thing)
+        if compact_from is not None:
+            with self.delta_lock:
+                self.delta_cache[thing] = {'desired': desired_signature, 'reported': reported_signature, 'compact_from': compact_from, 'delta': dict(delta)}
+
+        return delta
+
+    def _refresh_delta(self, thing, config):
+        with self.delta_lock:
+            cached = self.delta_cache.pop(thing, None)
+            if cached is None or not isinstance(config, dict):
+                return
+
+            if self._compact_config(config) == cached['compact_from']:
+                cached['reported'] = self._state_signature(thing, "reported")
+                self.delta_cache[thing] = cached
+
+    def _invalidate_delta(self, thing):
+        with self.delta_lock:
+            self.delta_cache.pop(thing, None)
+
+    def _compute_delta(self, thing):
+        log = logger.of('_compute_delta')
         from_state = self.load_state(thing, "reported")
         if from_state.get('state') is None or from_state.get('state').get('config') is None:
-            log.error("Unexpected from_state format, expected to begin with state/config. %s %s" % (thing, from_state))
-            return {"error":1}
+            log.error("Unexpected from_state format, expected to begin with state/config. %s %s", thing, from_state)
+            return {"error":1}, None
         from_state = from_state['state']['config']
 
         to_state = self.load_state(thing, "desired")
 
         if to_state == {}:
-            log.info("desired of %s is empty. Assuming no delta needed." % thing)
-            return {}
-        from_state = self._dealias(from_state) 
-        to_state = self._dealias(to_state)
+            log.info("desired of %s is empty. Assuming no delta needed.", thing)
+            return {}, self._compact_config(from_state)
 
-        compact_from = state_processor.compact(from_state)
-        compact_to = state_processor.compact(to_state)
-        delta_stanza = json_delta.diff(compact_from, compact_to, verbose=False)
+        compact_from = self._compact_config(from_state)
+        compact_to = self._compact_config(to_state)
 
-        if delta_stanza == []:
-            return {}
-
-        delta_dict = {}
-        for diff in delta_stanza:
-            path_parts = diff[0]
-            if len(diff) == 1:
-                if len(diff[0]) > 1 and diff[0][0] == 'actions':
-                    delete_which = diff[0][1]
-                    actions = compact_from['actions']
-                    actions.pop(delete_which)
-                    delta_dict.update({"actions":actions})
-                else:
-                    log.info("No value specified in diff, seems like field present in from is missing in to - skipping. %s %s" % (thing, diff))
-                continue
-            value = diff[1]
-            path_parts, value = change_action_diff_format(path_parts, value, compact_to)
-            d = value
-            post_config = path_parts
-            post_config.reverse()
-            for path_part in post_config:
-                new_d = {}
-                new_d[path_part] = d     
-                d = new_d
-            delta_dict.update(d)
-
-        return delta_dict
+        return state_processor.diff_config(compact_from, compact_to), compact_from
 
     # Level 1: gui/user callables. Thing may be aliased, thus a_thing
 
@@ -386,43 +613,50 @@ class DatabaseDriver:
         thing_directory = self.directory / thing
         state_path = thing_directory / state_name
         state_file = state_path.with_suffix(".json")
+        key = (thing, state_name)
 
-        if state_file.exists():
-            with state_file.open(encoding='utf-8') as f:
-                contents = f.read()
-
-            deserialized = safe_json_loads(contents)
-            if deserialized is None:
-                return {}
-            return deserialized
-        else:
+        try:
+            stat = state_file.stat()
+        except FileNotFoundError:
+            self.state_cache.invalidate(key)
             log = logger.of('load_state')
-            log.info("Tried to load state that does not exist: %s/%s" % (thing, state_name))
+            log.info("Tried to load state that does not exist: %s/%s", thing, state_name)
+
+            return {}
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.state_cache.get(key, signature)
+        if cached is not None:
+            return copy_json(cached)
 
+        with state_file.open(encoding='utf-8') as f:
+            contents = f.read()
+
+        deserialized = safe_json_loads(contents)
+        if deserialized is None:
             return {}
 
+        if is_settled(stat.st_mtime_ns):
+            self.state_cache.put(key, signature, deserialized)
+        return copy_json(deserialized)
+
     def alias_thing(self, thing):
-        log = logger.of('alias_thing')
-        alias = thing
-        alias_directory = self.directory / 'na'
-        for existing_alias in alias_directory.iterdir():
-            if existing_alias.resolve().name == thing:
-                alias = existing_alias.name
-                break
+        aliases = self.alias_index.aliases(thing)
+        if aliases:
+            return aliases[0]
 
-        return alias
+        return thing
 
     def resolve_thing(self, a_thing):
         log = logger.of('resolve_thing')
         if (self.directory / a_thing).is_dir():
             return a_thing
-        aliased_dir = self.directory / "na" / a_thing
-        if aliased_dir.is_symlink():
-            thing = aliased_dir.resolve().name
-            log.info("Resolved thing alias %s to %s" % (a_thing, thing))
+        thing = self.alias_index.thing(a_thing)
+        if thing is not None:
+            log.info("Resolved thing alias %s to %s", a_thing, thing)
             return thing
         else:
-            log.warning("%s is neither a thing or a thing alias." % a_thing)
+            log.warning("%s is neither a thing or a thing alias.", a_thing)
             return None
 
 
@@ -430,16 +664,10 @@ class DatabaseDriver:
         if type(alias) is not str or '/' in alias:
             raise Exception("Invalid alias received for thing %s: %s" % (thing, alias))
 
-        alias_directory = self.directory / "na"
-        for existing_alias in alias_directory.iterdir():
-            if existing_alias.resolve().name == thing:
-                existing_alias.unlink()
-
         actual = self.directory / thing
-        symlinked = alias_directory / alias
-        symlinked.symlink_to(actual.resolve())
+        self.alias_index.replace(thing, alias, actual.resolve())
         log = logger.of('update_thing_alias')
-        log.info("%s aliased to %s" % (thing, alias))
+        log.info("%s aliased to %s", thing, alias)
 
     def _update_enchanter(self, a_thing, value):
         log = logger.of('update_enchanter')
@@ -457,18 +685,16 @@ class DatabaseDriver:
         state_file = self._get_state_path(thing, state)
 
         if state_file.exists():
-            with state_file.open(encoding='utf-8') as f:
-                previous_value = json.loads(f.read())
+            previous_value = self.load_state(thing, state)
 
             encapsulated_previous_value = encapsulate_and_timestamp(previous_value, 'state')
             result = self._append_history(thing, state, encapsulated_previous_value)
             log_updated.extend(result)
             
-        with state_file.open('w', encoding='utf-8') as f:
-            f.write(pretty_json(value))
-            log_updated.append('state')
+        self._write_state(thing, state, value)
+        log_updated.append('state')
 
-        log.info("[%s] updated %s" % (thing, pretty_list(log_updated)))
+        log.info("[%s] updated %s", thing, pretty_list(log_updated))
 
 
 
@@ -497,23 +723,23 @@ class DatabaseDriver:
             result = self._append_history(thing, state, encapsulated_previous_value)
             log_updated.extend(result)
             
-        with state_file.open('w', encoding='utf-8') as f:
-            # refresh aliases
-            value = self._apply_aliases(thing, self._dealias(value))
+        # refresh aliases
+        value = self._apply_aliases(thing, self._dealias(value))
 
-            # fill default action values if needed
-            value = state_processor.explode(state_processor.compact(value))
-            f.write(pretty_json(value))
-            log_updated.append('state')
+        # fill default action values if needed
+        value = state_processor.explode(state_processor.compact(value))
+        self._write_state(thing, state, value)
+        self._invalidate_delta(thing)
+        log_updated.append('state')
 
         log = logger.of('update_desired')
-        log.info("[%s] updated %s" % (thing, pretty_list(log_updated)))
+        log.info("[%s] updated %s", thing, pretty_list(log_updated))
 
     def _update_displayables(self, a_thing, value):
         log = logger.of('update_displayables')
         validate_input(a_thing, "displayables", value)
         if len(list(filter(is_displayable, value.keys()))) != len(value.keys()): 
-            log.error("Some of the keys are not displayable. Ignoring update. %s %s" % (a_thing, value))
+            log.error("Some of the keys are not displayable. Ignoring update. %s %s", a_thing, value)
             return
 
         log_updated = []
@@ -528,18 +754,16 @@ class DatabaseDriver:
         state_file = self._get_state_path(thing, state)
 
         if state_file.exists():
-            with state_file.open(encoding='utf-8') as f:
-                previous_value = json.loads(f.read())
+            previous_value = self.load_state(thing, state)
 
             encapsulated_previous_value = encapsulate_and_timestamp(previous_value, 'state')
             result = self._append_history(thing, state, encapsulated_previous_value)
             log_updated.extend(result)
             
-        with state_file.open('w', encoding='utf-8') as f:
-            f.write(pretty_json(value))
-            log_updated.append('state')
+        self._write_state(thing, state, value)
+        log_updated.append('state')
 
-        log.info("[%s] updated %s" % (thing, pretty_list(log_updated)))
+        log.info("[%s] updated %s", thing, pretty_list(log_updated))
 
     def _load_archive_for_day(self, thing, state_name, day):
         log = logger.of('load_archive_for_day')
@@ -549,22 +773,28 @@ class DatabaseDriver:
 
         if archive_file.exists():
             text = read_lines_single_zipped_file(archive_file)
-            states = list(map(json.loads, text))
+            states = list(map(json_codec.loads, text))
         else:
-            states = []
+            # the archiver has not got to this day yet
+            states = self._load_history_for_day(thing, state_name, day)
 
         return states
 
-    def _load_history_for_day(self, thing, state_name, day):
+    def _load_history_for_day(self, thing, state_name, day, since=None):
         history_path = self.directory / thing / "history"/ state_name
         history_file = history_path.with_suffix(".%s.txt" % day.isoformat())
 
         if history_file.exists():
-            with history_file.open(encoding='utf-8') as f:
-                states = [x for x in map(safe_json_loads, f.readlines()) if x is not None]
+            offset = 0
+            if since is not None:
+                offset = history_offset(history_file.with_suffix(HISTORY_INDEX_SUFFIX), since)
+            with history_file.open('rb') as f:
+                f.seek(offset)
+                lines = f.read().decode('utf-8').splitlines()
+            states = [x for x in map(safe_json_loads, lines) if x is not None]
         else:
             log = logger.of("load_history_for_day")
-            log.info("No history exists for %s %s for %s" % (thing, state_name, day))
+            log.info("No history exists for %s %s for %s", thing, state_name, day)
             states = []
 
         return states
@@ -576,7 +806,7 @@ class DatabaseDriver:
             since_hours = 0
         if since_hours > 24:
             log = logger.of("load_history")
-            log.error("Called with since_hours %d - too big. Transforming to days and ignoring remainder hours." % since_hours)
+            log.error("Called with since_hours %d - too big. Transforming to days and ignoring remainder hours.", since_hours)
             since_days = since_hours // 24
             since_hours = 0
 
@@ -584,7 +814,7 @@ class DatabaseDriver:
 
         thing_directory = self.directory / thing
 
-        history_path = thing_directory / "history"/ state_name
+        since_datetime = datetime.utcnow() - timedelta(days=since_days, hours=since_hours)
         today = date.today()
         history = []
         
@@ -594,18 +824,75 @@ class DatabaseDriver:
 
         if since_days > 0:
             yesterday = today - timedelta(days=1)
-            history.extend(self._load_history_for_day(thing, state_name, yesterday))
+            history.extend(self._load_history_for_day(thing, state_name, yesterday, since=since_datetime))
 
-        history.extend(self._load_history_for_day(thing, state_name, today))
+        history.extend(self._load_history_for_day(thing, state_name, today, since=since_datetime))
 
         state = self.load_state(thing, state_name)
         if state:
             history.append(state)
 
-        since_datetime = datetime.utcnow() - timedelta(days=since_days, hours=since_hours)
         filtered_history = list(filter(lambda s: parse_isoformat(s['timestamp_utc']) > since_datetime, history))
         return filtered_history 
 
+    def load_series(self, a_thing, key, state_name='reported', kind='senses', since_days=1, since_hours=0):
+        thing = self.resolve_thing(a_thing)
+        path = series.series_path(self.directory / thing, state_name, kind, key)
+        since_datetime = datetime.utcnow() - timedelta(days=since_days, hours=since_hours)
+
+        return series.load(path, since=since_datetime)
+
+    def series_keys(self, a_thing, state_name='reported', kind='senses'):
+        thing = self.resolve_thing(a_thing)
+        return series.keys(self.directory / thing, state_name, kind)
+
+    # History made of the rollups of the coarsest resolution that still gives points buckets, one
+    # state per bucket with the mean of each sense and the highest write, so a write that was on
+    # during the bucket is shown. None when raw history is needed, because the span is too short
+    # or the rollups do not reach back to since.
+    def load_rollup_history(self, a_thing, state_name='reported', since_days=1, since_hours=0, points=1000):
+        log = logger.of('load_rollup_history')
+        span = timedelta(days=since_days, hours=since_hours)
+        resolution = rollups.choose_resolution(span.total_seconds(), points)
+        if resolution is None:
+            return None
+
+        thing = self.resolve_thing(a_thing)
+        thing_directory = self.directory / thing
+        since_datetime = datetime.utcnow() - span
+
+        loaded = {}
+        covered = False
+        for kind in series.SERIES_KINDS:
+            for key in rollups.keys(thing_directory, state_name, kind, resolution):
+                records = rollups.load(rollups.rollup_path(thing_directory, state_name, kind, key, resolution))
+                if len(records) == 0:
+                    continue
+                covered = covered or records['time'][0] <= series.to_datetime64(since_datetime)
+                records = rollups.since(records, since_datetime, resolution)
+                if len(records) > 0:
+                    loaded[(kind, key)] = records
+
+        if not covered:
+            log.info('Rollups of %s do not reach back to %s', thing, since_datetime)
+            return None
+
+        states = {}
+        for (kind, key), records in loaded.items():
+            if kind == 'senses':
+                values = rollups.mean(records)
+            else:
+                values = np.where(records['count'] > 0, records['max'], np.nan)
+            for bucket, value in zip(records['time'].tolist(), values.tolist()):
+                state = states.setdefault(bucket, {}).setdefault(kind, {})
+                if kind == 'senses':
+                    # a bucket with only wrong values is a sense without value, like a wrong report
+                    state[key] = {} if math.isnan(value) else {'value': value}
+                elif not math.isnan(value):
+                    state[key] = value
+
+        return [{'timestamp_utc': timestamp(bucket), 'state': states[bucket]} for bucket in sorted(states)]
+
     def _update_plot_background(self, a_thing, svg_bytes):
         thing = self.resolve_thing(a_thing)
         plot_path = self.directory / thing / 'plot.png'
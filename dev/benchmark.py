@@ -0,0 +1,231 @@
+#!/www/zelenik/venv/bin/python
+
+# Micro benchmarks of the hot paths. Usage: dev/benchmark.py [name ...]
+
+from pathlib import Path
+import sys
+root_path = Path(__file__).absolute().parent.parent
+sys.path.append(str(root_path))
+
+import argparse
+from tempfile import TemporaryDirectory
+import time
+import timeit
+
+import state_processor
+import json_codec
+import json
+
+BENCHMARKS = {}
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+def measure(name, statement, number):
+    seconds = min(timeit.repeat(statement, number=number, repeat=3))
+    print("%-40s %10.2f us" % (name, seconds / number * 1e6))
+    return seconds / number
+
+def compare(name, before, after, number):
+    before_seconds = measure("%s (before)" % name, before, number)
+    after_seconds = measure("%s (after)" % name, after, number)
+    print("%-40s %10.1fx" % (name, before_seconds / after_seconds))
+
+# get_delta before state_processor.diff_config
+def json_delta_diff_config(compact_from, compact_to):
+    import json_delta # not a runtime dependency anymore
+
+    delta_stanza = json_delta.diff(compact_from, compact_to, verbose=False)
+    delta_dict = {}
+    for diff in delta_stanza:
+        path_parts = diff[0]
+        if len(diff) == 1:
+            if len(diff[0]) > 1 and diff[0][0] == 'actions':
+                actions = list(compact_from['actions'])
+                actions.pop(diff[0][1])
+                delta_dict.update({"actions": actions})
+            continue
+        value = diff[1]
+        if len(path_parts) == 2 and path_parts[0] == 'actions':
+            path_parts, value = ['actions'], list(compact_to['actions'])
+        d = value
+        for path_part in reversed(path_parts):
+            d = {path_part: d}
+        delta_dict.update(d)
+
+    return delta_dict
+
+CONFIG_FROM = {"sleep": 60, "gpio": {"4": "OneWire", "5": "DHT11"}, "mode": {"12": "a", "13": "m"}, "actions": ["I2C-8|4|H|300|20", "OW-1|5|L|25|1", "time|13|H|28800|3600"]}
+# json_delta_diff_config sends the actions from before the change when an action is also removed,
+# so the fixture changes an action without removing one and both give the same delta
+CONFIG_TO = {"sleep": 120, "gpio": {"4": "OneWire", "5": "DHT22"}, "mode": {"12": "a", "13": "m"}, "actions": ["I2C-8|4|H|300|20", "OW-1|5|L|26|1", "time|13|H|28800|3600"]}
+
+@benchmark
+def config_diff():
+    before = json_delta_diff_config(CONFIG_FROM, CONFIG_TO)
+    after = state_processor.diff_config(CONFIG_FROM, CONFIG_TO)
+    if before != after:
+        print("Deltas differ, before: %s after: %s" % (before, after))
+
+    compare("config diff, changed",
+            lambda: json_delta_diff_config(CONFIG_FROM, CONFIG_TO),
+            lambda: state_processor.diff_config(CONFIG_FROM, CONFIG_TO),
+            number=2000)
+    compare("config diff, unchanged",
+            lambda: json_delta_diff_config(CONFIG_FROM, CONFIG_FROM),
+            lambda: state_processor.diff_config(CONFIG_FROM, CONFIG_FROM),
+            number=2000)
+
+REPORTED = {"state": {"senses": {"OW-1": {"value": 21.5, "expected": 21.4, "ssd": 3}, "OW-2": {"value": 18.25}, "I2C-8": {"value": 612, "expected": 600, "ssd": 12}, "A0": {"value": 80}, "time": "13:05"},
+        "write": {"4": 1, "5": 0, "13": 0}, "config": CONFIG_FROM, "boot_utc": "2017-06-26 08:19:09", "lawake": 4, "version": "2.1.3", "wifi": "zelenik", "voltage": 3.31, "state": "local_publish"},
+        "timestamp_utc": "2017-06-26 10:19:09"}
+
+@benchmark
+def codec():
+    compact = json.dumps(REPORTED, separators=(',', ':'))
+    if compact != json_codec.dumps_compact(REPORTED):
+        print("Compact output differs")
+    if json_codec.orjson is None:
+        print("orjson is not installed, the codec falls back to json")
+
+    compare("compact dumps",
+            lambda: json.dumps(REPORTED, separators=(',', ':')),
+            lambda: json_codec.dumps_compact(REPORTED),
+            number=5000)
+    compare("loads",
+            lambda: json.loads(compact),
+            lambda: json_codec.loads(compact),
+            number=5000)
+    compare("state dumps, pretty before and compact after",
+            lambda: json_codec.dumps_pretty(REPORTED),
+            lambda: json_codec.dumps_compact(REPORTED),
+            number=5000)
+
+ENCHANTER_CONFIG = [{"name": "I2C-8-percent", "formula": "scale", "from": "I2C-8", "from_low": 0, "from_high": 1024, "to_low": 0, "to_high": 100},
+        {"name": "OW-1-average", "formula": "cum_average", "from": "OW-1", "window": 60}]
+
+def things(working_directory, count):
+    import db_driver
+
+    db_driver.prepare_test_directory(Path(working_directory))
+    db = db_driver.DatabaseDriver(working_directory)
+    for index in range(count):
+        thing = 'thing-%d' % index
+        db.update('reported', thing, REPORTED['state'])
+        db.update('enchanter', thing, ENCHANTER_CONFIG)
+    return db
+
+def report_all(db, count):
+    for index in range(count):
+        db.update('reported', 'thing-%d' % index, REPORTED['state'])
+
+# stands in for a disk that takes its time to write enchanted.json
+def slowed(update, seconds):
+    def slow_update(thing, value):
+        time.sleep(seconds)
+        update(thing, value)
+    return slow_update
+
+@benchmark
+def enchant_sweep():
+    import enchanter
+
+    for latency in (0, 0.005):
+        for count in (10, 50, 200):
+            for workers in (1, 4):
+                with TemporaryDirectory() as working_directory:
+                    db = things(working_directory, count)
+                    sweeping = enchanter.Enchanter(working_directory, watch=False, workers=workers)
+                    # the first sweep creates the files of every thing, later ones only append to them
+                    sweeping.enchant_flagged()
+                    report_all(db, count)
+                    if latency:
+                        sweeping.db._update_enchanted = slowed(sweeping.db._update_enchanted, latency)
+                    started = time.perf_counter()
+                    sweeping.enchant_flagged()
+                    seconds = time.perf_counter() - started
+                    sweeping.stop()
+                name = "sweep of %d things, %d workers, %d ms writes" % (count, workers, latency * 1e3)
+                print("%-50s %10.2f ms" % (name, seconds * 1e3))
+
+MONTH_OF_REPORTS = 30 * 24 * 12 # every five minutes
+
+def month_history():
+    import db_driver
+    from datetime import datetime, timedelta
+
+    start = datetime(2018, 3, 1)
+    history = []
+    for index in range(MONTH_OF_REPORTS):
+        state = db_driver.copy_json(REPORTED)
+        state['state']['senses']['OW-1']['value'] = 20 + index % 17 / 4
+        state['timestamp_utc'] = db_driver.timestamp(start + timedelta(minutes=5 * index))
+        history.append(state)
+    return history
+
+@benchmark
+def batch_enchant():
+    import batch_enchanter
+    import db_driver
+    import enchanter
+
+    history = month_history()
+    with TemporaryDirectory() as working_directory:
+        things(working_directory, 1)
+        one_by_one = enchanter.Enchanter(working_directory, watch=False)
+
+        def enchant_one_by_one():
+            old = {}
+            for reported in history:
+                # enchant adds the formula senses to the reported state it is given
+                old = one_by_one.enchant('thing-0', reported=db_driver.copy_json(reported), config=ENCHANTER_CONFIG, alias=False, old_enchanted=old)
+
+        compare("month of reports enchanted",
+                enchant_one_by_one,
+                lambda: batch_enchanter.enchant_arrays(history, ENCHANTER_CONFIG),
+                number=1)
+        one_by_one.stop()
+
+@benchmark
+def window_formulas():
+    import enchanter
+    from datetime import datetime, timedelta
+
+    start = datetime(2018, 3, 1)
+    for formula in ("window_mean", "window_max", "ema"):
+        for minutes in (5, 6 * 60, 7 * 24 * 60):
+            calculate = enchanter.Formula({"name": "windowed", "formula": formula, "from": "OW-1", "minutes": minutes}).calculate
+            # a full window of falling values, the most state a window_max keeps
+            old = None
+            for index in range(2000):
+                old = calculate([1000 - index], old, False, start + timedelta(minutes=index * minutes / 1000))
+            now = start + timedelta(minutes=2 * minutes)
+            measure("%s of %d minutes" % (formula, minutes), lambda: calculate([20], old, False, now), number=2000)
+
+@benchmark
+def get_answer():
+    import logging
+    import mqtt_operator
+
+    update = json.dumps({"state": {"reported": REPORTED['state']}})
+    with TemporaryDirectory() as working_directory:
+        db = things(working_directory, 1)
+        # deltas are only cached once the state files settle
+        time.sleep(1)
+        measure("logger.of", lambda: mqtt_operator.logger.of("get_answer"), number=100000)
+        for level in (logging.INFO, logging.WARNING):
+            # the levels of every logger on the path, as ZELENIK_LOG_LEVEL would set them
+            logging.getLogger().setLevel(level)
+            name = logging.getLevelName(level)
+            measure("get_answer get, %s" % name, lambda: mqtt_operator.get_answer(db, "things/thing-0/get", "{}"), number=2000)
+            measure("get_answer update, %s" % name, lambda: mqtt_operator.get_answer(db, "things/thing-0/update", update), number=200)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro benchmarks of the hot paths')
+    parser.add_argument('names', nargs='*', choices=[[]] + sorted(BENCHMARKS), help='benchmarks to run, all by default')
+    args = parser.parse_args()
+
+    for name in args.names or sorted(BENCHMARKS):
+        print("# %s" % name)
+        BENCHMARKS[name]()
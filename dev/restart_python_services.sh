@@ -2,6 +2,7 @@ sudo systemctl restart uwsgi
 sudo systemctl restart rest_uwsgi
 sudo systemctl restart mqtt_operator
 sudo systemctl restart enchanter
+sudo systemctl restart archiver
 sudo systemctl restart uptime_monitor
 sudo systemctl restart error_reporter
 sudo systemctl restart server_operator
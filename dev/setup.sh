@@ -4,9 +4,12 @@ sudo cp /www/zelenik/conf/error_reporter.service /lib/systemd/system/ && \
 sudo cp /www/zelenik/conf/zelenik_nginx.service /lib/systemd/system/ && \
 sudo cp /www/zelenik/conf/uwsgi.service /lib/systemd/system/ && \
 sudo cp /www/zelenik/conf/enchanter.service /lib/systemd/system/ && \
+sudo cp /www/zelenik/conf/archiver.service /lib/systemd/system/ && \
 sudo cp /www/zelenik/conf/uptime_monitor.service /lib/systemd/system/ && \
 sudo cp /www/zelenik/conf/server_operator.service /lib/systemd/system/ && \
 sudo cp /www/zelenik/conf/rest_uwsgi.service /lib/systemd/system/ && \
+sudo mkdir -p /var/cache/nginx/graphs && \
+sudo chown otselo /var/cache/nginx/graphs && \
 sudo systemctl daemon-reload && \
 sudo systemctl enable mosquitto && \
 sudo systemctl enable mqtt_operator && \
@@ -15,6 +18,7 @@ sudo systemctl enable zelenik_nginx && \
 sudo systemctl enable uwsgi && \
 sudo systemctl enable rest_uwsgi && \
 sudo systemctl enable enchanter && \
+sudo systemctl enable archiver && \
 sudo systemctl enable uptime_monitor && \
 sudo systemctl enable server_operator && \
 sudo systemctl restart mosquitto && \
@@ -24,6 +28,7 @@ sudo systemctl restart zelenik_nginx && \
 sudo systemctl restart uwsgi && \
 sudo systemctl restart rest_uwsgi && \
 sudo systemctl restart enchanter && \
+sudo systemctl restart archiver && \
 sudo systemctl restart uptime_monitor && \
 sudo systemctl restart server_operator 
 
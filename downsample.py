@@ -0,0 +1,112 @@
+import numpy as np
+
+import series
+
+from logger import Logger
+logger = Logger("downsample")
+
+# Reducers take times and values as float arrays sorted by time and return the sorted indices of the
+# points to keep. Wrong values are nan and are not drawn, so they are only kept when nothing else is.
+
+def to_seconds(times):
+    return times.astype('datetime64[us]').astype(np.int64) / 1e6
+
+def parse_times(history):
+    return np.array([state['timestamp_utc'] for state in history], dtype='datetime64[us]')
+
+# Largest-Triangle-Three-Buckets: keeps the first and last point and from each of points - 2 equal
+# buckets the point making the largest triangle with the point kept before and the average of the
+# next bucket. Keeps the shape of the line, spikes included, with few points. Each bucket depends on
+# the one before, so only the work within a bucket is vectorized.
+def lttb(times, values, points):
+    count = len(times)
+    if points >= count or points < 3:
+        return np.arange(count)
+
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) == 0:
+        return np.array([0, count - 1])
+    if len(valid) < count:
+        return valid[lttb(times[valid], values[valid], points)]
+
+    edges = np.floor(np.linspace(1, count - 1, points - 1)).astype(np.int64)
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    a = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket == points - 3:
+            next_time, next_value = times[-1], values[-1]
+        else:
+            next_end = edges[bucket + 2]
+            next_time = times[end:next_end].mean()
+            next_value = values[end:next_end].mean()
+
+        areas = np.abs((times[a] - next_time) * (values[start:end] - values[a]) - (times[a] - times[start:end]) * (next_value - values[a]))
+        a = start + int(np.argmax(areas))
+        selected[bucket + 1] = a
+
+    return selected
+
+# Keeps the lowest and the highest value of each of buckets equal time spans, a bucket being a pixel
+# column or two, so nothing that would be drawn is lost. The first and the last point are kept too.
+def min_max(times, values, buckets):
+    count = len(times)
+    if count <= 2 * buckets or buckets < 1:
+        return np.arange(count)
+
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    span = times[-1] - times[0]
+    if span > 0:
+        bucket_ids = np.minimum(((times - times[0]) / span * buckets).astype(np.int64), buckets - 1)
+    else:
+        bucket_ids = np.arange(count) * buckets // count
+
+    wrong = np.isnan(values)
+    # lexsort is stable, so of equal values the earliest is kept
+    by_lowest = np.lexsort((np.where(wrong, np.inf, values), bucket_ids))
+    by_highest = np.lexsort((np.where(wrong, np.inf, -values), bucket_ids))
+    sorted_ids = bucket_ids[by_lowest]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+
+    return np.unique(np.concatenate([by_lowest[starts], by_highest[starts], [0, count - 1]]))
+
+def history_values(history):
+    values = {}
+    for index, state in enumerate(history):
+        state = state.get('state', {})
+        for kind in series.SERIES_KINDS:
+            kind_values = state.get(kind)
+            if not isinstance(kind_values, dict):
+                continue
+            for key, value in kind_values.items():
+                if not series.is_series_key(key):
+                    continue
+                column = values.get((kind, key))
+                if column is None:
+                    column = values[(kind, key)] = np.full(len(history), np.nan)
+                column[index] = series.numeric_value(value)
+
+    return values
+
+# Reduces each sense and write of the history on its own and keeps the states any of them needs,
+# so a spike in one sense is not lost to another. history is sorted by time.
+def downsample_history(history, points, reducer=lttb):
+    log = logger.of('downsample_history')
+    if len(history) <= points:
+        return history
+
+    times = to_seconds(parse_times(history))
+    keep = [np.array([0, len(history) - 1])]
+    for values in history_values(history).values():
+        keep.append(reducer(times, values, points))
+
+    indices = np.unique(np.concatenate(keep))
+    log.info('Downsampling reduced data from %d to %d' % (len(history), len(indices)))
+
+    return [history[index] for index in indices]
@@ -4,7 +4,7 @@ import matplotlib._color_data as mcd
 
 from logger import Logger
 import db_driver
-from db_driver import pretty_json, SHOULD_ENCHANT_FLAG, flat_map, is_displayable
+from db_driver import SHOULD_ENCHANT_FLAG, flat_map, is_displayable
 
 from numbers import Number
 
@@ -12,8 +12,13 @@ from state_processor import parse_isoformat
 
 import re
 import json
+import math
+import os
+
+import inotify
 
 import threading 
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from pathlib import Path
 
@@ -24,6 +29,15 @@ logger = Logger("enchanter")
 DIR = '/www/zelenik/'
 ANALOG_SENSES = {'I2C-8', 'I2C-9', 'I2C-10'}
 
+# how often a watching enchanter checks that it should keep running, it is woken by changes
+WATCH_TIMEOUT = 1 # seconds
+WATCH_THING_MASK = inotify.IN_CREATE | inotify.IN_ATTRIB | inotify.IN_MOVED_TO
+WATCH_DB_MASK = inotify.IN_CREATE | inotify.IN_MOVED_TO
+NOT_THINGS = ('na', 'stado')
+
+# things waiting to be enchanted by the pool, a sweep finding more waits for room
+MAX_PENDING = 256
+
 NEW_DISPLAYABLE = {"alias":"", "color": "green", "position":"0,0","type":"number","plot":"yes","graph":"yes"}
 
 def parse_time(s):
@@ -96,48 +110,483 @@ def should_reset(formula_config, old_time, now):
     reset_at_string = formula_config.get('reset_at')
 
     if reset_at_string is None:
-        reset_at = None
-    else:
-        reset_at = today_at(parse_time(reset_at_string), now=now)
+        return False
+
+    return should_reset_at(parse_time(reset_at_string), old_time, now)
 
-    return reset_at \
-        and old_time <= reset_at \
+def should_reset_at(reset_at_time, old_time, now):
+    reset_at = today_at(reset_at_time, now=now)
+
+    return old_time <= reset_at \
         and (reset_at < now \
             or reset_at - timedelta(days=1) > old_time)
 
+# A time window is kept as WINDOW_BUCKETS buckets, so its state stays the same size however often a
+# thing reports. Values leave the window a bucket at a time, a bucket being 1/WINDOW_BUCKETS of it.
+WINDOW_BUCKETS = 60
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_seconds(now):
+    return (now - EPOCH).total_seconds()
+
+# The buckets of old still in the window ending with bucket, none when old is not of this kind of
+# window or is ahead of it, as after the window was changed
+def window_buckets(old, key, bucket):
+    buckets = old.get(key) if isinstance(old, dict) else None
+    if not isinstance(buckets, list) or (buckets and buckets[-1][0] > bucket):
+        return []
+
+    first = 0
+    while first < len(buckets) and buckets[first][0] <= bucket - WINDOW_BUCKETS:
+        first += 1
+    return buckets[first:]
+
+# sums are [bucket, sum, count] of the buckets with values. new None only moves the window.
+def window_mean(new, old, bucket):
+    buckets = window_buckets(old, 'sums', bucket)
+    total = sum(b[1] for b in buckets)
+    count = sum(b[2] for b in buckets)
+    if new is not None:
+        if buckets and buckets[-1][0] == bucket:
+            last = buckets[-1]
+            buckets = buckets[:-1] + [[bucket, last[1] + new, last[2] + 1]]
+        else:
+            buckets = buckets + [[bucket, new, 1]]
+        total += new
+        count += 1
+
+    if count == 0:
+        return None
+    return {'value': total / count, 'count': count, 'sums': buckets}
+
+# extremes are [bucket, value] kept monotonic, each better than the ones after it: a value a newer
+# one is at least as good as can not be the extreme of the window again. The first is the extreme.
+def window_extreme(new, old, bucket, better):
+    buckets = window_buckets(old, 'extremes', bucket)
+    if new is not None:
+        buckets = list(buckets)
+        while buckets and not better(buckets[-1][1], new):
+            buckets.pop()
+        # a better value in the same bucket leaves the window with the new one
+        if not buckets or buckets[-1][0] != bucket:
+            buckets.append([bucket, new])
+
+    if not buckets:
+        return None
+    return {'value': buckets[0][1], 'extremes': buckets}
+
+# Exponential moving average of values at uneven times: a value weighs 1 - e^(-t/period), t being
+# the time since the previous one, so a report after a long sleep is not drowned by the old average
+def ema(new, old, seconds, period):
+    if not isinstance(old, dict) or not is_number(old.get('time')) or old['time'] > seconds:
+        return {'value': new, 'time': seconds}
+
+    weight = 1 - math.exp(-(seconds - old['time']) / period)
+    return {'value': old['value'] + weight * (new - old['value']), 'time': seconds}
+
+class FormulaError(Exception):
+    pass
+
+# formula - the parameters it needs besides name and from
+FORMULA_PARAMETERS = {
+    'scale': ('from_low', 'from_high', 'to_low', 'to_high'),
+    'decorrelate': ('correlated', 'adjustment', 'scale'),
+    'average': (),
+    'cum_average': (),
+    'sum': (),
+    'window_mean': ('minutes',),
+    'window_min': ('minutes',),
+    'window_max': ('minutes',),
+    'ema': ('minutes',),
+}
+SINGLE_FROM = ('scale', 'decorrelate', 'cum_average', 'sum', 'window_mean', 'window_min', 'window_max', 'ema')
+ACCUMULATING = ('cum_average', 'sum')
+# keep their state in the enchanted sense and read it with each report
+WINDOWED = ('window_mean', 'window_min', 'window_max', 'ema')
+
+def is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+# One formula of a config, checked and bound to its parameters when the config is compiled
+class Formula:
+    def __init__(self, config):
+        if not isinstance(config, dict):
+            raise FormulaError('Expected formula to be an object, got %s' % config)
+        self.config = config
+        self.name = config.get('name')
+        if not isinstance(self.name, str) or not self.name:
+            raise FormulaError('Formula without a name: %s' % config)
+
+        self.formula = config.get('formula')
+        if self.formula not in FORMULA_PARAMETERS:
+            raise FormulaError('Do not know how to apply formula %s of %s' % (self.formula, self.name))
+
+        from_keys = config.get('from')
+        if not isinstance(from_keys, list):
+            from_keys = [from_keys]
+        if not from_keys or not all(isinstance(k, str) and k for k in from_keys):
+            raise FormulaError('Formula %s needs from to be a sense or a list of senses, got %s' % (self.name, config.get('from')))
+        if self.formula in SINGLE_FROM and len(from_keys) != 1:
+            raise FormulaError('Formula %s of %s takes a single from sense, got %s' % (self.formula, self.name, from_keys))
+
+        missing = [p for p in FORMULA_PARAMETERS[self.formula] if p not in config]
+        if missing:
+            raise FormulaError('Formula %s of %s is missing %s' % (self.formula, self.name, ', '.join(missing)))
+
+        self.inputs = from_keys
+        self.accumulating = self.formula in ACCUMULATING
+        self.windowed = self.formula in WINDOWED
+        self.calculate = getattr(self, 'bind_' + self.formula)(config)
+
+        reset_at = config.get('reset_at')
+        try:
+            self.reset_at = None if reset_at is None else parse_time(reset_at)
+        except (TypeError, ValueError):
+            raise FormulaError('Formula %s has reset_at %s, expected HH:MM' % (self.name, reset_at))
+
+        # set after the formula calculated once, until then its previous result may be of another config
+        self.evaluated = False
+
+    def numbers(self, config, *keys):
+        values = [config[key] for key in keys]
+        for key, value in zip(keys, values):
+            if not is_number(value):
+                raise FormulaError('Formula %s of %s needs %s to be a number, got %s' % (self.formula, self.name, key, value))
+        return values
+
+    def bind_scale(self, config):
+        from_low, from_high, to_low, to_high = self.numbers(config, 'from_low', 'from_high', 'to_low', 'to_high')
+        if from_low == from_high:
+            raise FormulaError('Formula scale of %s can not scale from an empty range' % self.name)
+        return lambda values, old, reset, now: scale(values[0], from_low, from_high, to_low, to_high)
+
+    def bind_decorrelate(self, config):
+        adjustment, correlation_scale = self.numbers(config, 'adjustment', 'scale')
+        correlated = config['correlated']
+        if not isinstance(correlated, str) or not correlated:
+            raise FormulaError('Formula decorrelate of %s needs correlated to be a sense, got %s' % (self.name, correlated))
+        self.inputs = self.inputs + [correlated]
+        return lambda values, old, reset, now: decorrelate(values[0], values[1], adjustment, correlation_scale)
+
+    def bind_average(self, config):
+        return lambda values, old, reset, now: average(values)
+
+    def bind_cum_average(self, config):
+        window = config.get('window')
+        if window is not None and (not isinstance(window, int) or isinstance(window, bool) or window < 1):
+            raise FormulaError('Formula cum_average of %s needs window to be a positive whole number, got %s' % (self.name, window))
+
+        def calculate(values, old, reset, now):
+            old_value, old_count = accumulated(old, reset)
+            value, count = cum_average(values[0], old_value, old_count, window)
+            return {'value': value, 'count': count}
+        return calculate
+
+    def bind_sum(self, config):
+        def calculate(values, old, reset, now):
+            old_value, old_count = accumulated(old, reset)
+            value, count = sum_formula(values[0], old_value, old_count)
+            return {'value': value, 'count': count}
+        return calculate
+
+    def window_minutes(self, config):
+        minutes, = self.numbers(config, 'minutes')
+        if minutes <= 0:
+            raise FormulaError('Formula %s of %s needs minutes to be positive, got %s' % (self.formula, self.name, minutes))
+        return minutes
+
+    def bind_window(self, config, window):
+        bucket_seconds = self.window_minutes(config) * 60 / WINDOW_BUCKETS
+        bucket = lambda now: int(epoch_seconds(now) // bucket_seconds)
+        self.advance = lambda old, now: window(None, old, bucket(now))
+        return lambda values, old, reset, now: window(values[0], old, bucket(now))
+
+    def bind_window_mean(self, config):
+        return self.bind_window(config, window_mean)
+
+    def bind_window_min(self, config):
+        return self.bind_window(config, lambda new, old, bucket: window_extreme(new, old, bucket, lambda a, b: a < b))
+
+    def bind_window_max(self, config):
+        return self.bind_window(config, lambda new, old, bucket: window_extreme(new, old, bucket, lambda a, b: a > b))
+
+    def bind_ema(self, config):
+        period = self.window_minutes(config) * 60
+        # the average stays as it was until the next value
+        self.advance = lambda old, now: old if isinstance(old, dict) and 'time' in old else None
+        return lambda values, old, reset, now: ema(values[0], old, epoch_seconds(now), period)
+
+    def should_reset(self, old_time, now):
+        return self.reset_at is not None and should_reset_at(self.reset_at, old_time, now)
+
+def accumulated(old, reset):
+    if old is None or reset or not isinstance(old, dict):
+        return 0, 0
+    return old.get('value', 0), old.get('count', 0)
+
+# The formulas of a config ordered so each comes after the formulas it reads from, keeping the
+# config order otherwise. A formula reading its own name reads the reported sense it replaces.
+def compile_formulas(config):
+    if not config:
+        return []
+    if not isinstance(config, list):
+        raise FormulaError('Expected config to be a list of formulas, got %s' % config)
+
+    formulas = [Formula(formula_config) for formula_config in config]
+    by_name = {}
+    for formula in formulas:
+        if formula.name in by_name:
+            raise FormulaError('More than one formula is named %s' % formula.name)
+        by_name[formula.name] = formula
+
+    ordered = []
+    done = set()
+    def visit(formula, path):
+        if formula.name in done:
+            return
+        if formula.name in path:
+            cycle = path[path.index(formula.name):] + [formula.name]
+            raise FormulaError('Formulas depend on each other: %s' % ' -> '.join(cycle))
+        for key in formula.inputs:
+            dependency = by_name.get(key)
+            if dependency is not None and dependency is not formula:
+                visit(dependency, path + [formula.name])
+        done.add(formula.name)
+        ordered.append(formula)
+
+    for formula in formulas:
+        visit(formula, [])
+
+    return ordered
+
+# Enchants things on worker threads. A thing is enchanted by one worker at a time and is queued at
+# most once, as the queued run will find every flag set until it starts. Submitting blocks while
+# max_pending things are waiting.
+class EnchantPool:
+    def __init__(self, enchant_thing, workers, max_pending=MAX_PENDING):
+        self.enchant_thing = enchant_thing
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='enchant')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.queued = {} # thing - future
+        self.thing_locks = {}
+
+    def submit(self, thing):
+        with self.lock:
+            future = self.queued.get(thing)
+            if future is not None:
+                return future
+
+        self.pending.acquire()
+        with self.lock:
+            future = self.queued.get(thing)
+            if future is not None:
+                self.pending.release()
+                return future
+            thing_lock = self.thing_locks.setdefault(thing, threading.Lock())
+            future = self.executor.submit(self.run, thing, thing_lock)
+            self.queued[thing] = future
+            return future
+
+    def run(self, thing, thing_lock):
+        try:
+            with self.lock:
+                self.queued.pop(thing, None)
+            with thing_lock:
+                self.enchant_thing(thing)
+        finally:
+            self.pending.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
 class Enchanter:
-    def __init__(self, working_directory = DIR):
+    def __init__(self, working_directory = DIR, db = None, watch = None, workers = None):
         self.working_directory = working_directory
-        self.db = db_driver.DatabaseDriver(working_directory)
+        if db is None:
+            db = db_driver.DatabaseDriver(working_directory)
+        self.db = db
 
         self.db_path = Path(self.working_directory) / 'db'
+        # watch for should-enchant flags where inotify is available, ZELENIK_ENCHANTER_POLL=1 polls instead
+        if watch is None:
+            watch = os.environ.get('ZELENIK_ENCHANTER_POLL', '0') == '0'
+        self.watch = watch
+
+        # things are enchanted one after another unless ZELENIK_ENCHANTER_WORKERS is more than 1
+        if workers is None:
+            workers = int(os.environ.get('ZELENIK_ENCHANTER_WORKERS', '1'))
+        self.pool = EnchantPool(self.enchant_thing_logged, workers) if workers > 1 else None
+        self.running = False
+        self.thread = None
+
+        # thing - (enchanter.json signature, compiled formulas)
+        self.compiled = {}
+        # thing - senses of its latest enchanted state, read by formulas of other things
+        self.snapshot = {}
 
     def enchant_all(self):
         log = logger.of('enchant_all')
         if not self.running:
             return
         if not self.db_path.is_dir():
-            log.error('Database path %s is not a directory.' % self.db_path)
+            log.error('Database path %s is not a directory.', self.db_path)
             self.stop()
             return
 
-        things = self.db.get_thing_list()
-        for thing in things:
-            self.enchant_thing(thing)
+        self.enchant_flagged()
 
         if self.running:
             t = threading.Timer(1, self.enchant_all)
             t.start()
+            self.thread = t
+
+    def enchant_flagged(self):
+        things = self.db.get_thing_list()
+        flagged = [thing for thing in things if (self.db_path / thing / SHOULD_ENCHANT_FLAG).exists()]
+        self.enchant_things(flagged)
+
+    def enchant_things(self, things):
+        if self.pool is None:
+            for thing in self.dependency_order(things):
+                self.enchant_thing_logged(thing)
+            return
+
+        # things of a level only read things of the levels before, which are done by then
+        for level in self.dependency_levels(things):
+            wait([self.pool.submit(thing) for thing in level])
+
+    def enchant_thing_logged(self, thing):
+        try:
+            self.enchant_thing(thing)
+        except Exception:
+            logger.of('enchant_thing_logged').error('Could not enchant %s', thing, traceback=True)
+
+    def referenced_things(self, thing):
+        things = set()
+        for formula in self.load_formulas(thing):
+            for key in formula.inputs:
+                if ':' in key:
+                    referenced = self.db.resolve_thing(key.split(':')[0])
+                    if referenced is not None and referenced != thing:
+                        things.add(referenced)
+        return things
+
+    # Things whose formulas read senses of other things come after them, so they read this sweep's
+    # values. Things reading each other are left in name order.
+    def dependency_order(self, things):
+        things = sorted(things)
+        to_order = set(things)
+        ordered = []
+        done = set()
+        def visit(thing, path):
+            if thing in done or thing in path:
+                return
+            for referenced in sorted(self.referenced_things(thing) & to_order):
+                visit(referenced, path + [thing])
+            done.add(thing)
+            ordered.append(thing)
+
+        for thing in things:
+            visit(thing, [])
+
+        return ordered
+
+    def dependency_levels(self, things):
+        ordered = self.dependency_order(things)
+        levels = {}
+        for thing in ordered:
+            # a thing reading each other with another is not waited for
+            referenced = [levels[r] for r in self.referenced_things(thing) if r in levels]
+            levels[thing] = max(referenced) + 1 if referenced else 0
+
+        grouped = [[] for _ in range(max(levels.values()) + 1)] if levels else []
+        for thing in ordered:
+            grouped[levels[thing]].append(thing)
+        return grouped
+
+    # Woken only for the things whose should-enchant flag was created or touched, instead of
+    # looking at every thing each second
+    def watch_all(self, watcher):
+        log = logger.of('watch_all')
+        if not self.db_path.is_dir():
+            log.error('Database path %s is not a directory.', self.db_path)
+            watcher.close()
+            self.stop()
+            return
+
+        try:
+            self.watch_things(watcher)
+            # flags created before the things were watched
+            self.enchant_flagged()
+            while self.running:
+                self.enchant_changed(watcher, watcher.read(WATCH_TIMEOUT))
+        except Exception:
+            log.error('Watching failed, polling instead', traceback=True)
+            if self.running:
+                t = threading.Timer(1, self.enchant_all)
+                t.start()
+                self.thread = t
+        finally:
+            watcher.close()
+
+    def watch_things(self, watcher):
+        if not watcher.is_watched(self.db_path):
+            watcher.watch(self.db_path, WATCH_DB_MASK)
+        for thing in self.db.get_thing_list():
+            thing_path = self.db_path / thing
+            if not watcher.is_watched(thing_path):
+                watcher.watch(thing_path, WATCH_THING_MASK)
+
+    def enchant_changed(self, watcher, events):
+        log = logger.of('enchant_changed')
+        things = []
+        for event in events:
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                log.info('Missed changes, enchanting all flagged things')
+                self.watch_things(watcher)
+                things.extend(self.db.get_thing_list())
+            elif event.directory == self.db_path:
+                if event.mask & inotify.IN_ISDIR and event.name not in NOT_THINGS:
+                    try:
+                        watcher.watch(self.db_path / event.name, WATCH_THING_MASK)
+                    except OSError:
+                        log.error('Could not watch new thing %s', event.name, traceback=True)
+                    # the flag may have been created before the watch
+                    things.append(event.name)
+            elif event.directory is not None and event.name == SHOULD_ENCHANT_FLAG:
+                things.append(event.directory.name)
+
+        self.enchant_things(set(things))
 
     def start(self):
-        logger.of('start').info('Starting')
+        log = logger.of('start')
+        log.info('Starting')
         self.running = True
-        t = threading.Timer(1, self.enchant_all)
+        watcher = inotify.Watcher.create() if self.watch else None
+        if watcher is None:
+            log.info('Polling for things to enchant')
+            t = threading.Timer(1, self.enchant_all)
+        else:
+            log.info('Watching for things to enchant')
+            t = threading.Thread(target=self.watch_all, args=(watcher,))
         t.start()
+        self.thread = t
 
     def stop(self):
         logger.of('stop').info('Stopping')
         self.running = False
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    # waits for a stopped enchanter to finish, polling starts a new thread each time
+    def join(self):
+        thread = self.thread
+        while thread is not None:
+            thread.join()
+            if thread is self.thread:
+                return
+            thread = self.thread
 
     def create_default_config(self, thing, reported):
         config = []
@@ -203,17 +652,16 @@ class Enchanter:
         if not should_enchant.exists():
             return
 
-        log.info('Enchanting %s' % thing)
+        log.info('Enchanting %s', thing)
 
-        enchanted = self.enchant(thing)
+        # removed first, so a report arriving while enchanting sets it again
+        should_enchant.unlink()
 
-        enchanted_path = thing_path / 'enchanted.json'
-        with enchanted_path.open('w', encoding='utf-8') as f:
-            f.write(pretty_json(enchanted))
+        enchanted = self.enchant(thing)
 
-        should_enchant.unlink()
+        self.db._update_enchanted(thing, enchanted)
+        self.snapshot[thing] = db_driver.copy_json(enchanted.get('state', {}).get('senses', {}))
 
-    # Keep this fast as graph runs it on every reported state
     def enchant(self, thing, reported=None, config=None, displayables=None, alias=True, old_enchanted=None):
         log = logger.of('enchant')
 
@@ -221,11 +669,9 @@ class Enchanter:
             reported = self.db.load_state(thing, 'reported')
 
         if config is None:
-            config = self.db.load_state(thing, 'enchanter')
-            if not config:
-                log.info('Config is empty, making a default one')
-                self.create_default_config(thing, reported)
-                config = self.db.load_state(thing, 'enchanter')
+            formulas = self.load_formulas(thing, reported)
+        else:
+            formulas = self.compile(thing, config)
 
         if old_enchanted is None:
             old_enchanted = self.db.load_state(thing, 'enchanted')
@@ -242,7 +688,7 @@ class Enchanter:
         else:
             old_time = parse_isoformat(old_time_string)
 
-        for formula in config:
+        for formula in formulas:
             self.apply_formula(formula, senses, old_enchanted_senses, old_time, now)
 
         if alias:
@@ -260,26 +706,70 @@ class Enchanter:
 
         return enchanted
 
+    # Compiled once per version of enchanter.json. A just written file may change again within its
+    # mtime resolution, so it is compiled again until it settles.
+    # reported is needed to make a default config when there is none
+    def load_formulas(self, thing, reported=None):
+        log = logger.of('load_formulas')
+        signature = self.db._state_signature(thing, 'enchanter')
+        cached = self.compiled.get(thing)
+        if cached is not None and signature is not None and cached[0] == signature:
+            return cached[1]
+
+        config = self.db.load_state(thing, 'enchanter')
+        if not config and reported is None:
+            return []
+        if not config:
+            log.info('Config is empty, making a default one')
+            self.create_default_config(thing, reported)
+            config = self.db.load_state(thing, 'enchanter')
+            signature = self.db._state_signature(thing, 'enchanter')
+
+        formulas = self.compile(thing, config)
+        if signature is not None and db_driver.is_settled(signature[0]):
+            self.compiled[thing] = (signature, formulas)
+        return formulas
+
+    # A config with errors is reported once when compiled and the thing is enchanted without formulas
+    def compile(self, thing, config):
+        try:
+            return compile_formulas(config)
+        except FormulaError as e:
+            logger.of('compile').error('Not applying formulas of %s: %s', thing, e)
+            return []
+
+    # Senses of other things come from the snapshot, read from enchanted.json only the first time
+    def thing_senses(self, thing):
+        log = logger.of('thing_senses')
+        thing_senses = self.snapshot.get(thing)
+        if thing_senses is None:
+            log.info('Loading senses for %s', thing)
+            state = self.db.load_state(thing, 'enchanted')
+            thing_senses = state.get('state', {}).get('senses')
+            if thing_senses is None:
+                log.info('No senses found for %s', thing)
+                thing_senses = {}
+            self.snapshot[thing] = thing_senses
+
+        return db_driver.copy_json(thing_senses)
+
     # Modifying senses - using it as a cache
     def retrieve_sense_value(self, key, senses = {}):
         log = logger.of('retrieve_sense_value')
         
         if key not in senses:
             if ':' not in key:
-                log.info('Could not retrieve sense value because key %s missing in senses %s' % (key, senses))
+                log.info('Could not retrieve sense value because key %s missing in senses %s', key, senses)
                 return None
 
             split = key.split(':')
             a_thing = split[0]
             thing = self.db.resolve_thing(a_thing)
-            sense_key = split[1]
 
-            log.info('Loading senses for %s' % thing)
-            state = self.db.load_state(thing, 'enchanted')
-            thing_senses = state.get('state', {}).get('senses')
-            if thing_senses is None:
-                log.info('No senses found for %s, making an empty record to prevent loading again this turn' % thing)
+            if thing is None:
                 thing_senses = {}
+            else:
+                thing_senses = self.thing_senses(thing)
             senses.update(prefix_keys('%s:' % a_thing, thing_senses))
 
         return get_value(senses.get(key))
@@ -290,79 +780,34 @@ class Enchanter:
         decorrelate - correlation (may be from another thing, format is thing:sense_key, adjustment, scale
         average - from (a list)
         cum_average - from, start_time, end_time
+        window_mean, window_min, window_max, ema - from, minutes
     """
-    def apply_formula(self, formula_config, senses, old_enchanted_senses, old_time, now):
+    def apply_formula(self, formula, senses, old_enchanted_senses, old_time, now):
         log = logger.of('apply_formula')
-        key = formula_config['name']
-        from_keys = formula_config['from']
-        if not isinstance(from_keys, list):
-            from_keys = [from_keys]
-        from_sense_values = list(map(lambda k: self.retrieve_sense_value(k, senses = senses), from_keys))
-
-        if None in from_sense_values:
-            log.info('Not applying formula %s because at least one from value missing: %s' % (formula_config, from_sense_values))
+        values = [self.retrieve_sense_value(key, senses = senses) for key in formula.inputs]
+
+        old = old_enchanted_senses.get(formula.name)
+        if None in values:
+            log.info('Not applying formula %s because at least one from value missing: %s', formula.config, values)
+            if formula.windowed and old is not None:
+                # the window moves on without the value, so old values still leave it on time
+                advanced = formula.advance(old, now)
+                if advanced is not None:
+                    senses[formula.name] = advanced
             return 
 
-        formula = formula_config['formula']
-
-        if formula == 'scale':
-            from_value = get_only_element(from_sense_values)
-            from_low = formula_config['from_low']
-            from_high = formula_config['from_high']
-            to_low = formula_config['to_low']
-            to_high = formula_config['to_high']
-            senses[key] = scale(from_value, from_low, from_high, to_low, to_high)
-        elif formula == 'decorrelate':
-            from_value = get_only_element(from_sense_values)
-            correlated = formula_config['correlated']
-            correlated_sense = self.retrieve_sense_value(correlated, senses)
-                 
-            if correlated_sense is None:
-                log.info('Not decorrelating because of missing %s' % correlated)
-                return
-
-            correlated_value = get_value(correlated_sense)
-
-            adjustment = formula_config['adjustment']
-            correlation_scale = formula_config['scale']
-
-            senses[key] = decorrelate(from_value, correlated_value, adjustment, correlation_scale)
-
-        elif formula == 'average':
-            senses[key] = average(from_sense_values)
-
-        elif formula == 'cum_average':
-            window = formula_config.get('window')
+        if not (formula.accumulating or formula.windowed) and formula.evaluated and old is not None \
+                and values == [get_value(old_enchanted_senses.get(key)) for key in formula.inputs]:
+            # same inputs as the previous report, so the same result
+            senses[formula.name] = get_value(old)
+            return
 
-            old = old_enchanted_senses.get(key)
-            if old is None or should_reset(formula_config, old_time, now):
-                log.info("Starting new cumulative average at %s" % now )
-                old_value = 0
-                old_count = 0
-            else:
-                old_value = old.get('value', 0)
-                old_count = old.get('count', 0)
-             
-            from_value = get_only_element(from_sense_values)
-            value, count = (cum_average(from_value, old_value, old_count, window))
-            senses[key] = {'value': value, 'count': count}
-
-        elif formula == 'sum':
-            old = old_enchanted_senses.get(key)
-            if old is None or should_reset(formula_config, old_time, now):
-                log.info("Starting new sum at %s" % now )
-                old_value = 0
-                old_count = 0
-            else:
-                old_value = old.get('value', 0)
-                old_count = old.get('count', 0)
-             
-            from_value = get_only_element(from_sense_values)
-            value, count = (sum_formula(from_value, old_value, old_count))
-            senses[key] = {'value': value, 'count': count}
+        reset = formula.accumulating and formula.should_reset(old_time, now)
+        if formula.accumulating and (old is None or reset):
+            log.info("Starting new %s at %s", formula.formula, now)
 
-        else:
-            log.error('Do not know how to apply formula %s' % formula)
+        senses[formula.name] = formula.calculate(values, old, reset, now)
+        formula.evaluated = True
             
 if __name__ == '__main__':
     enchanter = Enchanter()
@@ -1,10 +1,8 @@
 from logger import Logger
 logger = Logger("graph")
 
-import matplotlib
-matplotlib.use('svg')
-
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.dates import date2num, AutoDateLocator, AutoDateFormatter, DateFormatter
 
 from db_driver import parse_isoformat, flat_map
@@ -15,11 +13,18 @@ import matplotlib.gridspec as gridspec
 
 from scipy import signal
 
-from enchanter import Enchanter
+import downsample
 
-from operator import itemgetter
+from contextlib import contextmanager
 
-from datetime import datetime, timedelta
+from pathlib import Path
+from io import BytesIO
+import fcntl
+import gc
+import os
+import tempfile
+import threading
+import time
 
 timezone = tz.gettz('Europe/Sofia')
 
@@ -27,6 +32,15 @@ DEFAULT_SINCE_DAYS = 1
 DEFAULT_MEDIAN_KERNEL = 3
 DEFAULT_WRONGS = False
 
+GRAPH_SIZE = (12, 6) # inches
+GRAPH_DPI = 100
+# the lowest and highest value of every two pixel columns, so the history keeps about one point per pixel
+GRAPH_BUCKETS = GRAPH_SIZE[0] * GRAPH_DPI // 2
+
+# (since_days up to, seconds) - how old a cached graph may get before it is rendered again.
+# Longer graphs change less per minute so they tolerate more staleness.
+GRAPH_MAX_STALENESS = ((1, 60), (7, 5*60), (31, 15*60), (366, 60*60))
+
 def get_write(state):
     if state.get('write'):
         return state['write']
@@ -93,58 +107,174 @@ def parse_formdata(formdata):
 
     return since_days, median_kernel, wrongs, graphable
 
-def fast_enchant(reported):
-    global thing, displayables, enchanter, enchanter_config, old_enchanted
-
-    old_enchanted = enchanter.enchant(thing, reported = reported, config = enchanter_config, displayables = displayables, alias=False, old_enchanted = old_enchanted)
-
-    return old_enchanted
-
-# assumes history is sorted in ascending order
-def subsample_history(history, conditions):
-    log = logger.of('subsample_history')
-    sorted_conditions = sorted(conditions, key=itemgetter(0))
-    subsampled = []
-    index = 0
-    for earlier_than, subsample_rate in sorted_conditions:
-        next_index = len(history[index:])
-        for increment_index, state in enumerate(history[index:]):
-            if parse_isoformat(state['timestamp_utc']) > earlier_than:
-                next_index = index + increment_index
-                break
-
-        subsampled.extend(history[index:next_index:subsample_rate])
-        index = next_index
-
-    if index < len(history):
-        subsampled.extend(history[index:])
-
-    log.info('Subsampling reduced data from %d to %d' % (len(history), len(subsampled)))
-
-    return subsampled
+def max_staleness(since_days, table=GRAPH_MAX_STALENESS):
+    for up_to_days, seconds in table:
+        if since_days <= up_to_days:
+            return seconds
+    return table[-1][1]
+
+def graph_location(db, thing, since_days, median_kernel, wrongs):
+    name = 'graph-%d-median-%d' % (since_days, median_kernel)
+    if wrongs:
+        name += '-w'
+
+    return str(db.directory / thing / (name + '.png'))
+
+# A cached graph is served from its file, so the path is returned rather than the image. lstat,
+# because the no data graph is cached as a symlink to view/no-data.png.
+def cached_graph(image_location, staleness, now=None):
+    if now is None:
+        now = time.time()
+    p = Path(image_location)
+    try:
+        if now - p.lstat().st_mtime > staleness:
+            return None
+    except FileNotFoundError:
+        return None
+    return p
+
+# per worker process, logged so coalescing across processes can be followed in the journal
+GRAPH_STATS = {'cached': 0, 'rendered': 0, 'coalesced': 0}
+graph_stats_lock = threading.Lock()
+
+def count(stat):
+    with graph_stats_lock:
+        GRAPH_STATS[stat] += 1
+        return dict(GRAPH_STATS)
+
+def temp_graph_location(image_location):
+    directory, name = os.path.split(image_location)
+    fd, temp_location = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+    return fd, temp_location
+
+def write_graph(image_location, image_bytes):
+    fd, temp_location = temp_graph_location(image_location)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(temp_location, image_location)
+    except BaseException:
+        os.unlink(temp_location)
+        raise
+
+def link_graph(image_location, target):
+    fd, temp_location = temp_graph_location(image_location)
+    os.close(fd)
+    os.unlink(temp_location)
+    os.symlink(str(Path(target).resolve()), temp_location)
+    os.replace(temp_location, image_location)
+
+# flock is held per open file, so it serializes both the uwsgi processes and their threads
+class GraphLock:
+    def __init__(self, image_location):
+        self.lock_location = image_location + '.lock'
+
+    def acquire(self):
+        self.f = open(self.lock_location, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+# The response does not wait for the cache file. The lock is held until it is written so requests
+# waiting for the render find it.
+def write_graph_in_background(lock, image_location, image_bytes):
+    def write():
+        try:
+            write_graph(image_location, image_bytes)
+        except Exception:
+            logger.of('write_graph_in_background').error('Could not cache %s' % image_location, traceback=True)
+        finally:
+            lock.release()
+
+    threading.Thread(target=write).start()
+
+# One worker renders a missing or stale graph while the others requesting it wait for the lock and
+# then serve what it rendered. Returns the path of a cached graph, or what render returned: the
+# image bytes, or the path of a static image.
+def single_flight(image_location, staleness, render):
+    log = logger.of('single_flight')
+    cached = cached_graph(image_location, staleness)
+    if cached is not None:
+        count('cached')
+        return cached
+
+    lock = GraphLock(image_location)
+    lock.acquire()
+    try:
+        cached = cached_graph(image_location, staleness)
+        if cached is not None:
+            log.info('Coalesced render of %s %s' % (image_location, count('coalesced')))
+            return cached
+
+        log.info('Rendering %s %s' % (image_location, count('rendered')))
+        image = render()
+        if isinstance(image, Path):
+            link_graph(image_location, image)
+            return image
+
+        write_graph_in_background(lock, image_location, image)
+        lock = None
+        return image
+    finally:
+        if lock is not None:
+            lock.release()
+
+# Each thread keeps one figure and clears it after a render instead of making a new one per request.
+# New figures are full of reference cycles, so without reuse every render leaves its artists and
+# pixel buffers to the garbage collector and memory grows between collections.
+figures = threading.local()
+
+@contextmanager
+def graph_figure():
+    figure = getattr(figures, 'figure', None)
+    if figure is None:
+        figure = Figure(figsize=GRAPH_SIZE, dpi=GRAPH_DPI)
+        FigureCanvasAgg(figure)
+        figures.figure = figure
+
+    try:
+        yield figure
+    finally:
+        figure.clear()
+        # the cleared artists are young, a collection of the younger generations frees them cheaply
+        gc.collect(1)
 
 def handle_graph(db, a_thing, since_days=DEFAULT_SINCE_DAYS, median_kernel=DEFAULT_MEDIAN_KERNEL, wrongs=DEFAULT_WRONGS, graphable=None, formdata=None):
-    global thing, displayables, enchanter, enchanter_config, old_enchanted
-
-    log = logger.of('handle_graph')
     if formdata:
         since_days, median_kernel, wrongs, graphable = parse_formdata(formdata)
     else:
         graphable = {}
 
+    # importantly here we should use the dealiased thing
     thing = db.resolve_thing(a_thing)
-    history = db.load_history(thing, 'reported', since_days=since_days)
 
-    ten_minutes_ago = datetime.utcnow() - timedelta(minutes=10) # so every 5 minutes
-    sparse_history = subsample_history(history, [(ten_minutes_ago, 10)])
-    
-    displayables = db.load_state(thing, 'displayables')
+    if formdata:
+        # graphs of chosen senses are not cached, each request renders its own
+        return 'image/png', render_graph(db, thing, since_days, median_kernel, wrongs, graphable)
+
+    image_location = graph_location(db, thing, since_days, median_kernel, wrongs)
+    render = lambda: render_graph(db, thing, since_days, median_kernel, wrongs, graphable)
+    return 'image/png', single_flight(image_location, max_staleness(since_days), render)
 
-    enchanter = Enchanter()
-    enchanter_config = db.load_state(thing, 'enchanter')
-    old_enchanted = {}
+# Returns the PNG bytes, or the path of view/no-data.png so it can be served from its file
+def render_graph(db, thing, since_days, median_kernel, wrongs, graphable):
+    # the enchanter keeps the history of derived senses, so they are read rather than recomputed
+    history = db.load_rollup_history(thing, 'enchanted', since_days=since_days, points=GRAPH_BUCKETS)
+    if history is None:
+        history = db.load_history(thing, 'enchanted', since_days=since_days)
 
-    enchanted_history = list(map(fast_enchant, sparse_history))
+    enchanted_history = downsample.downsample_history(history, GRAPH_BUCKETS, reducer=downsample.min_max)
+
+    displayables = db.load_state(thing, 'displayables')
 
     should_graph = flat_map(displayables, "graph")
     displayable_color = flat_map(displayables, "color")
@@ -156,193 +286,174 @@ def handle_graph(db, a_thing, since_days=DEFAULT_SINCE_DAYS, median_kernel=DEFAU
     senses = list(map(lambda s: get_senses(s['state']), enchanted_history))
     writes = list(map(lambda s: get_write(s['state']), enchanted_history))
 
-    f = plt.figure(figsize=(12, 6), dpi=100)
-
-    gs = gridspec.GridSpec(2, 1, height_ratios=[7,1])
+    with graph_figure() as figure:
+        gs = gridspec.GridSpec(2, 1, figure=figure, height_ratios=[7,1])
 
-    sense_plot = plt.subplot(gs[0])
-    writes_plot = plt.subplot(gs[1], sharex=sense_plot)
+        sense_plot = figure.add_subplot(gs[0])
+        writes_plot = figure.add_subplot(gs[1], sharex=sense_plot)
 
-    writes_plot.axes.xaxis.set_visible(False)
+        writes_plot.axes.xaxis.set_visible(False)
     
-    locator = AutoDateLocator(tz=timezone)
-    sense_plot.axes.xaxis.set_major_locator(locator)
-    sense_plot.axes.xaxis.set_major_formatter(AutoDateFormatter(locator, tz=timezone))
-    writes_plot.axes.yaxis.tick_right()
-
-    numbers, percents = graph_types(displayable_type, should_graph)
-
-    if numbers and percents: 
-        sense_twin_plot = sense_plot.twinx()
-        sense_twin_plot.axes.yaxis.tick_left()
-        sense_plot.axes.yaxis.tick_right()
-        sense_plot.set_ylabel('°C')
-        sense_plot.axes.yaxis.set_label_position('right')
-        sense_twin_plot.set_ylabel('%')
-        sense_twin_plot.axes.yaxis.set_label_position('left')
-    elif numbers:
-        sense_twin_plot = None
-        sense_plot.set_ylabel('°C')
-        sense_plot.axes.yaxis.set_label_position('right')
-    elif percents:
-        sense_twin_plot = None
-        sense_plot.set_ylabel('%')
-        sense_plot.axes.yaxis.tick_left()
-        sense_plot.axes.yaxis.set_label_position('left')
-
-    if len(senses) > 0:
-        if graphable:
-            sense_types = graphable.keys() 
+        locator = AutoDateLocator(tz=timezone)
+        sense_plot.axes.xaxis.set_major_locator(locator)
+        sense_plot.axes.xaxis.set_major_formatter(AutoDateFormatter(locator, tz=timezone))
+        writes_plot.axes.yaxis.tick_right()
+
+        numbers, percents = graph_types(displayable_type, should_graph)
+
+        if numbers and percents: 
+            sense_twin_plot = sense_plot.twinx()
+            sense_twin_plot.axes.yaxis.tick_left()
+            sense_plot.axes.yaxis.tick_right()
+            sense_plot.set_ylabel('°C')
+            sense_plot.axes.yaxis.set_label_position('right')
+            sense_twin_plot.set_ylabel('%')
+            sense_twin_plot.axes.yaxis.set_label_position('left')
+        elif numbers:
+            sense_twin_plot = None
+            sense_plot.set_ylabel('°C')
+            sense_plot.axes.yaxis.set_label_position('right')
+        elif percents:
+            sense_twin_plot = None
+            sense_plot.set_ylabel('%')
+            sense_plot.axes.yaxis.tick_left()
+            sense_plot.axes.yaxis.set_label_position('left')
+
+        if len(senses) > 0:
+            if graphable:
+                sense_types = graphable.keys() 
+            else:
+                sense_types = set()
+                for sense_state in senses:
+                    sense_types = sense_types.union(sense_state.keys())
+
+                sense_types = sorted(sense_types) 
+                sense_types = list(filter(lambda s: should_graph.get(s, "no") == "yes", sense_types))
+                if 'time' in sense_types:
+                    sense_types.remove('time')
         else:
-            sense_types = set()
-            for sense_state in senses:
-                sense_types = sense_types.union(sense_state.keys())
-
-            sense_types = sorted(sense_types) 
-            sense_types = list(filter(lambda s: should_graph.get(s, "no") == "yes", sense_types))
-            if 'time' in sense_types:
-                sense_types.remove('time')
-    else:
-        sense_types = []
-
-    if len(sense_types) == 0:
-        content_type = 'image/png'
-        with open('view/no-data.png', 'rb') as f:
-            bytes = f.read()
-        return content_type, bytes
-
-    for sense_type in sense_types:
-        values = []
-        times = []
-        wrong_times = []
-        wrong_values = []
-        subtypes = graphable.get(sense_type, ['valueOrNormalized'])
-        for subtype in subtypes:
-            for sense_state, time in zip(senses, plot_times):
-                if sense_state.get(sense_type) is not None:
-                    previous_value = 0
-                    if len(values) > 0:
-                        previous_value = values[-1]
-
-                    value = sense_state[sense_type]
+            sense_types = []
+
+        if len(sense_types) == 0:
+            return db.view / 'no-data.png'
+
+        for sense_type in sense_types:
+            values = []
+            times = []
+            wrong_times = []
+            wrong_values = []
+            subtypes = graphable.get(sense_type, ['valueOrNormalized'])
+            for subtype in subtypes:
+                for sense_state, time in zip(senses, plot_times):
+                    if sense_state.get(sense_type) is not None:
+                        previous_value = 0
+                        if len(values) > 0:
+                            previous_value = values[-1]
+
+                        value = sense_state[sense_type]
+                        if type(value) is dict:
+                            if subtype == 'valueOrNormalized':
+                                # check if 'normalized' exists, use it instead of value
+                                sense = value.get("normalized", None)
+                                if not sense:
+                                    sense = value.get("value", None)
+                            else:
+                                sense = value.get(subtype)
+
+                            wrong, float_value = parse_sense(sense)
+                            if not wrong:
+                                values.append(float_value)
+                                times.append(time)
+                            else:
+                                wrong_times.append(time)
+                                wrong_values.append(previous_value)
+                        elif subtype in ["value", "valueOrNormalized"]:
+                            wrong, float_value = parse_sense(value)
+                            if not wrong:
+                                values.append(float_value)
+                                times.append(time)
+                            else:
+                                wrong_times.append(time)
+                                wrong_values.append(previous_value)
+
+            label = displayable_alias.get(sense_type)
+            if not label:
+                label = sense_type
+
+            color = displayable_color.get(sense_type, 'black')
+
+            if sense_twin_plot and displayable_type.get(sense_type, 'number') == 'percent':
+                p = sense_twin_plot
+            else:
+                p = sense_plot
+
+            filtered_values = signal.medfilt(values, median_kernel)
+            p.plot(times, filtered_values, label=label, color=color)
+            if wrongs:
+                p.plot(wrong_times, wrong_values, 'rx')
+
+        if len(writes) > 0:
+            writes_types = sorted(writes[-1].keys()) 
+        else:
+            writes_types = []
+
+        writes_start = 0 
+        writes_offset = -2
+        labels = []
+        yticks = []
+        for writes_index, writes_type in enumerate(writes_types):
+            values = []
+            intervals = []
+            interval = None
+            times = []
+        
+            for writes_state, time in zip(writes, plot_times):
+                if writes_state.get(writes_type) is not None:
+                    value = writes_state[writes_type]
                     if type(value) is dict:
-                        if subtype == 'valueOrNormalized':
-                            # check if 'normalized' exists, use it instead of value
-                            sense = value.get("normalized", None)
-                            if not sense:
-                                sense = value.get("value", None)
-                        else:
-                            sense = value.get(subtype)
+                        converted = float(value['value'])
+                    else:
+                        converted = int(value)
 
-                        wrong, float_value = parse_sense(sense)
-                        if not wrong:
-                            values.append(float_value)
-                            times.append(time)
+                    if converted == 1:
+                        if not interval:
+                            interval = (time, 0.0001) # about 1 minute
                         else:
-                            wrong_times.append(time)
-                            wrong_values.append(previous_value)
-                    elif subtype in ["value", "valueOrNormalized"]:
-                        wrong, float_value = parse_sense(value)
-                        if not wrong:
-                            values.append(float_value)
-                            times.append(time)
-                        else:
-                            wrong_times.append(time)
-                            wrong_values.append(previous_value)
-
-        label = displayable_alias.get(sense_type)
-        if not label:
-            label = sense_type
-
-        color = displayable_color.get(sense_type, 'black')
-
-        if sense_twin_plot and displayable_type.get(sense_type, 'number') == 'percent':
-            p = sense_twin_plot
-        else:
-            p = sense_plot
-
-        filtered_values = signal.medfilt(values, median_kernel)
-        p.plot(times, filtered_values, label=label, color=color)
-        if wrongs:
-            p.plot(wrong_times, wrong_values, 'rx')
-
-    if len(writes) > 0:
-        writes_types = sorted(writes[-1].keys()) 
-    else:
-        writes_types = []
-
-    writes_start = 0 
-    writes_offset = -2
-    labels = []
-    yticks = []
-    for writes_index, writes_type in enumerate(writes_types):
-        values = []
-        intervals = []
-        interval = None
-        times = []
-        
-        for writes_state, time in zip(writes, plot_times):
-            if writes_state.get(writes_type) is not None:
-                value = writes_state[writes_type]
-                if type(value) is dict:
-                    converted = float(value['value'])
-                else:
-                    converted = int(value)
-
-                if converted == 1:
-                    if not interval:
-                        interval = (time, 0.0001) # about 1 minute
+                            interval = (interval[0], time-interval[0])
                     else:
-                        interval = (interval[0], time-interval[0])
-                else:
-                    if interval:
-                        interval = (interval[0], time-interval[0])
-                        intervals.append(interval)
-                        interval = None
+                        if interval:
+                            interval = (interval[0], time-interval[0])
+                            intervals.append(interval)
+                            interval = None
 
-        if interval:
-            intervals.append(interval)
+            if interval:
+                intervals.append(interval)
 
-        label = displayable_alias.get(writes_type)
-        if not label:
-            label = writes_type
+            label = displayable_alias.get(writes_type)
+            if not label:
+                label = writes_type
 
-        y = writes_start + writes_index*writes_offset
+            y = writes_start + writes_index*writes_offset
 
-        writes_plot.broken_barh(intervals, (y+0.5, writes_offset+0.5)) # -0.5 to center on named y axis
+            writes_plot.broken_barh(intervals, (y+0.5, writes_offset+0.5)) # -0.5 to center on named y axis
 
-        labels.append(label)
-        yticks.append(y)
+            labels.append(label)
+            yticks.append(y)
 
-    writes_plot.set_yticks(yticks)
-    writes_plot.set_yticklabels(labels)
+        writes_plot.set_yticks(yticks)
+        writes_plot.set_yticklabels(labels)
         
-    sense_plot.axes.autoscale()
-    sense_plot.grid(True)
-
-    # importantly here we should use the dealiased thing
-    if formdata:
-        image_location = "db/%s/temp.png" % thing
-
-    else:
-        image_location = 'db/%s/graph-%d-median-%d' % (thing, since_days, median_kernel)
-        if wrongs:
-            image_location += '-w'
+        sense_plot.axes.autoscale()
+        sense_plot.grid(True)
 
-        image_location += '.png'
-
-    # legend to top of plot, based on example from http://matplotlib.org/users/legend_guide.html
-    if sense_twin_plot:
-        sense_twin_plot.legend(bbox_to_anchor=(0., 1.02, 0.5, .102), loc=3, ncol=2, mode="expand", borderaxespad=0.)
-        sense_plot.legend(bbox_to_anchor=(0.5, 1.02, 0.5, .102), loc=3, ncol=2, mode="expand", borderaxespad=0.)
-    else:
-        sense_plot.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3, ncol=3, mode="expand", borderaxespad=0.)
-
-    plt.savefig(image_location, dpi=100, bbox_inches='tight')
-
-    with open(image_location, 'rb') as f:
-        image_bytes = f.read()
+        # legend to top of plot, based on example from http://matplotlib.org/users/legend_guide.html
+        if sense_twin_plot:
+            sense_twin_plot.legend(bbox_to_anchor=(0., 1.02, 0.5, .102), loc=3, ncol=2, mode="expand", borderaxespad=0.)
+            sense_plot.legend(bbox_to_anchor=(0.5, 1.02, 0.5, .102), loc=3, ncol=2, mode="expand", borderaxespad=0.)
+        else:
+            sense_plot.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3, ncol=3, mode="expand", borderaxespad=0.)
 
-    content_type = 'image/png'
-    return content_type, image_bytes
+        image = BytesIO()
+        figure.savefig(image, format='png', dpi=GRAPH_DPI, bbox_inches='tight')
+        return image.getvalue()
 
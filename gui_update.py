@@ -1,4 +1,5 @@
 import json
+import enchanter
 from logger import Logger
 logger = Logger("gui_update")
 
@@ -41,6 +42,13 @@ def update_db(db, a_thing, state, value, ret):
             log.error("Could not parse json value. %s %s %s" % (a_thing, state, value))
             return 'Could not parse json value %s %s %s' % (state, a_thing, value)
 
+        if state == 'enchanter':
+            try:
+                enchanter.compile_formulas(value_dict)
+            except enchanter.FormulaError as e:
+                log.error("Not saving enchanter config with errors. %s %s" % (a_thing, e))
+                return 'Could not save enchanter config of %s: %s' % (a_thing, e)
+
         if thing == None:
             log.warning('First time heard of thing %s\nAssuming it is a new thing' % a_thing)
             thing = a_thing
@@ -0,0 +1,107 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+from logger import Logger
+logger = Logger("inotify")
+
+# from linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+READ_BYTES = 64 * 1024
+
+class Event:
+    def __init__(self, directory, mask, name):
+        self.directory = directory
+        self.mask = mask
+        self.name = name
+
+    def __repr__(self):
+        return 'Event(%s, %#x, %s)' % (self.directory, self.mask, self.name)
+
+def load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # raises AttributeError where the C library has no inotify
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+# Linux change notification for a set of directories, without dependencies beyond the C library
+class Watcher:
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.directories = {}
+
+    # None where inotify is not available, callers then poll
+    @staticmethod
+    def create():
+        log = logger.of('create')
+        try:
+            libc = load_libc()
+        except (OSError, AttributeError) as e:
+            log.info('inotify is not available: %s' % e)
+            return None
+
+        fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            log.error('inotify_init1 failed: %s' % os.strerror(ctypes.get_errno()))
+            return None
+
+        return Watcher(libc, fd)
+
+    def watch(self, directory, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), mask | IN_ONLYDIR)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch %s failed: %s' % (directory, os.strerror(ctypes.get_errno())))
+        self.directories[wd] = directory
+        return wd
+
+    def is_watched(self, directory):
+        return directory in self.directories.values()
+
+    # Waits up to timeout seconds for events, returns the ones that arrived. An IN_Q_OVERFLOW event
+    # means some were lost.
+    def read(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, READ_BYTES)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            offset += length
+
+            directory = self.directories.get(wd)
+            if mask & IN_IGNORED:
+                # the directory was deleted or unwatched
+                self.directories.pop(wd, None)
+                continue
+            events.append(Event(directory, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+        self.directories = {}
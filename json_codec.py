@@ -0,0 +1,48 @@
+import json
+import os
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# States are pretty printed for people reading them. Services that only write for other programs
+# set ZELENIK_PRETTY_JSON=0 to write them compact instead.
+PRETTY_STATES = os.environ.get('ZELENIK_PRETTY_JSON', '1') != '0'
+
+# orjson writes exponents, floats below 1e-4, NaN and DEL differently from json.dumps, and does not
+# escape non-ascii. Output that may contain any of these is written again with json.dumps.
+ORJSON_EXPONENT = re.compile(rb'e[-0-9]')
+ORJSON_OPTIONS = 0
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_PASSTHROUGH_DATACLASS
+
+def loads(s):
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass # json.loads also accepts NaN and Infinity, let it decide
+
+    return json.loads(s)
+
+def dumps_compact(o):
+    if orjson is not None:
+        try:
+            b = orjson.dumps(o, option=ORJSON_OPTIONS)
+        except TypeError:
+            pass
+        else:
+            if b.isascii() and not (b'0.0000' in b or b'null' in b or b'\x7f' in b or ORJSON_EXPONENT.search(b)):
+                return b.decode('ascii')
+
+    return json.dumps(o, separators=(',', ':'))
+
+def dumps_pretty(o):
+    return json.dumps(o, sort_keys=True, indent=4, separators=(',', ': '), ensure_ascii=False)
+
+def dumps_state(o):
+    if PRETTY_STATES:
+        return dumps_pretty(o)
+    return dumps_compact(o)
@@ -1,26 +1,95 @@
+import atexit
+import copy
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import threading
+
 from systemd.journal import JournalHandler
 
+# Records are queued and written to the journal by a listener thread, so logging does not wait for
+# journald. ZELENIK_LOG_LEVEL is the level of every logger and ZELENIK_LOG_LEVELS sets some apart,
+# as in "enchanter=WARNING,db_driver.load_state=DEBUG". A method logger has the level of its module
+# unless it is given one.
+LOG_LEVEL = os.environ.get('ZELENIK_LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('ZELENIK_LOG_LEVELS', '')
+
+def parse_levels(levels):
+    parsed = {}
+    for item in levels.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+# The message is formatted when queued, as its arguments may change after, and a traceback by the
+# listener, as that is the slow part
+class JournalQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+lock = threading.Lock()
+handler = None
+listener = None
+
+def start_listener(records):
+    global listener
+    listener = QueueListener(records, JournalHandler())
+    listener.start()
+
+def queue_handler():
+    global handler
+    with lock:
+        if handler is None:
+            logging.basicConfig(level=LOG_LEVEL)
+            for name, level in parse_levels(LOG_LEVELS).items():
+                logging.getLogger(name).setLevel(level)
+
+            records = queue.SimpleQueue()
+            handler = JournalQueueHandler(records)
+            start_listener(records)
+            # writes what is queued when the process exits
+            atexit.register(lambda: listener.stop())
+            # a forked process has the queue but not the thread writing it
+            os.register_at_fork(after_in_child=lambda: start_listener(handler.queue))
+        return handler
+
 class Logger:
-    def __init__(self, name, level=logging.INFO):
-        logging.basicConfig(level=level)
+    def __init__(self, name, level=None, module=True):
         self.name = name
-        self.level = level
         self.logger = logging.getLogger(name)
-        self.logger.propagate = False
-        if len(self.logger.handlers) == 0:
-            self.logger.addHandler(JournalHandler())
+        self.children = {}
+        if module:
+            self.logger.propagate = False
+            if not self.logger.handlers:
+                self.logger.addHandler(queue_handler())
+        if level is not None:
+            self.logger.setLevel(level)
 
+    # Kept, as hot paths ask for their logger with every call. Records of a method logger go through
+    # the handler of its module.
     def of(self, method_name):
-        return Logger(".".join([self.name, method_name]), level=self.level)
+        child = self.children.get(method_name)
+        if child is None:
+            child = self.children.setdefault(method_name, Logger(".".join([self.name, method_name]), module=False))
+        return child
 
-    def info(self, message):
-        self.logger.info("%s" % message)
+    def is_enabled(self, level):
+        return self.logger.isEnabledFor(level)
 
-    def warning(self, message):
-        self.logger.warning("%s" % message)
+    # args are formatted into message only when the record is written, as in logging
+    def debug(self, message, *args):
+        self.logger.debug(message, *args)
 
-    def error(self, message, traceback=False):
-        self.logger.error("%s" % message, exc_info=traceback)
+    def info(self, message, *args):
+        self.logger.info(message, *args)
 
+    def warning(self, message, *args):
+        self.logger.warning(message, *args)
 
+    def error(self, message, *args, traceback=False):
+        self.logger.error(message, *args, exc_info=traceback)
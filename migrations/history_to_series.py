@@ -0,0 +1,108 @@
+#!/www/zelenik/venv/bin/python
+
+# Builds the reported series of every thing from its history. Stop mqtt_operator while this runs,
+# reports appended in the meantime would be lost when the merged series replace the existing ones.
+
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+
+import sys
+sys.path.append('/www/zelenik/')
+
+from db_driver import read_lines_single_zipped_file, parse_isoformat
+import series
+
+created = []
+
+db = Path('/www/zelenik/db')
+
+def safe_loads(t):
+    try:
+        return json.loads(t)
+    except json.JSONDecodeError:
+        print("Ignoring %s because of parsing error" % t)
+        return None
+
+def unlink(files):
+    print("Deleting %s" % [*map(str,files)])
+    for file in files:
+        file.unlink()
+
+def reported_lines(thing_directory):
+    history_path = thing_directory / "history"
+    archive_path = history_path / "archive"
+    if archive_path.is_dir():
+        archives = sorted(archive_path.glob('*/reported.*.zip'), key=lambda x: x.name)
+        for archive in archives:
+            yield from read_lines_single_zipped_file(archive)
+
+    if history_path.is_dir():
+        for history in sorted(history_path.glob('reported.*.txt')):
+            with history.open(encoding='utf-8') as f:
+                yield from f.readlines()
+
+    state = thing_directory / "reported.json"
+    if state.exists():
+        with state.open(encoding='utf-8') as f:
+            yield f.read()
+
+for file in db.iterdir():
+    if not file.is_dir() or file.name in ('na', 'stado'):
+        print("Ignoring %s because it is not a thing directory" % file.name)
+        continue
+
+    collected = {}
+    for line in reported_lines(file):
+        reported = safe_loads(line)
+        if reported is None or 'timestamp_utc' not in reported:
+            continue
+        time = parse_isoformat(reported['timestamp_utc'])
+        state = reported.get('state', {})
+        for kind in series.SERIES_KINDS:
+            values = state.get(kind)
+            if not isinstance(values, dict):
+                continue
+            for key, value in values.items():
+                if series.is_series_key(key):
+                    times, numbers = collected.setdefault((kind, key), ([], []))
+                    times.append(time)
+                    numbers.append(series.numeric_value(value))
+
+    for (kind, key), (times, numbers) in collected.items():
+        series.prepare_directory(series.series_directory(file, 'reported', kind))
+        p = series.series_path(file, 'reported', kind, key)
+        migrated = p.with_suffix('.migrated')
+        if migrated.exists():
+            migrated.unlink() # left by an interrupted run
+        series.append(migrated, times, numbers)
+
+        # reports that arrived since the series was introduced are merged in, keeping time order
+        # for series.load. History already holds them too, so duplicates are dropped.
+        records = np.fromfile(str(migrated), dtype=series.SERIES_DTYPE)
+        if p.exists():
+            existing = np.fromfile(str(p), dtype=series.SERIES_DTYPE, count=p.stat().st_size // series.SERIES_DTYPE.itemsize)
+            records = np.concatenate([records, existing])
+        records = records[np.argsort(records['time'], kind='stable')]
+        _, first = np.unique(records['time'], return_index=True)
+        records[first].tofile(str(migrated))
+
+        if p.exists():
+            p.rename(p.with_suffix('.premigration'))
+            created.append(p.with_suffix('.premigration'))
+        os.replace(str(migrated), str(p))
+        created.append(p)
+
+    print("Created %d series for %s" % (len(collected), file.name))
+
+print("Does db look okay? I will keep the new series if yes or bring back the old ones if no. (yes/No)")
+yes_no = input()
+premigration = [p for p in created if p.suffix == '.premigration']
+if yes_no.lower() != "yes":
+    unlink([p for p in created if p.suffix != '.premigration'])
+    for p in premigration:
+        p.rename(p.with_suffix(series.SERIES_SUFFIX))
+else:
+    unlink(premigration)
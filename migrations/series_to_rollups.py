@@ -0,0 +1,33 @@
+#!/www/zelenik/venv/bin/python
+
+# Builds the rollups of every thing from its reported series, run history_to_series.py first. Rollups
+# only hold what is in the series, so this can be run again at any time. Stop mqtt_operator while it
+# runs, reports rolled up in the meantime would be lost when the built rollups replace the existing ones.
+
+from pathlib import Path
+
+import sys
+sys.path.append('/www/zelenik/')
+
+import series
+import rollups
+
+db = Path('/www/zelenik/db')
+
+for file in db.iterdir():
+    if not file.is_dir() or file.name in ('na', 'stado'):
+        print("Ignoring %s because it is not a thing directory" % file.name)
+        continue
+
+    built = 0
+    for kind in series.SERIES_KINDS:
+        keys = series.keys(file, 'reported', kind)
+        if keys:
+            series.prepare_directory(rollups.rollup_directory(file, 'reported', kind))
+        for key in keys:
+            times, values = series.load(series.series_path(file, 'reported', kind, key))
+            for resolution in rollups.ROLLUP_RESOLUTIONS:
+                rollups.write(rollups.rollup_path(file, 'reported', kind, key, resolution), rollups.build(times, values, resolution))
+            built += 1
+
+    print("Built rollups of %d series for %s" % (built, file.name))
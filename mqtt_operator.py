@@ -2,12 +2,17 @@
 
 import paho.mqtt.client as mqtt
 import db_driver
-import json
+import json_codec
+import os
+import queue
 import re
+import signal
+import threading
 import time
 import sys
+import zlib
 
-from db_driver import to_compact_json
+from db_driver import to_compact_json, pretty_json
 
 from logger import Logger
 logger = Logger("mqtt_operator")
@@ -21,6 +26,13 @@ UPDATE_REPORTED_EXCEPTION = '{"reason": "Caught exception while updating reporte
 
 DIR = '/www/zelenik/'
 
+# messages are handled by worker threads, those of a thing always by the same one and in order
+INGEST_WORKERS = int(os.environ.get('ZELENIK_INGEST_WORKERS', '4'))
+# messages waiting for a worker, more block paho's network loop until there is room
+INGEST_QUEUE_SIZE = int(os.environ.get('ZELENIK_INGEST_QUEUE_SIZE', '1000'))
+STATUS_EVERY = 60 # seconds
+OPERATOR_STATUS = 'mqtt-operator-status.json'
+
 def add_time(d):
     d['t'] = int(time.time()) # seconds since EPOCH, Posix time
 
@@ -38,7 +50,7 @@ def parse_thing_action(topic):
     match = re.match(r'things\/([a-zA-Z0-9-]+)\/(\w+)', topic)
     log = logger.of("parse_thing_action")
     if not match:
-        log.info("Could not parse thing and action from topic %s" % topic)
+        log.info("Could not parse thing and action from topic %s", topic)
         return "", ""
     thing = match.group(1)
     action = match.group(2)
@@ -49,9 +61,9 @@ def get_answer(db, topic, payload_string):
     log = logger.of("get_answer")
 
     try:
-        payload = json.loads(payload_string)
+        payload = json_codec.loads(payload_string)
     except ValueError:
-        log.error("Payload is not a valid json. %s - %s" % (topic, payload_string), traceback=True)
+        log.error("Payload is not a valid json. %s - %s", topic, payload_string, traceback=True)
         answer_topic = ERROR_TOPIC
         answer_payload = MESSAGE_NOT_JSON
         return answer_topic, answer_payload
@@ -60,7 +72,7 @@ def get_answer(db, topic, payload_string):
 
     if action == "update":
         if not payload.get("state"):
-            log.error("Update payload does not begin with a state object. %s - %s" % (topic, payload))
+            log.error("Update payload does not begin with a state object. %s - %s", topic, payload)
             answer_topic = ERROR_TOPIC
             answer_payload = WRONG_FORMAT_STATE
             return answer_topic, answer_payload
@@ -69,14 +81,14 @@ def get_answer(db, topic, payload_string):
             try:
                 db.update('reported', thing, payload["state"]["reported"])
             except Exception as e:
-                log.error("Updating reported failed with an exception %s" % e, traceback=True)
+                log.error("Updating reported failed with an exception %s", e, traceback=True)
                 e = sys.exc_info()[0]
                 answer_topic = ERROR_TOPIC
                 answer_payload = UPDATE_REPORTED_EXCEPTION % e
 
                 return answer_topic, answer_payload
         else:
-            log.error("Update does not contain reported. %s - %s" % (topic, payload))
+            log.error("Update does not contain reported. %s - %s", topic, payload)
             answer_topic = ERROR_TOPIC
             answer_payload = WRONG_FORMAT_REPORTED_DESIRED 
             return answer_topic, answer_payload
@@ -91,16 +103,98 @@ def get_answer(db, topic, payload_string):
         answer_topic = "things/%s/delta" % thing
         answer_payload = to_compact_json(delta)
     else:
-        log.error("We got a message on a topic we should not be listening to: %s - %s" % (topic, payload))
+        log.error("We got a message on a topic we should not be listening to: %s - %s", topic, payload)
         answer_topic = ERROR_TOPIC
         answer_payload = MESSAGE_NOT_HANDLED
 
     return answer_topic, answer_payload
 
 
+# put on every worker queue after the messages still to handle
+STOP = None
+
+# Hands messages from paho's network loop to worker threads, so a slow disk does not hold up
+# keep-alives and the messages of other things. A thing's messages go to one worker, in order.
+# Each worker has a bounded queue; submitting to a full one waits, which shows in the status.
+class IngestionPipeline:
+    def __init__(self, handle, workers=INGEST_WORKERS, queue_size=INGEST_QUEUE_SIZE):
+        self.handle = handle
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.accepting = False
+        self.status = {'workers': workers, 'queue_size': queue_size, 'queued': 0, 'handled': 0, 'failed': 0, 'waited': 0, 'waited_seconds': 0.0, 'max_depth': 0}
+
+    # stable for a thing, so its messages are handled in the order they came
+    def shard(self, thing):
+        return zlib.crc32(thing.encode('utf-8')) % len(self.queues)
+
+    def start(self):
+        self.accepting = True
+        for index, messages in enumerate(self.queues):
+            t = threading.Thread(target=self.run, args=(messages,), name='ingest-%d' % index)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, thing, *message):
+        if not self.accepting:
+            logger.of('submit').error('Not accepting messages, dropping one for %s', thing)
+            return False
+
+        messages = self.queues[self.shard(thing)]
+        try:
+            messages.put_nowait(message)
+        except queue.Full:
+            started = time.monotonic()
+            messages.put(message)
+            with self.lock:
+                self.status['waited'] += 1
+                self.status['waited_seconds'] += time.monotonic() - started
+
+        with self.lock:
+            self.status['queued'] += 1
+            self.status['max_depth'] = max(self.status['max_depth'], messages.qsize())
+        return True
+
+    def run(self, messages):
+        log = logger.of('run')
+        while True:
+            message = messages.get()
+            if message is STOP:
+                return
+            try:
+                self.handle(*message)
+                handled = 'handled'
+            except Exception:
+                log.error('Handling a message failed', traceback=True)
+                handled = 'failed'
+            with self.lock:
+                self.status[handled] += 1
+
+    # Handles what is queued, then stops the workers
+    def stop(self):
+        logger.of('stop').info('Stopping, %d messages queued', self.depth())
+        self.accepting = False
+        for messages in self.queues:
+            messages.put(STOP)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def depth(self):
+        return sum(messages.qsize() for messages in self.queues)
+
+    def get_status(self):
+        with self.lock:
+            status = dict(self.status)
+        status['depths'] = [messages.qsize() for messages in self.queues]
+        return status
+
 class MqttOperator:
     def __init__(self, working_directory = DIR): 
         self.db = db_driver.DatabaseDriver(working_directory)
+        self.pipeline = IngestionPipeline(self.answer)
+        self.running = False
         self.client = mqtt.Client()
         username, password = parse_username_password()
         self.client.username_pw_set(username, password)
@@ -109,24 +203,53 @@ class MqttOperator:
         self.client.on_message = self.on_message
 
     def operate(self):
-        self.client.connect("localhost")
-        self.client.loop_forever()
+        # systemd stops the operator with SIGTERM, the queued messages are handled before it exits
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.client.disconnect())
+        self.running = True
+        self.pipeline.start()
+        self.write_status()
+        try:
+            self.client.connect("localhost")
+            self.client.loop_forever()
+        finally:
+            self.running = False
+            self.pipeline.stop()
+            self.write_status()
+
+    # replaced whole so readers never see a partially written status
+    def write_status(self):
+        status_path = self.db.directory / OPERATOR_STATUS
+        temp_status_path = status_path.with_suffix('.tmp')
+        with temp_status_path.open('w', encoding='utf-8') as f:
+            f.write(pretty_json(self.pipeline.get_status()))
+        os.replace(str(temp_status_path), str(status_path))
+
+        if self.running:
+            t = threading.Timer(STATUS_EVERY, self.write_status)
+            t.daemon = True
+            t.start()
 
     def on_connect(self, client, userdata, flags, rc):
         log = logger.of("on_connect")
-        log.info("Connected with result code %d" % rc)
+        log.info("Connected with result code %d", rc)
         client.subscribe("things/+/update")
         client.subscribe("things/+/get")
 
 
+    # runs in paho's network loop, so only queues the message
     def on_message(self, client, userdata, msg):
-        log = logger.of("on_message")
-        topic = msg.topic
-        payload = msg.payload.decode('utf-8')
-        log.info("[%s] %s" % (topic, payload))
+        thing, _ = parse_thing_action(msg.topic)
+        self.pipeline.submit(thing, msg.topic, msg.payload)
+
+    # runs on a pipeline worker
+    def answer(self, topic, payload_bytes):
+        log = logger.of("answer")
+        payload = payload_bytes.decode('utf-8')
+        # payloads are logged at debug, a message comes from every thing every few minutes
+        log.debug("[%s] %s", topic, payload)
         answer_topic, answer_payload = get_answer(self.db, topic, payload)
         if answer_topic:
-            log.info("Answering [%s] %s" % (answer_topic, answer_payload))
+            log.debug("Answering [%s] %s", answer_topic, answer_payload)
             self.client.publish(answer_topic, answer_payload)
         
 if __name__ == '__main__':
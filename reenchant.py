@@ -0,0 +1,243 @@
+#!/www/zelenik/venv/bin/python
+
+# Recomputes the enchanted history of things from their reported history, after their enchanter.json
+# changed. Days are read and written by a pool of processes and enchanted in order, so sum and
+# cum_average go on from one day to the next. Days up to two days ago are done, later ones are still
+# being written by the enchanter. Stop the enchanter and the archiver while this runs, the enchanted
+# series and rollups are rebuilt at the end and what they append meanwhile would be lost.
+#
+# Usage: reenchant.py thing [thing ...] [--since YYYY-MM-DD] [--workers N] [--restart]
+#
+# An interrupted run goes on from the last day written when run again, unless the config changed.
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+import hashlib
+import os
+import time
+
+import numpy as np
+
+import batch_enchanter
+import db_driver
+from db_driver import flat_map, pretty_json, to_compact_json
+import enchanter
+import rollups
+import series
+from state_processor import parse_isoformat
+
+from logger import Logger
+logger = Logger("reenchant")
+
+DIR = '/www/zelenik/'
+WORKERS = os.cpu_count() or 1
+READ_AHEAD = 2 # days read per worker before they are enchanted
+REENCHANT_STATUS = 'reenchant-status.json'
+
+# Each worker process has its own driver
+worker_db = None
+
+def start_worker(working_directory):
+    global worker_db
+    worker_db = db_driver.DatabaseDriver(working_directory)
+
+def read_day(thing, state_name, day):
+    return worker_db._load_archive_for_day(thing, state_name, day)
+
+def write_day(thing, day, enchanted_history):
+    worker_db._write_archive(thing, 'enchanted', day, enchanted_history)
+
+    # the archiver would replace the written archive with history left from before
+    history_file = worker_db.directory / thing / 'history' / ('enchanted.%s.txt' % day.isoformat())
+    for stale in (history_file, history_file.with_suffix(db_driver.HISTORY_INDEX_SUFFIX)):
+        if stale.exists():
+            stale.unlink()
+
+# The series values of an enchanted day, (kind, key) - (times, values) of the reports having the key
+def read_day_values(thing, day):
+    collected = {}
+    for state in worker_db._load_archive_for_day(thing, 'enchanted', day):
+        if 'timestamp_utc' not in state:
+            continue
+        time = parse_isoformat(state['timestamp_utc'])
+        for kind in series.SERIES_KINDS:
+            values = state.get('state', {}).get(kind)
+            if not isinstance(values, dict):
+                continue
+            for key, value in values.items():
+                if series.is_series_key(key):
+                    times, numbers = collected.setdefault((kind, key), ([], []))
+                    times.append(time)
+                    numbers.append(series.numeric_value(value))
+
+    return {key: (np.array(times, dtype='datetime64[us]'), np.array(numbers)) for key, (times, numbers) in collected.items()}
+
+def config_signature(config):
+    return hashlib.sha1(to_compact_json(config).encode('utf-8')).hexdigest()
+
+class Reenchanter:
+    def __init__(self, working_directory=DIR, workers=WORKERS):
+        self.working_directory = working_directory
+        self.db = db_driver.DatabaseDriver(working_directory)
+        self.enchanter = enchanter.Enchanter(working_directory, db=self.db, watch=False, workers=1)
+        self.workers = workers
+
+    def days(self, thing, since=None, today=None):
+        if today is None:
+            today = date.today()
+        two_days_ago = today - timedelta(days=2)
+        days = self.db.history_days(thing, 'reported')
+        return [day for day in days if day <= two_days_ago and (since is None or day >= since)]
+
+    def status_path(self, thing):
+        return self.db.directory / thing / REENCHANT_STATUS
+
+    def load_status(self, thing):
+        status_path = self.status_path(thing)
+        if not status_path.exists():
+            return {}
+        with status_path.open(encoding='utf-8') as f:
+            return db_driver.safe_json_loads(f.read()) or {}
+
+    # replaced whole, so an interrupted run leaves the status of the last day written
+    def write_status(self, thing, status):
+        status_path = self.status_path(thing)
+        temp_status_path = status_path.with_suffix('.tmp')
+        with temp_status_path.open('w', encoding='utf-8') as f:
+            f.write(pretty_json(status))
+        os.replace(str(temp_status_path), str(status_path))
+
+    # The senses of other things the formulas read, as the enchanter sees them now
+    def other_senses(self, config):
+        formulas = enchanter.compile_formulas(config)
+        keys = {key for formula in formulas for key in formula.inputs if ':' in key}
+        return {key: self.enchanter.retrieve_sense_value(key, senses={}) for key in keys}
+
+    def reenchant(self, thing, since=None, restart=False, today=None):
+        log = logger.of('reenchant')
+        config = self.db.load_state(thing, 'enchanter')
+        if not config:
+            log.info('Not re-enchanting %s because it has no enchanter config' % thing)
+            return 0
+        other_senses = self.other_senses(config)
+        aliases = flat_map(self.db.load_state(thing, 'displayables'), 'alias')
+
+        days = self.days(thing, since, today)
+        signature = config_signature(config)
+        status = self.load_status(thing)
+        if not restart and status.get('config') == signature and status.get('since') == (since and since.isoformat()) and status.get('day'):
+            done = datetime.strptime(status['day'], '%Y-%m-%d').date()
+            old_enchanted = status['enchanted']
+            log.info('Resuming %s after %s' % (thing, done))
+            pending = [day for day in days if day > done]
+        else:
+            status = {'config': signature, 'since': since and since.isoformat(), 'day': None, 'enchanted': {}, 'reports': 0}
+            old_enchanted = {}
+            pending = days
+
+        started = time.monotonic()
+        reports = 0
+        with ProcessPoolExecutor(self.workers, initializer=start_worker, initargs=(self.working_directory,)) as pool:
+            reads = deque()
+            writes = deque()
+            upcoming = iter(pending)
+            for day in pending:
+                while len(reads) < self.workers * READ_AHEAD:
+                    next_day = next(upcoming, None)
+                    if next_day is None:
+                        break
+                    reads.append(pool.submit(read_day, thing, 'reported', next_day))
+
+                reported = [x for x in reads.popleft().result() if 'timestamp_utc' in x]
+                if reported:
+                    enchanted_history = batch_enchanter.enchant_history(reported, config, old_enchanted, other_senses)
+                    old_enchanted = db_driver.copy_json(enchanted_history[-1])
+                    aliased = [self.db._apply_aliases(thing, x, aliases=aliases) for x in enchanted_history]
+                    writes.append((day, len(reported), old_enchanted, pool.submit(write_day, thing, day, aliased)))
+                    reports += len(reported)
+                else:
+                    writes.append((day, 0, old_enchanted, None))
+
+                while writes and (writes[0][3] is None or writes[0][3].done()):
+                    self.written(thing, status, *writes.popleft())
+
+            while writes:
+                self.written(thing, status, *writes.popleft())
+
+            self.rebuild_series(thing, days, pool)
+
+        seconds = time.monotonic() - started
+        log.info('Re-enchanted %d reports of %d days for %s in %.1f s, %.0f reports/s' % (reports, len(pending), thing, seconds, reports / seconds if seconds else 0))
+        return reports
+
+    def written(self, thing, status, day, reports, enchanted, write):
+        if write is not None:
+            write.result()
+        status.update({'day': day.isoformat(), 'enchanted': enchanted, 'reports': status['reports'] + reports})
+        self.write_status(thing, status)
+
+    # The series in the time of the re-enchanted days are replaced and the rollups built from them again
+    def rebuild_series(self, thing, days, pool):
+        log = logger.of('rebuild_series')
+        if not days:
+            return
+
+        collected = {}
+        for day_values in pool.map(read_day_values, [thing] * len(days), days):
+            for key, part in day_values.items():
+                collected.setdefault(key, []).append(part)
+
+        all_times = [times for parts in collected.values() for times, _ in parts]
+        if not all_times:
+            return
+        all_times = np.concatenate(all_times)
+        first, last = all_times.min(), all_times.max()
+
+        thing_directory = self.db.directory / thing
+        keys = set(collected) | {(kind, key) for kind in series.SERIES_KINDS for key in series.keys(thing_directory, 'enchanted', kind)}
+        for kind, key in keys:
+            parts = collected.get((kind, key), [])
+            path = series.series_path(thing_directory, 'enchanted', kind, key)
+            records = np.fromfile(str(path), dtype=series.SERIES_DTYPE, count=path.stat().st_size // series.SERIES_DTYPE.itemsize) if path.exists() else np.empty(0, dtype=series.SERIES_DTYPE)
+            kept = records[(records['time'] < first) | (records['time'] > last)]
+
+            new = np.empty(sum(len(times) for times, _ in parts), dtype=series.SERIES_DTYPE)
+            if parts:
+                new['time'] = np.concatenate([times for times, _ in parts])
+                new['value'] = np.concatenate([numbers for _, numbers in parts])
+
+            records = np.concatenate([kept, new])
+            records = records[np.argsort(records['time'], kind='stable')]
+
+            series.prepare_directory(series.series_directory(thing_directory, 'enchanted', kind))
+            temp = path.with_suffix('.tmp')
+            records.tofile(str(temp))
+            os.replace(str(temp), str(path))
+
+            series.prepare_directory(rollups.rollup_directory(thing_directory, 'enchanted', kind))
+            for resolution in rollups.ROLLUP_RESOLUTIONS:
+                rollups.write(rollups.rollup_path(thing_directory, 'enchanted', kind, key, resolution), rollups.build(records['time'], records['value'], resolution))
+
+        log.info('Rebuilt %d enchanted series for %s' % (len(keys), thing))
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the enchanted history of things after their enchanter config changed')
+    parser.add_argument('things', nargs='+')
+    parser.add_argument('--since', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(), help='first day to re-enchant, YYYY-MM-DD, the first day with history by default')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--restart', action='store_true', help='start over instead of going on from an interrupted run')
+    parser.add_argument('--directory', default=DIR)
+    args = parser.parse_args()
+
+    reenchanter = Reenchanter(args.directory, workers=args.workers)
+    started = time.monotonic()
+    reports = 0
+    for thing in args.things:
+        reports += reenchanter.reenchant(reenchanter.db.resolve_thing(thing) or thing, since=args.since, restart=args.restart)
+    seconds = time.monotonic() - started
+    print("Re-enchanted %d reports in %.1f s, %.0f reports/s" % (reports, seconds, reports / seconds if seconds else 0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+
+import series
+
+from logger import Logger
+logger = Logger("rollups")
+
+# One record per sense and time bucket, updated in place while the bucket is the newest, so long
+# graphs read a few thousand records instead of weeks of history
+ROLLUP_DTYPE = np.dtype([('time', '<M8[s]'), ('count', '<u4'), ('min', '<f8'), ('max', '<f8'), ('sum', '<f8'), ('last', '<f8')])
+ROLLUP_RESOLUTIONS = (5*60, 60*60, 24*60*60) # seconds
+ROLLUP_DIRECTORY = 'rollups'
+ROLLUP_SUFFIX = '.rollup'
+
+def rollup_directory(thing_directory, state_name, kind):
+    return thing_directory / ROLLUP_DIRECTORY / state_name / kind
+
+def rollup_path(thing_directory, state_name, kind, key, resolution):
+    return rollup_directory(thing_directory, state_name, kind) / ('%s.%d%s' % (key, resolution, ROLLUP_SUFFIX))
+
+def bucket_time(time, resolution):
+    seconds = series.to_datetime64(time).astype('datetime64[s]').astype(np.int64)
+    return np.datetime64(int(seconds - seconds % resolution), 's')
+
+def new_record(bucket, value):
+    record = np.zeros(1, dtype=ROLLUP_DTYPE)[0]
+    record['time'] = bucket
+    record['min'] = np.inf
+    record['max'] = -np.inf
+    return add(record, value)
+
+# wrong values are nan, they are only remembered as the last value of the bucket
+def add(record, value):
+    if not np.isnan(value):
+        record['count'] += 1
+        record['min'] = min(record['min'], value)
+        record['max'] = max(record['max'], value)
+        record['sum'] += value
+    record['last'] = value
+    return record
+
+def read_record(fd, offset):
+    return np.frombuffer(os.pread(fd, ROLLUP_DTYPE.itemsize, offset), dtype=ROLLUP_DTYPE)[0].copy()
+
+def write_record(fd, offset, record):
+    os.pwrite(fd, np.array([record], dtype=ROLLUP_DTYPE).tobytes(), offset)
+
+# Reports arrive in time order, so the newest record is updated or a new one appended. A late report
+# for an older bucket rewrites the file.
+def update(path, resolution, time, value):
+    bucket = bucket_time(time, resolution)
+    fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        size = os.fstat(fd).st_size
+        # drop a record left partially written by an interrupted writer so the new ones stay aligned
+        partial = size % ROLLUP_DTYPE.itemsize
+        if partial:
+            size -= partial
+            os.ftruncate(fd, size)
+
+        if size == 0:
+            write_record(fd, 0, new_record(bucket, value))
+            return
+
+        last_offset = size - ROLLUP_DTYPE.itemsize
+        last = read_record(fd, last_offset)
+        if last['time'] == bucket:
+            write_record(fd, last_offset, add(last, value))
+        elif last['time'] < bucket:
+            write_record(fd, size, new_record(bucket, value))
+        else:
+            update_past(fd, size, bucket, value)
+    finally:
+        os.close(fd)
+
+def update_past(fd, size, bucket, value):
+    logger.of('update_past').info('Updating past bucket %s' % bucket)
+    records = np.frombuffer(os.pread(fd, size, 0), dtype=ROLLUP_DTYPE).copy()
+    index = np.searchsorted(records['time'], bucket)
+    if index < len(records) and records[index]['time'] == bucket:
+        records[index] = add(records[index], value)
+    else:
+        records = np.insert(records, index, new_record(bucket, value))
+    os.pwrite(fd, records.tobytes(), 0)
+
+def update_state(thing_directory, state_name, state, time):
+    updated = []
+    for kind in series.SERIES_KINDS:
+        values = state.get(kind)
+        if not isinstance(values, dict):
+            continue
+
+        keys = [key for key in values.keys() if series.is_series_key(key)]
+        if not keys:
+            continue
+
+        series.prepare_directory(rollup_directory(thing_directory, state_name, kind))
+        for key in keys:
+            value = series.numeric_value(values[key])
+            for resolution in ROLLUP_RESOLUTIONS:
+                update(rollup_path(thing_directory, state_name, kind, key, resolution), resolution, time, value)
+            updated.append(key)
+
+    return updated
+
+# The rollups of a whole series at once, for building them from existing history
+def build(times, values, resolution):
+    if len(times) == 0:
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+
+    seconds = np.asarray(times).astype('datetime64[s]').astype(np.int64)
+    buckets = seconds - seconds % resolution
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(buckets, kind='stable')
+    buckets, values = buckets[order], values[order]
+
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)]
+    valid = ~np.isnan(values)
+
+    records = np.empty(len(starts), dtype=ROLLUP_DTYPE)
+    records['time'] = buckets[starts].astype('datetime64[s]')
+    records['count'] = np.add.reduceat(valid, starts)
+    records['min'] = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+    records['max'] = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+    records['sum'] = np.add.reduceat(np.where(valid, values, 0), starts)
+    records['last'] = values[ends - 1]
+    return records
+
+def write(path, records):
+    temp = path.with_name(path.name + '.tmp')
+    with temp.open('wb') as f:
+        f.write(records.tobytes())
+    os.replace(str(temp), str(path))
+
+def keys(thing_directory, state_name, kind, resolution):
+    directory = rollup_directory(thing_directory, state_name, kind)
+    if not directory.is_dir():
+        return []
+
+    suffix = '.%d%s' % (resolution, ROLLUP_SUFFIX)
+    return sorted(x.name[:-len(suffix)] for x in directory.iterdir() if x.name.endswith(suffix))
+
+def load(path):
+    if not path.exists():
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+
+    count = path.stat().st_size // ROLLUP_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+
+    return np.memmap(str(path), dtype=ROLLUP_DTYPE, mode='r', shape=(count,))
+
+# The records of the buckets ending after since
+def since(records, since, resolution):
+    start = np.searchsorted(records['time'], series.to_datetime64(since).astype('datetime64[s]') - np.timedelta64(resolution, 's'), side='right')
+    return records[start:]
+
+def mean(records):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return records['sum'] / records['count']
+
+# The coarsest resolution with at least one bucket per point, None when raw history is needed
+def choose_resolution(seconds, points):
+    for resolution in sorted(ROLLUP_RESOLUTIONS, reverse=True):
+        if seconds / resolution >= points:
+            return resolution
+    return None
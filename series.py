@@ -0,0 +1,100 @@
+from numbers import Number
+
+import numpy as np
+
+from logger import Logger
+logger = Logger("series")
+
+# One fixed width record per reported value, so a file can be memory mapped and sliced without parsing
+SERIES_DTYPE = np.dtype([('time', '<M8[us]'), ('value', '<f8')])
+SERIES_DIRECTORY = 'series'
+SERIES_SUFFIX = '.series'
+SERIES_KINDS = ('senses', 'write')
+NOT_SERIES = ['time']
+
+def numeric_value(value):
+    # wrong senses are stored as nan so that their time is still known
+    if isinstance(value, dict):
+        value = value.get('value')
+    if isinstance(value, Number):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return float('nan')
+
+    return float('nan')
+
+def is_series_key(key):
+    return key not in NOT_SERIES and '/' not in key and not key.startswith('.')
+
+def series_directory(thing_directory, state_name, kind):
+    return thing_directory / SERIES_DIRECTORY / state_name / kind
+
+def series_path(thing_directory, state_name, kind, key):
+    return series_directory(thing_directory, state_name, kind) / (key + SERIES_SUFFIX)
+
+def to_datetime64(time):
+    return np.datetime64(time, 'us')
+
+def empty():
+    return np.array([], dtype=SERIES_DTYPE['time']), np.array([], dtype=SERIES_DTYPE['value'])
+
+def append(path, times, values):
+    records = np.empty(len(times), dtype=SERIES_DTYPE)
+    records['time'] = [to_datetime64(t) for t in times]
+    records['value'] = values
+    with path.open('ab') as f:
+        # drop a record left partially written by an interrupted writer so the new ones stay aligned
+        partial = f.tell() % SERIES_DTYPE.itemsize
+        if partial:
+            f.truncate(f.tell() - partial)
+        f.write(records.tobytes())
+
+def prepare_directory(directory):
+    if not directory.is_dir():
+        directory.mkdir(parents=True)
+        directory.chmod(0o774)
+
+def append_state(thing_directory, state_name, state, time):
+    updated = []
+    for kind in SERIES_KINDS:
+        values = state.get(kind)
+        if not isinstance(values, dict):
+            continue
+
+        keys = [key for key in values.keys() if is_series_key(key)]
+        if not keys:
+            continue
+
+        prepare_directory(series_directory(thing_directory, state_name, kind))
+        for key in keys:
+            append(series_path(thing_directory, state_name, kind, key), [time], [numeric_value(values[key])])
+            updated.append(key)
+
+    return updated
+
+def keys(thing_directory, state_name, kind):
+    directory = series_directory(thing_directory, state_name, kind)
+    if not directory.is_dir():
+        return []
+
+    return sorted(x.name[:-len(SERIES_SUFFIX)] for x in directory.iterdir() if x.name.endswith(SERIES_SUFFIX))
+
+def load(path, since=None):
+    if not path.exists():
+        return empty()
+
+    # a record can be partially written if the writer was interrupted, ignore it
+    count = path.stat().st_size // SERIES_DTYPE.itemsize
+    if count == 0:
+        return empty()
+
+    records = np.memmap(str(path), dtype=SERIES_DTYPE, mode='r', shape=(count,))
+    times = records['time']
+    start = 0
+    if since is not None:
+        start = np.searchsorted(times, to_datetime64(since), side='right')
+
+    return times[start:], records['value'][start:]
@@ -1,7 +1,7 @@
-from flask import Flask, request, json
+from flask import Flask, request, json, abort
 from datetime import datetime, timedelta
 import csv
-import math
+from numbers import Number
 from io import StringIO
 from pathlib import Path
 import sys
@@ -9,6 +9,7 @@ root_path = Path(__file__).absolute().parent.parent
 sys.path.append(str(root_path))
 
 from db_driver import DatabaseDriver, flat_map, timestamp
+import downsample
 
 GOOD_PERFORMANCE_LENGTH = 1000 
 
@@ -21,7 +22,11 @@ app.config.update(dict(
 
 def timestamped(state):
     ret = {"timestamp_utc": state.get("timestamp_utc")}
-    senses = flat_map(state.get("state", {}).get("senses", {}), "value", strict=True)
+    senses = state.get("state", {}).get("senses", {})
+    # derived senses like scale are plain numbers
+    numbers = { key : value for key, value in senses.items() if isinstance(value, Number) }
+    senses = flat_map(senses, "value", strict=True)
+    senses.update(numbers)
     senses = { ("sense(%s)" % key) : value for key, value in senses.items() }
     ret.update(senses)
     writes = state.get("state", {}).get("write", {})
@@ -62,10 +67,17 @@ def history(a_thing):
     else:
         since_hours = 0
 
-    history = db.load_history(a_thing, "reported", since_days=since_days, since_hours=since_hours)
-    if len(history) > GOOD_PERFORMANCE_LENGTH:
-        rate = math.ceil(len(history) / GOOD_PERFORMANCE_LENGTH) # ceil so we are conservative
-        history = history[:-1:rate]
+    # graph.js asks for as many points as its graph is pixels wide
+    points = request.args.get('points', GOOD_PERFORMANCE_LENGTH)
+    try:
+        points = max(min(int(points), GOOD_PERFORMANCE_LENGTH), 3)
+    except ValueError:
+        abort(400) # Bad Request
+
+    history = db.load_rollup_history(a_thing, "enchanted", since_days=since_days, since_hours=since_hours, points=points)
+    if history is None:
+        history = db.load_history(a_thing, "enchanted", since_days=since_days, since_hours=since_hours)
+    history = downsample.downsample_history(history, points)
 
     if not history:
         return b"\r\n"
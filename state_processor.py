@@ -44,7 +44,7 @@ def compact_write(word):
 
     else:
         log = logger.of('compact_write')
-        log.error("Word is neither high nor low - %s. Returning default %s" % (word, DEFAULT_WRITE))
+        log.error("Word is neither high nor low - %s. Returning default %s", word, DEFAULT_WRITE)
         return compact_write(DEFAULT_WRITE)
 
 def seconds_to_timestamp(seconds):
@@ -66,11 +66,11 @@ def action(sense, gpio, write, threshold, delta):
 def explode_action(compact_action):
     log = logger.of('explode_action')
     if isinstance(compact_action, dict):
-        log.info('Action looks already exploded: %s' % compact_action)
+        log.info('Action looks already exploded: %s', compact_action)
         return compact_action
     m = ACTION_PATTERN.match(compact_action)
     if m is None:
-        log.error("Could not explode action %s" % compact_action)
+        log.error("Could not explode action %s", compact_action)
         return compact_action
     sense = m.group(1)
     gpio = int(m.group(2))
@@ -87,10 +87,10 @@ def explode_action(compact_action):
 def compact_action(exploded):
     log = logger.of('compact_action')
     if type(exploded) is not dict:
-        log.error('Could not compact action because it is not a dict: %s' % exploded)
+        log.error('Could not compact action because it is not a dict: %s', exploded)
         return exploded
     if not set(exploded.keys()).issuperset(REQUIRED_ACTION_ATTRIBUTES):
-        log.error('Could not compact action because it does not have all the required attributes: %s' % exploded)
+        log.error('Could not compact action because it does not have all the required attributes: %s', exploded)
         return exploded
 
     threshold = exploded['threshold']
@@ -113,7 +113,7 @@ def compact_actions(actions):
 def explode_deprecated_sense(value):
     log = logger.of("explode_deprecated_sense")
     if isinstance(value, Number):
-        log.info("Deprecated sense value number: %s" % value)
+        log.debug("Deprecated sense value number: %s", value)
         return {"value": value}
 
     else:
@@ -123,7 +123,7 @@ def explode_deprecated_sense(value):
             pass
 
     if len(value) > 0 and value[0] == 'w':
-        log.info("Deprecated sense value number marked as wrong with a 'w' character: %s" % value)
+        log.debug("Deprecated sense value number marked as wrong with a 'w' character: %s", value)
         return {"wrong": int(value[1:])}
 
     return None
@@ -139,7 +139,7 @@ def explode_sense(value):
     if not enriched_sense:
         split = value.split('|')
         if len(split) != 4:
-            log.error("Expected value to be 4 parts split by |, got %s instead" % value)
+            log.error("Expected value to be 4 parts split by |, got %s instead", value)
             return None
 
         enriched_sense = {}
@@ -168,7 +168,7 @@ def explode_senses(senses):
         enriched_sense = explode_sense(value)
 
         if enriched_sense is None:
-            log.info('Not exploding sense %s:%s because of a parsing failure' % (key, value))
+            log.info('Not exploding sense %s:%s because of a parsing failure', key, value)
             exploded[key] = value
             continue
 
@@ -205,7 +205,7 @@ def explode(json, previous_json={}, previous_timestamp_string=None):
                     update_delta_seconds = (datetime.utcnow() - parse_isoformat(previous_timestamp_string)).total_seconds()
                     print("Update delta seconds is", update_delta_seconds)
                     if almost_equal(update_delta_seconds, sleep_seconds, TYPICAL_AWAKE_SECONDS):
-                        log.info('Looks like device has slept, adjusting boot for %d seconds ago' % abs_delta_seconds)
+                        log.info('Looks like device has slept, adjusting boot for %d seconds ago', abs_delta_seconds)
                         boot_utc = previous_boot_utc
 
             exploded_value = boot_utc.isoformat(sep=' ')
@@ -235,3 +235,23 @@ def compact(json):
             compacted_value = value
         compacted[key] = compacted_value
     return compacted 
+
+MISSING = object()
+
+# The config has a fixed shape (sleep, gpio, mode, actions) so it is compared field by field.
+# actions are sent as a whole list because the device replaces all its actions with it.
+def diff_config(compact_from, compact_to):
+    delta = {}
+    for key, to_value in compact_to.items():
+        from_value = compact_from.get(key, MISSING)
+        if key == 'actions':
+            if from_value != to_value:
+                delta[key] = list(to_value)
+        elif type(to_value) is dict and type(from_value) is dict:
+            nested = diff_config(from_value, to_value)
+            if nested:
+                delta[key] = nested
+        elif from_value is MISSING or from_value != to_value:
+            delta[key] = to_value
+
+    return delta
@@ -12,6 +12,7 @@ sys.path.append(str(root_path.absolute()))
 sys.path.append(str(source_path.absolute()))
 import zelenik_rest
 import db_driver
+import enchanter
 
 def thing(index):
     return "thing-%d" % index
@@ -41,6 +42,7 @@ class ZelenikRestTestCase(unittest.TestCase):
 
         db_driver.prepare_test_directory(self.temp_directory_path)
         self.db = db_driver.DatabaseDriver(working_directory=self.temp_directory.name)
+        self.enchanter = enchanter.Enchanter(self.temp_directory.name, db=self.db)
 
     def tearDown(self):
         self.temp_directory.cleanup()
@@ -134,13 +136,55 @@ class ZelenikRestTestCase(unittest.TestCase):
                 (n, None, 2)
                 )
 
+    def test_derived_senses(self):
+        self.given_thing(thing(1))
+        self.given_enchanter_config(thing(1), [{"name": "s-percent", "formula": "scale", "from": "s", "from_low": 0, "from_high": 10, "to_low": 0, "to_high": 100}])
+        n = now()
+        self.given_reported(thing(1),
+                {'s' : {"value": 2}},
+                {},
+                n)
+
+        self.when_getting("/db/%s/history?since_days=1" % thing(1))
+
+        self.then_result(
+                ("timestamp_utc", sense('s'), sense('s-percent')),
+                (n, 2, 20.0)
+                )
+
+    def test_downsampled_keeps_newest(self):
+        self.given_thing(thing(1))
+        n = now()
+        for minute in range(20, -1, -1):
+            self.given_reported(thing(1),
+                    {'s' : {"value": minute % 7}},
+                    {},
+                    n - timedelta(minutes=minute))
+
+        self.when_getting("/db/%s/history?since_days=1&points=5" % thing(1))
+
+        lines = self.response.data.decode().split("\r\n")
+        self.assertLess(len(lines), 20)
+        self.assertEqual(db_driver.timestamp(n) + ",0", lines[-2])
+
+    def test_bad_points(self):
+        self.given_thing(thing(1))
+
+        self.when_getting("/db/%s/history?since_days=1&points=many" % thing(1))
+
+        self.assertEqual(400, self.response.status_code)
+
     def given_thing(self, thing):
         self.db._prepare_directory(self.db.directory / thing)
 
+    def given_enchanter_config(self, thing, config):
+        self.db.update('enchanter', thing, config)
+
     def given_reported(self, thing, senses, writes, time):
         state = { "senses": senses }
         state["write"] = writes
         self.db._update_reported(thing, state, time)
+        self.enchanter.enchant_thing(thing)
 
     def when_getting(self, url):
         self.response = self.app.get(url)
@@ -0,0 +1,133 @@
+import unittest
+import archiver
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from datetime import date, datetime, timedelta
+import json
+
+
+THING = "thing"
+THING2 = "another-thing"
+
+class TestArchiver(unittest.TestCase):
+    def setUp(self):
+        self.tmp_directory = TemporaryDirectory()
+        self.db_directory = Path(self.tmp_directory.name) / 'db'
+        self.db_directory.mkdir()
+        self.archiver = archiver.Archiver(self.tmp_directory.name, max_jitter=0, archives_per_second=0)
+
+    def tearDown(self):
+        self.tmp_directory.cleanup()
+
+    def test_jitter_is_stable(self):
+        self.assertEqual(archiver.jitter(THING), archiver.jitter(THING))
+
+    def test_jitter_is_within_max(self):
+        self.assertTrue(0 <= archiver.jitter(THING, 60) < 60)
+
+    def test_archives_old_history(self):
+        last_week = date.today() - timedelta(days=7)
+        self.given_history(THING, "reported", last_week)
+
+        self.when_archiving()
+
+        self.then_archived(THING, "reported", last_week)
+
+    def test_archives_all_states(self):
+        last_week = date.today() - timedelta(days=7)
+        self.given_history(THING, "desired", last_week)
+
+        self.when_archiving()
+
+        self.then_archived(THING, "desired", last_week)
+
+    def test_keeps_recent_history(self):
+        yesterday = date.today() - timedelta(days=1)
+        self.given_history(THING, "reported", yesterday)
+
+        self.when_archiving()
+
+        self.then_not_archived(THING, "reported", yesterday)
+
+    def test_waits_for_thing_time_of_day(self):
+        self.archiver.max_jitter = 60*60
+        last_week = date.today() - timedelta(days=7)
+        self.given_history(THING, "reported", last_week)
+        self.given_history(THING2, "reported", last_week)
+
+        self.when_archiving(now=datetime.combine(date.today(), datetime.min.time()))
+
+        self.then_status_includes({'things_done': 0, 'things_pending': 2, 'archived': 0})
+
+    def test_writes_status(self):
+        last_week = date.today() - timedelta(days=7)
+        self.given_history(THING, "reported", last_week)
+        self.given_history(THING2, "reported", last_week)
+
+        self.when_archiving()
+
+        self.then_status_includes({'running': False, 'things_total': 2, 'things_done': 2, 'archived': 2})
+        self.then_status_has_timing()
+
+    def test_writes_status_while_running(self):
+        last_week = date.today() - timedelta(days=7)
+        self.given_history(THING, "reported", last_week)
+        self.given_history(THING2, "reported", last_week)
+        self.given_status_recorded_on_archive()
+
+        self.when_archiving()
+
+        self.then_recorded_statuses_include([
+            {'running': True, 'things_total': 2, 'things_done': 0, 'archived': 0},
+            {'running': True, 'things_total': 2, 'things_done': 1, 'archived': 1}])
+
+    def given_status_recorded_on_archive(self):
+        self.recorded_statuses = []
+        archive_history_file = self.archiver.db.archive_history_file
+        def recording_archive_history_file(thing, history):
+            with (self.db_directory / archiver.ARCHIVER_STATUS).open(encoding='utf-8') as f:
+                self.recorded_statuses.append(json.loads(f.read()))
+            archive_history_file(thing, history)
+        self.archiver.db.archive_history_file = recording_archive_history_file
+
+    def given_history(self, thing, state, day):
+        p = self.db_directory / thing / "history"
+        p.mkdir(parents=True, exist_ok=True)
+        p = p / ("%s.%s.txt" % (state, day.isoformat()))
+        with p.open('w', encoding='utf-8') as f:
+            f.write('{"value":1}\n')
+
+    def when_archiving(self, now=None):
+        self.archiver.archive_all(now=now)
+
+    def then_archived(self, thing, state, day):
+        p = self.db_directory / thing / "history" / "archive" / str(day.year) / ("%s.%s.zip" % (state, day.isoformat()))
+        self.assertTrue(p.exists())
+        self.then_not_in_history(thing, state, day)
+
+    def then_not_in_history(self, thing, state, day):
+        p = self.db_directory / thing / "history" / ("%s.%s.txt" % (state, day.isoformat()))
+        self.assertFalse(p.exists())
+
+    def then_not_archived(self, thing, state, day):
+        p = self.db_directory / thing / "history" / ("%s.%s.txt" % (state, day.isoformat()))
+        self.assertTrue(p.exists())
+
+    def then_status_includes(self, expected):
+        with (self.db_directory / archiver.ARCHIVER_STATUS).open(encoding='utf-8') as f:
+            status = json.loads(f.read())
+        for key, value in expected.items():
+            self.assertEqual(value, status[key])
+
+    def then_recorded_statuses_include(self, expected_statuses):
+        self.assertEqual(len(expected_statuses), len(self.recorded_statuses))
+        for expected, status in zip(expected_statuses, self.recorded_statuses):
+            for key, value in expected.items():
+                self.assertEqual(value, status[key])
+
+    def then_status_has_timing(self):
+        self.assertIsNotNone(self.archiver.status['last_run_started'])
+        self.assertIsNotNone(self.archiver.status['last_run_seconds'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from datetime import datetime, timedelta
+import random
+
+import numpy as np
+
+import batch_enchanter
+import db_driver
+import enchanter
+
+THING = "thing"
+SENSES = ["OW-1", "OW-2", "I2C-8"]
+CASES = 200
+
+CONFIGS = [
+    [{"name": "I2C-8-scaled", "formula": "scale", "from": "I2C-8", "from_low": 0, "from_high": 1024, "to_low": 0, "to_high": 100}],
+    [{"name": "I2C-8-decorrelated", "formula": "decorrelate", "from": "I2C-8-scaled", "correlated": "OW-1", "adjustment": -30, "scale": 6},
+        {"name": "I2C-8-scaled", "formula": "scale", "from": "I2C-8", "from_low": 0, "from_high": 1024, "to_low": 0, "to_high": 100}],
+    [{"name": "OW-average", "formula": "average", "from": ["OW-1", "OW-2"]}],
+    [{"name": "OW-average", "formula": "average", "from": ["OW-1", "other:OW-3"]}],
+    [{"name": "cum-average", "formula": "cum_average", "from": "OW-1"}],
+    [{"name": "cum-average", "formula": "cum_average", "from": "OW-1", "window": 5}],
+    [{"name": "cum-average", "formula": "cum_average", "from": "OW-2", "window": 3, "reset_at": "01:00"}],
+    [{"name": "sum", "formula": "sum", "from": "OW-1", "reset_at": "20:00"}],
+    [{"name": "sum", "formula": "sum", "from": "OW-2"}, {"name": "sum-average", "formula": "cum_average", "from": "sum", "window": 4, "reset_at": "12:30"}],
+    [{"name": "window", "formula": "window_mean", "from": "OW-1", "minutes": 120}],
+    [{"name": "window", "formula": "window_max", "from": "OW-2", "minutes": 600}, {"name": "window-scaled", "formula": "scale", "from": "window", "from_low": 0, "from_high": 10, "to_low": 0, "to_high": 1}],
+    [{"name": "window", "formula": "ema", "from": "I2C-8", "minutes": 30}],
+]
+
+def random_history(rng, start):
+    history = []
+    time = start
+    for _ in range(rng.randint(1, 60)):
+        time += timedelta(minutes=rng.choice([1, 5, 30, 90, 360, 900]), seconds=rng.randint(0, 59))
+        senses = {key: {"value": round(rng.uniform(-10, 1000), 2)} for key in SENSES if rng.random() > 0.15}
+        history.append({"state": {"senses": senses}, "timestamp_utc": db_driver.timestamp(time)})
+    return history
+
+def random_old_enchanted(rng, start):
+    if rng.random() < 0.3:
+        return {}
+    count = rng.randint(1, 8)
+    senses = {name: {"value": rng.uniform(0, 100), "count": count} for name in ["cum-average", "sum", "sum-average"] if rng.random() > 0.3}
+    return {"state": {"senses": senses}, "timestamp_utc": db_driver.timestamp(start - timedelta(minutes=rng.randint(1, 2000)))}
+
+class TestBatchEnchanter(unittest.TestCase):
+    def setUp(self):
+        self.temp_directory = TemporaryDirectory()
+        self.addCleanup(self.temp_directory.cleanup)
+        db_driver.prepare_test_directory(Path(self.temp_directory.name))
+        (Path(self.temp_directory.name) / 'db' / THING).mkdir()
+        (Path(self.temp_directory.name) / 'db' / 'other').mkdir()
+        self.enchanter = enchanter.Enchanter(self.temp_directory.name, watch=False)
+
+    def test_matches_enchanter(self):
+        rng = random.Random(2018)
+        for case in range(CASES):
+            config = rng.choice(CONFIGS)
+            start = datetime(2018, 3, 1) + timedelta(minutes=rng.randint(0, 3000))
+            history = random_history(rng, start)
+            old_enchanted = random_old_enchanted(rng, start)
+            other = {"OW-3": rng.uniform(0, 30)} if rng.random() > 0.2 else {}
+            with self.subTest(case=case, config=config):
+                self.enchanter.snapshot = {"other": other}
+
+                expected = self.when_enchanting_one_by_one(history, config, old_enchanted)
+                batch = batch_enchanter.enchant_history(history, config, old_enchanted=old_enchanted, other_senses={"other:" + key: value for key, value in other.items()})
+
+                self.then_same_formula_senses(config, expected, batch)
+
+    def test_windowed_average_of_constant_stays_constant(self):
+        config = [{"name": "cum-average", "formula": "cum_average", "from": "OW-1", "window": 3}]
+        start = datetime(2018, 3, 1)
+        history = [{"state": {"senses": {"OW-1": 20}}, "timestamp_utc": db_driver.timestamp(start + timedelta(minutes=i))} for i in range(10)]
+
+        values, counts = batch_enchanter.enchant_arrays(history, config)["cum-average"]
+
+        np.testing.assert_allclose(values, 20)
+        self.assertEqual([1, 2] + [3] * 8, counts.tolist())
+
+    def test_missing_sense_restarts_sum(self):
+        config = [{"name": "sum", "formula": "sum", "from": "OW-1"}]
+        start = datetime(2018, 3, 1)
+        readings = [1, 2, None, 3, 4]
+        history = [{"state": {"senses": {} if value is None else {"OW-1": value}}, "timestamp_utc": db_driver.timestamp(start + timedelta(minutes=i))} for i, value in enumerate(readings)]
+
+        values, counts = batch_enchanter.enchant_arrays(history, config)["sum"]
+
+        self.assertEqual("[1.0, 3.0, nan, 3.0, 7.0]", str(values.tolist()))
+        self.assertEqual([1, 2, 0, 1, 2], counts.tolist())
+
+    def when_enchanting_one_by_one(self, history, config, old_enchanted):
+        enchanted_history = []
+        old = old_enchanted
+        for reported in history:
+            old = self.enchanter.enchant(THING, reported=db_driver.copy_json(reported), config=config, alias=False, old_enchanted=old)
+            enchanted_history.append(old)
+        return enchanted_history
+
+    def then_same_formula_senses(self, config, expected, batch):
+        self.assertEqual(len(expected), len(batch))
+        names = [formula["name"] for formula in config]
+        for expected_state, batch_state in zip(expected, batch):
+            expected_senses = expected_state["state"]["senses"]
+            batch_senses = batch_state["state"]["senses"]
+            for name in names:
+                self.assertEqual(name in expected_senses, name in batch_senses, name)
+                if name not in expected_senses:
+                    continue
+                self.assertAlmostEqual(enchanter.get_value(expected_senses[name]), enchanter.get_value(batch_senses[name]), places=6)
+                if isinstance(expected_senses[name], dict) and "count" in expected_senses[name]:
+                    self.assertEqual(expected_senses[name]["count"], batch_senses[name]["count"])
@@ -5,7 +5,13 @@ from tempfile import TemporaryDirectory
 from datetime import date, datetime, timedelta
 from zipfile import ZipFile, ZIP_DEFLATED
 import json
+import os
+import time
 import state_processor
+import series
+import rollups
+
+import numpy as np
 
 THING="thing"
 BASE_STATE = '{"config": %s}'
@@ -66,6 +72,14 @@ class TestDatabaseDriver(unittest.TestCase):
         with p.open('w', encoding='utf-8') as f:
             f.write(value)
 
+    # cached reads only trust an mtime once it is a second old
+    def given_settled_state(self, state, value):
+        self.given_state(state, value)
+        p = self.db.directory / THING / state
+        p = p.with_suffix('.json')
+        a_minute_ago = time.time() - 60
+        os.utime(str(p), (a_minute_ago, a_minute_ago))
+
     def when_updating_reported(self, value):
         self.db.update('reported', THING, json.loads(value)) 
 
@@ -143,7 +157,7 @@ class TestDatabaseDriverUpdate(TestDatabaseDriver):
 
         self.then_state_exists("reported", FORMAT % JSN % 2)
 
-    def test_update_reported_deletes_graph(self):
+    def test_update_reported_keeps_graph(self):
         self.given_thing()
         self.given_state("reported", BASE_STATE % '{}')
         self.given_graph()
@@ -151,7 +165,7 @@ class TestDatabaseDriverUpdate(TestDatabaseDriver):
 
         self.when_updating_reported(JSN % 1)
 
-        self.then_no_graph()
+        self.then_graphs_kept()
 
     def test_update_desired_resolves_alias(self):
         aliased_thing = "aliased-%s" % THING
@@ -190,18 +204,12 @@ class TestDatabaseDriverUpdate(TestDatabaseDriver):
     def then_modified(self, expected):
         self.assertEqual(expected, self.db.last_modified())
 
-    def then_no_graph(self):
+    def then_graphs_kept(self):
         p = self.db.directory / THING / "graph.png"
-        self.assertFalse(p.exists())
+        self.assertTrue(p.exists())
 
         p = self.db.directory / THING / "graph-7.png"
-        self.assertFalse(p.exists())
-
-        p = self.db.directory / THING / "graph-31.png"
-        self.assertFalse(p.exists())
-
-        p = self.db.directory / THING / "graph-366.png"
-        self.assertFalse(p.exists())
+        self.assertTrue(p.exists())
 
     def then_one_thing(self):
         p = self.db.directory
@@ -338,6 +346,80 @@ class TestDatabaseDriverGetDelta(TestDatabaseDriver):
         self.when_getting_delta()
 
 
+class TestDatabaseDriverDeltaCache(TestDatabaseDriver):
+    def setUp(self):
+        super().setUp()
+        self.computed = 0
+        compute_delta = self.db._compute_delta
+        def counting_compute_delta(thing):
+            self.computed += 1
+            return compute_delta(thing)
+        self.db._compute_delta = counting_compute_delta
+
+    def test_get_delta_is_cached(self):
+        self.given_reported_desired('{"sleep": 1}', '{"sleep": 2}')
+
+        self.when_getting_delta()
+        self.when_getting_delta()
+
+        self.then_delta_is('{"sleep": 2}')
+        self.then_computed(1)
+
+    def test_get_delta_returns_copy(self):
+        self.given_reported_desired('{"sleep": 1}', '{"sleep": 2}')
+
+        self.when_getting_delta()
+        self.delta['t'] = 1
+        self.when_getting_delta()
+
+        self.then_delta_is('{"sleep": 2}')
+
+    def test_reported_with_same_config_keeps_delta(self):
+        self.given_reported_desired('{"sleep": 1}', '{"sleep": 2}')
+        self.when_getting_delta()
+
+        self.when_updating_reported(BASE_STATE % '{"sleep": 1}')
+        self.when_getting_delta()
+
+        self.then_delta_is('{"sleep": 2}')
+        self.then_computed(1)
+
+    def test_reported_with_new_config_recomputes_delta(self):
+        self.given_reported_desired('{"sleep": 1}', '{"sleep": 2}')
+        self.when_getting_delta()
+
+        self.when_updating_reported(BASE_STATE % '{"sleep": 2}')
+        self.when_getting_delta()
+
+        self.then_delta_is('{}')
+        self.then_computed(2)
+
+    def test_desired_change_recomputes_delta(self):
+        self.given_reported_desired('{"sleep": 1}', '{"sleep": 2}')
+        self.when_getting_delta()
+
+        self.when_updating_desired('{"sleep": 3}')
+        self.when_getting_delta()
+
+        self.then_delta_is('{"sleep": 3}')
+
+    def test_external_desired_change_recomputes_delta(self):
+        self.given_reported_desired('{"sleep": 1}', '{"sleep": 2}')
+        self.when_getting_delta()
+
+        self.given_settled_state("desired", '{"sleep": 3}')
+        self.when_getting_delta()
+
+        self.then_delta_is('{"sleep": 3}')
+
+    def given_reported_desired(self, reported, desired):
+        self.given_thing()
+        self.given_state("reported", FORMAT % BASE_STATE % reported)
+        self.given_settled_state("desired", desired)
+
+    def then_computed(self, times):
+        self.assertEqual(times, self.computed)
+
 class TestDatabaseDriverHistory(TestDatabaseDriver): 
     def test_update_stores_history(self):
         self.given_thing()
@@ -366,6 +448,7 @@ class TestDatabaseDriverHistory(TestDatabaseDriver):
         self.given_history("reported", JSN % "oldest", day=two_days_ago)
         self.given_history("reported", JSN % "older", day=yesterday)
         self.when_updating_reported(JSN % "new")
+        self.when_archiving()
 
         self.then_two_histories("reported")
         self.then_history_exists("reported", JSN % "older", day=yesterday)
@@ -385,6 +468,7 @@ class TestDatabaseDriverHistory(TestDatabaseDriver):
         self.given_history("reported", JSN % "oldest", day=last_week)
         self.given_history("reported", JSN % "older", day=yesterday)
         self.when_updating_reported(JSN % "new")
+        self.when_archiving()
 
         self.then_two_histories("reported")
         self.then_history_exists("reported", JSN % "older", day=yesterday)
@@ -402,6 +486,7 @@ class TestDatabaseDriverHistory(TestDatabaseDriver):
         self.given_history("reported", "%s\n%s" % (BROKEN_JSN % "oldest-broken", JSN % "oldest"), day=last_week)
         self.given_history("reported", JSN % "older", day=yesterday)
         self.when_updating_reported(JSN % "new")
+        self.when_archiving()
 
         self.then_two_histories("reported")
         self.then_history_exists("reported", JSN % "older", day=yesterday)
@@ -422,10 +507,33 @@ class TestDatabaseDriverHistory(TestDatabaseDriver):
         self.given_archive("reported", JSN % "archive", day=three_days_ago)
 
         self.when_updating_reported(JSN % "new")
+        self.when_archiving()
 
         self.then_archive_exists("reported", JSN % "archive", day=three_days_ago)
         self.then_archive_exists("reported", JSN % "oldest", day=two_days_ago)
 
+    def test_update_does_not_archive(self):
+        today = date.today()
+        two_days_ago = today - timedelta(days=2)
+
+        self.given_thing()
+        self.given_state("reported", JSN % "old")
+        self.given_history("reported", JSN % "oldest", day=two_days_ago)
+
+        self.when_updating_reported(JSN % "new")
+
+        self.then_history_exists("reported", JSN % "oldest", day=two_days_ago)
+
+    def test_archive_uses_year_of_day(self):
+        last_year = date.today() - timedelta(days=366)
+
+        self.given_thing()
+        self.given_history("reported", JSN % "oldest", day=last_year)
+
+        self.when_archiving()
+
+        self.then_archive_exists("reported", JSN % "oldest", day=last_year)
+
     def test_load_history(self):
         today = date.today()
         yesterday = today - timedelta(days=1)
@@ -505,6 +613,62 @@ class TestDatabaseDriverHistory(TestDatabaseDriver):
 
         self.then_history_values_are([1, 2, 3])
 
+    def test_load_history_reads_day_not_archived_yet(self):
+        today = date.today()
+        two_days_ago = today - timedelta(days=2)
+        last_week = today - timedelta(days=7)
+
+        today_timestamp = datetime.utcnow().isoformat(sep=' ')
+        two_days_ago_timestamp = (datetime.utcnow() - timedelta(days=2)).isoformat(sep=' ')
+        last_week_timestamp = (datetime.utcnow() - timedelta(days=7)).isoformat(sep=' ')
+
+        self.given_thing()
+
+        self.given_state("reported", FORMAT_TS % (JSN % 3, today_timestamp))
+        self.given_history("reported", FORMAT_TS % (JSN % 2, two_days_ago_timestamp), day = two_days_ago)
+        self.given_history("reported", FORMAT_TS % (JSN % 1, last_week_timestamp), day = last_week)
+
+        self.when_loading_reported_history()
+
+        self.then_history_values_are([1, 2, 3])
+
+    def test_append_history_writes_offset_index(self):
+        self.given_thing()
+        self.db.history_index_bytes = 100
+
+        self.when_appending_history_every_minute(30)
+
+        self.then_history_index_entries_between(5, 30)
+
+    def test_load_history_since_hours_seeks_with_index(self):
+        self.given_thing()
+        self.db.history_index_bytes = 100
+
+        self.when_appending_history_every_minute(300)
+        self.when_loading_reported_history(since_days=0, since_hours=1)
+
+        self.then_history_values_are(list(range(240, 300)))
+        self.then_history_offset_skips_old_lines(timedelta(hours=1))
+
+    def test_load_history_since_hours_without_index(self):
+        self.given_thing()
+
+        self.when_appending_history_every_minute(100)
+        self.given_no_history_index()
+        self.when_loading_reported_history(since_days=0, since_hours=1)
+
+        self.then_history_values_are(list(range(40, 100)))
+
+    def test_archive_removes_history_index(self):
+        last_week = date.today() - timedelta(days=7)
+        self.given_thing()
+        self.given_history("reported", JSN % "oldest", day=last_week)
+        self.given_history_index(day=last_week)
+
+        self.when_archiving()
+
+        self.then_no_history_index(day=last_week)
+
     def test_update_desired_adds_history_timestamp(self):
         self.given_thing()
         self.given_state("desired", JSN % 1)
@@ -537,6 +701,40 @@ class TestDatabaseDriverHistory(TestDatabaseDriver):
             arcname = '%s.%s.txt' % (state, suffix)
             zf.writestr(arcname, value + '\n')
 
+    def given_history_index(self, day):
+        p = self.db.directory / THING / "history" / ("reported.%s.idx" % day.isoformat())
+        with p.open('w', encoding='utf-8') as f:
+            f.write('%s\t0\n' % db_driver.timestamp(datetime.utcnow()))
+
+    def given_no_history_index(self):
+        self.history_index_path().unlink()
+
+    def when_appending_history_every_minute(self, count):
+        # keep it within today so that the history is in a single file
+        start = max(datetime.utcnow() - timedelta(minutes=count, seconds=-30), datetime.combine(date.today(), datetime.min.time()))
+        self.history_start = start
+        for minute in range(count):
+            time = start + timedelta(minutes=minute)
+            self.db._append_history(THING, 'reported', json.loads(FORMAT_TS % (JSN % minute, db_driver.timestamp(time))))
+
+    def history_index_path(self, day=date.today()):
+        return self.db.directory / THING / "history" / ("reported.%s.idx" % day.isoformat())
+
+    def then_history_index_entries_between(self, at_least, at_most):
+        entries = db_driver.read_history_index(self.history_index_path())
+        self.assertTrue(at_least <= len(entries) <= at_most)
+        self.assertEqual(0, entries[0][1])
+
+    def then_history_offset_skips_old_lines(self, before):
+        offset = db_driver.history_offset(self.history_index_path(), datetime.utcnow() - before)
+        self.assertTrue(offset > 0)
+
+    def then_no_history_index(self, day):
+        self.assertFalse(self.history_index_path(day).exists())
+
+    def when_archiving(self):
+        self.db.archive_histories(THING)
+
     def when_loading_reported_history(self, since_days=366, since_hours=0):
         self.history = self.db.load_history(THING, 'reported', since_days=since_days, since_hours=since_hours)
 
@@ -603,6 +801,320 @@ class TestDatabaseDriverStateProcessor(TestDatabaseDriver):
 
         self.then_delta_is(compact_to)
 
+class TestDatabaseDriverSeries(TestDatabaseDriver):
+    def test_update_reported_appends_series(self):
+        self.given_thing()
+
+        self.when_updating_reported('{"senses": {"OW-1": {"value": 21.5}}}')
+        self.when_updating_reported('{"senses": {"OW-1": {"value": 22.5}}}')
+
+        self.when_loading_series("OW-1")
+
+        self.then_series_values_are([21.5, 22.5])
+
+    def test_series_marks_wrong_as_nan(self):
+        self.given_thing()
+
+        self.when_updating_reported('{"senses": {"OW-1": "w85"}}')
+
+        self.when_loading_series("OW-1")
+
+        self.then_series_values_are(["nan"])
+
+    def test_series_stores_writes(self):
+        self.given_thing()
+
+        self.when_updating_reported('{"write": {"4": 1}}')
+
+        self.when_loading_series("4", kind="write")
+
+        self.then_series_values_are([1])
+
+    def test_series_since_hours(self):
+        self.given_thing()
+        self.when_updating_reported_at('{"senses": {"OW-1": 1}}', datetime.utcnow() - timedelta(hours=2))
+        self.when_updating_reported_at('{"senses": {"OW-1": 2}}', datetime.utcnow())
+
+        self.when_loading_series("OW-1", since_days=0, since_hours=1)
+
+        self.then_series_values_are([2])
+
+    def test_series_ignores_partial_record(self):
+        self.given_thing()
+        self.when_updating_reported('{"senses": {"OW-1": 1}}')
+        self.given_partial_series_record("OW-1")
+
+        self.when_loading_series("OW-1")
+
+        self.then_series_values_are([1])
+
+    def test_series_append_after_partial_record(self):
+        self.given_thing()
+        self.when_updating_reported('{"senses": {"OW-1": 1}}')
+        self.given_partial_series_record("OW-1")
+
+        self.when_updating_reported('{"senses": {"OW-1": 2}}')
+        self.when_updating_reported('{"senses": {"OW-1": 3}}')
+        self.when_loading_series("OW-1")
+
+        self.then_series_values_are([1, 2, 3])
+        self.then_series_times_are_recent()
+
+    def test_series_missing(self):
+        self.given_thing()
+
+        self.when_loading_series("OW-1")
+
+        self.then_series_values_are([])
+
+    def test_series_keys(self):
+        self.given_thing()
+
+        self.when_updating_reported('{"senses": {"OW-1": 1, "A0": 2, "time": "1:30"}}')
+
+        self.assertEqual(["A0", "OW-1"], self.db.series_keys(THING))
+
+    def given_partial_series_record(self, key):
+        p = series.series_path(self.db.directory / THING, "reported", "senses", key)
+        with p.open('ab') as f:
+            f.write(b'\x00' * 3)
+
+    def when_updating_reported_at(self, value, time):
+        self.db._update_reported(THING, json.loads(value), time)
+
+    def when_loading_series(self, key, kind="senses", since_days=1, since_hours=0):
+        self.times, self.values = self.db.load_series(THING, key, kind=kind, since_days=since_days, since_hours=since_hours)
+
+    def then_series_times_are_recent(self):
+        a_day_ago = series.to_datetime64(datetime.utcnow() - timedelta(days=1))
+        now = series.to_datetime64(datetime.utcnow())
+        for time in self.times:
+            self.assertTrue(a_day_ago < time <= now, time)
+
+    def then_series_values_are(self, values):
+        self.assertEqual(len(self.times), len(values))
+        self.assertEqual(list(map(str, map(float, self.values))), list(map(str, map(float, values))))
+
+class TestDatabaseDriverRollups(TestDatabaseDriver):
+    def test_update_reported_rolls_up_bucket(self):
+        self.given_thing()
+        start = datetime(2018, 3, 1, 12, 0, 0)
+
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}}', start + timedelta(minutes=1))
+        self.when_updating_reported_at('{"senses": {"OW-1": 24}}', start + timedelta(minutes=2))
+        self.when_updating_reported_at('{"senses": {"OW-1": 22}}', start + timedelta(minutes=3))
+
+        self.when_loading_rollups("OW-1", 300)
+
+        self.then_rollups_are([(start, 3, 20, 24, 22, 22)])
+
+    def test_update_reported_appends_bucket(self):
+        self.given_thing()
+        start = datetime(2018, 3, 1, 12, 0, 0)
+
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}}', start)
+        self.when_updating_reported_at('{"senses": {"OW-1": 24}}', start + timedelta(minutes=6))
+
+        self.when_loading_rollups("OW-1", 300)
+
+        self.then_rollups_are([(start, 1, 20, 20, 20, 20), (start + timedelta(minutes=5), 1, 24, 24, 24, 24)])
+
+    def test_update_reported_late_report_updates_past_bucket(self):
+        self.given_thing()
+        start = datetime(2018, 3, 1, 12, 0, 0)
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}}', start)
+        self.when_updating_reported_at('{"senses": {"OW-1": 24}}', start + timedelta(minutes=10))
+
+        self.when_updating_reported_at('{"senses": {"OW-1": 22}}', start + timedelta(minutes=1))
+        self.when_updating_reported_at('{"senses": {"OW-1": 23}}', start + timedelta(minutes=6))
+
+        self.when_loading_rollups("OW-1", 300)
+
+        self.then_rollups_are([
+            (start, 2, 20, 22, 21, 22),
+            (start + timedelta(minutes=5), 1, 23, 23, 23, 23),
+            (start + timedelta(minutes=10), 1, 24, 24, 24, 24)])
+
+    def test_rollup_ignores_wrong_values(self):
+        self.given_thing()
+        start = datetime(2018, 3, 1, 12, 0, 0)
+
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}}', start)
+        self.when_updating_reported_at('{"senses": {"OW-1": "w85"}}', start + timedelta(minutes=1))
+
+        self.when_loading_rollups("OW-1", 300)
+
+        self.then_rollups_are([(start, 1, 20, 20, 20, "nan")])
+
+    def test_built_rollups_match_updated(self):
+        self.given_thing()
+        start = datetime(2018, 3, 1, 12, 0, 0)
+        times = [start + timedelta(minutes=7 * i) for i in range(30)]
+        values = [float(i % 11) if i % 5 else float('nan') for i in range(30)]
+        for time, value in zip(times, values):
+            self.when_updating_reported_at('{"senses": {"OW-1": %s}}' % ('"w1"' if value != value else value), time)
+
+        for resolution in rollups.ROLLUP_RESOLUTIONS:
+            self.when_loading_rollups("OW-1", resolution)
+            built = rollups.build(np.array(times, dtype='datetime64[us]'), values, resolution)
+            self.assertEqual(built.tobytes(), np.asarray(self.rollups).tobytes())
+
+    def test_rollup_history_chooses_coarsest_resolution(self):
+        self.given_thing()
+        now = datetime.utcnow()
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}, "write": {"4": 0}}', now - timedelta(days=8))
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}, "write": {"4": 1}}', now - timedelta(hours=1, minutes=10))
+        self.when_updating_reported_at('{"senses": {"OW-1": 24}, "write": {"4": 0}}', now - timedelta(hours=1, minutes=9))
+
+        history = self.db.load_rollup_history(THING, since_days=7, points=100)
+
+        self.assertEqual(1, len(history))
+        self.assertEqual({"senses": {"OW-1": {"value": 22}}, "write": {"4": 1}}, history[0]["state"])
+        bucket = rollups.bucket_time(now - timedelta(hours=1, minutes=10), 3600)
+        self.assertEqual(db_driver.timestamp(bucket.astype(datetime)), history[0]["timestamp_utc"])
+
+    def test_rollup_history_needs_long_span(self):
+        self.given_thing()
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}}', datetime.utcnow() - timedelta(days=2))
+
+        self.assertIsNone(self.db.load_rollup_history(THING, since_days=1, points=1000))
+
+    def test_rollup_history_needs_rollups_since(self):
+        self.given_thing()
+        self.when_updating_reported_at('{"senses": {"OW-1": 20}}', datetime.utcnow() - timedelta(days=2))
+
+        self.assertIsNone(self.db.load_rollup_history(THING, since_days=7, points=100))
+
+    def when_updating_reported_at(self, value, time):
+        self.db._update_reported(THING, json.loads(value), time)
+
+    def when_loading_rollups(self, key, resolution):
+        path = rollups.rollup_path(self.db.directory / THING, "reported", "senses", key, resolution)
+        self.rollups = rollups.load(path)
+
+    def then_rollups_are(self, expected):
+        actual = [(r['time'].astype(datetime), int(r['count']), float(r['min']), float(r['max']), float(rollups.mean(r)), str(float(r['last']))) for r in self.rollups]
+        expected = [(time, count, float(lowest), float(highest), float(mean), str(float(last))) for time, count, lowest, highest, mean, last in expected]
+        self.assertEqual(expected, actual)
+
+class TestDatabaseDriverEnchanted(TestDatabaseDriver):
+    def test_update_enchanted_keeps_history(self):
+        self.given_thing()
+        a_minute_ago = datetime.utcnow() - timedelta(minutes=1)
+
+        self.when_updating_enchanted({"senses": {"OW-1": 1, "OW-1-scaled": 10}}, a_minute_ago)
+        self.when_updating_enchanted({"senses": {"OW-1": 2, "OW-1-scaled": 20}}, datetime.utcnow())
+
+        history = self.db.load_history(THING, 'enchanted')
+        self.assertEqual([10, 20], [state['state']['senses']['OW-1-scaled'] for state in history])
+        _, values = self.db.load_series(THING, 'OW-1-scaled', state_name='enchanted')
+        self.assertEqual([10, 20], list(values))
+
+    def test_update_enchanted_same_report_replaces_state(self):
+        self.given_thing()
+        n = datetime.utcnow()
+
+        self.when_updating_enchanted({"senses": {"OW-1-scaled": 10}}, n)
+        self.when_updating_enchanted({"senses": {"OW-1-scaled": 11}}, n)
+
+        history = self.db.load_history(THING, 'enchanted')
+        self.assertEqual([11], [state['state']['senses']['OW-1-scaled'] for state in history])
+        _, values = self.db.load_series(THING, 'OW-1-scaled', state_name='enchanted')
+        self.assertEqual([10], list(values))
+
+    def when_updating_enchanted(self, state, time):
+        self.db._update_enchanted(THING, {"state": state, "timestamp_utc": db_driver.timestamp(time)})
+
+class TestDatabaseDriverStateCache(TestDatabaseDriver):
+    def test_load_state_hits_cache(self):
+        self.given_thing()
+        self.given_settled_state("desired", JSN % 1)
+
+        self.when_loading_state("desired")
+        self.when_loading_state("desired")
+
+        self.then_loaded_value(1)
+        self.then_cache_stats(hits=1, misses=1)
+
+    def test_load_state_sees_external_change(self):
+        self.given_thing()
+        self.given_settled_state("desired", JSN % 1)
+        self.when_loading_state("desired")
+
+        self.given_settled_state("desired", JSN % 22)
+        self.when_loading_state("desired")
+
+        self.then_loaded_value(22)
+
+    def test_load_state_sees_same_size_change(self):
+        self.given_thing()
+        self.given_settled_state("desired", JSN % 1)
+        self.when_loading_state("desired")
+
+        self.given_settled_state("desired", JSN % 2)
+        self.given_state_modified_later("desired")
+        self.when_loading_state("desired")
+
+        self.then_loaded_value(2)
+
+    def test_load_state_returns_copy(self):
+        self.given_thing()
+        self.given_settled_state("desired", JSN % 1)
+        self.when_loading_state("desired")
+
+        self.loaded['value'] = 'changed'
+        self.when_loading_state("desired")
+
+        self.then_loaded_value(1)
+
+    def test_update_invalidates_cache(self):
+        self.given_thing()
+        self.given_settled_state("desired", JSN % 1)
+        self.when_loading_state("desired")
+
+        self.when_updating_desired(JSN % 2)
+        self.when_loading_state("desired")
+
+        self.then_loaded_value(2)
+
+    def test_load_state_does_not_cache_recent_change(self):
+        self.given_thing()
+        self.given_state("desired", JSN % 1)
+
+        self.when_loading_state("desired")
+        self.when_loading_state("desired")
+
+        self.then_cache_stats(hits=0, misses=2)
+
+    def test_cache_is_bounded(self):
+        self.db.state_cache.max_size = 1
+        self.given_thing()
+        self.given_settled_state("desired", JSN % 1)
+        self.given_settled_state("displayables", JSN % 2)
+
+        self.when_loading_state("desired")
+        self.when_loading_state("displayables")
+        self.when_loading_state("desired")
+
+        self.then_cache_stats(hits=0, misses=3)
+
+    def given_state_modified_later(self, state):
+        p = self.db.directory / THING / state
+        p = p.with_suffix('.json')
+        stat = p.stat()
+        os.utime(str(p), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+    def when_loading_state(self, state):
+        self.loaded = self.db.load_state(THING, state)
+
+    def then_loaded_value(self, value):
+        self.assertEqual(str(value), self.loaded['value'])
+
+    def then_cache_stats(self, hits, misses):
+        stats = self.db.state_cache.stats()
+        self.assertEqual(hits, stats['hits'])
+        self.assertEqual(misses, stats['misses'])
+
 class TestDatabaseDriverThingAlias(TestDatabaseDriver):
     def test_update_thing_alias_deletes_old_alias(self):
         old_aliased_thing = "old-aliased-%s" % THING
@@ -619,6 +1131,62 @@ class TestDatabaseDriverThingAlias(TestDatabaseDriver):
         self.then_thing_alias_exists(new_aliased_thing)
         self.then_thing_alias_does_not_exist(old_aliased_thing)
 
+    def test_alias_thing(self):
+        self.given_thing()
+        self.given_aliased_thing("aliased")
+
+        self.assertEqual("aliased", self.db.alias_thing(THING))
+
+    def test_alias_thing_without_alias(self):
+        self.given_thing()
+
+        self.assertEqual(THING, self.db.alias_thing(THING))
+
+    def test_resolve_thing(self):
+        self.given_thing()
+        self.given_aliased_thing("aliased")
+
+        self.assertEqual(THING, self.db.resolve_thing("aliased"))
+
+    def test_resolve_unknown_thing(self):
+        self.given_thing()
+        self.given_aliased_thing("aliased")
+
+        self.assertIsNone(self.db.resolve_thing("unknown"))
+
+    def test_alias_index_sees_new_alias(self):
+        self.given_thing()
+        self.given_aliased_thing("aliased")
+        self.db.alias_thing(THING)
+
+        self.when_removing_alias("aliased")
+        self.given_aliased_thing("realiased")
+
+        self.assertEqual("realiased", self.db.alias_thing(THING))
+        self.assertIsNone(self.db.resolve_thing("aliased"))
+
+    def test_update_thing_alias_updates_index(self):
+        self.given_thing()
+        self.given_aliased_thing("aliased")
+        self.db.alias_thing(THING)
+
+        self.when_updating_thing_alias("realiased")
+
+        self.assertEqual("realiased", self.db.alias_thing(THING))
+        self.assertEqual(THING, self.db.resolve_thing("realiased"))
+        self.assertIsNone(self.db.resolve_thing("aliased"))
+
+    def test_update_thing_alias_creates_alias_directory(self):
+        self.given_thing()
+
+        self.when_updating_thing_alias("aliased")
+
+        self.then_thing_alias_exists("aliased")
+
+    def when_removing_alias(self, alias):
+        p = self.db.directory / "na" / alias
+        p.unlink()
+
     def when_updating_thing_alias(self, alias):
         self.db.update('thing-alias', THING, alias)
 
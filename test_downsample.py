@@ -0,0 +1,118 @@
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import downsample
+from db_driver import timestamp
+
+START = datetime(2017, 6, 26, 10, 0)
+
+def minutes(count):
+    return np.arange(count, dtype=float) * 60
+
+def state(minute, senses):
+    return {'timestamp_utc': timestamp(START + timedelta(minutes=minute)), 'state': {'senses': senses, 'write': {}}}
+
+class TestDownsample(unittest.TestCase):
+    def test_lttb_keeps_all_when_few(self):
+        self.when_reducing(downsample.lttb, minutes(5), [1, 2, 3, 4, 5], 10)
+
+        self.then_kept([0, 1, 2, 3, 4])
+
+    def test_lttb_keeps_first_last_and_count(self):
+        values = np.sin(np.arange(1000) / 30)
+
+        self.when_reducing(downsample.lttb, minutes(1000), values, 50)
+
+        self.assertEqual(50, len(self.kept))
+        self.then_kept_ends(1000)
+        self.then_sorted()
+
+    def test_lttb_keeps_spike(self):
+        values = np.zeros(1000)
+        values[437] = 100
+
+        self.when_reducing(downsample.lttb, minutes(1000), values, 20)
+
+        self.assertIn(437, self.kept)
+
+    def test_lttb_skips_wrong_values(self):
+        values = np.arange(100, dtype=float)
+        values[1::2] = np.nan
+
+        self.when_reducing(downsample.lttb, minutes(100), values, 10)
+
+        self.assertEqual(10, len(self.kept))
+        self.assertFalse(np.isnan(values[self.kept]).any())
+        self.assertEqual(98, self.kept[-1])
+
+    def test_min_max_keeps_extremes_of_each_bucket(self):
+        values = np.zeros(100)
+        values[10] = 5
+        values[11] = -5
+        values[60] = 7
+
+        self.when_reducing(downsample.min_max, minutes(100), values, 2)
+
+        # zeros tie for the lowest of the second bucket, the earliest is kept
+        self.then_kept([0, 10, 11, 50, 60, 99])
+
+    def test_min_max_buckets_by_time(self):
+        # a dense burst at the start should not take all the buckets
+        times = np.concatenate([np.arange(90, dtype=float), 1000 + np.arange(10, dtype=float) * 100])
+        values = np.arange(100, dtype=float)
+
+        self.when_reducing(downsample.min_max, times, values, 10)
+
+        self.assertTrue(set(range(90, 100)) <= set(self.kept))
+
+    def test_min_max_ignores_wrong_values(self):
+        values = np.array([np.nan, 1, 3, np.nan, 2, np.nan, 0, 4, np.nan, np.nan])
+
+        self.when_reducing(downsample.min_max, minutes(10), values, 2)
+
+        self.then_kept([0, 1, 2, 6, 7, 9])
+
+    def test_downsample_history_keeps_small_history(self):
+        history = [state(i, {'OW-1': {'value': i}}) for i in range(5)]
+
+        self.assertIs(history, downsample.downsample_history(history, 10))
+
+    def test_downsample_history_keeps_states_any_sense_needs(self):
+        history = [state(i, {'OW-1': {'value': 0}, 'A0': 0}) for i in range(500)]
+        history[100]['state']['senses']['OW-1'] = {'value': 50}
+        history[300]['state']['senses']['A0'] = -50
+        history[400]['state']['write']['4'] = 1
+
+        downsampled = downsample.downsample_history(history, 10)
+
+        self.assertLess(len(downsampled), 40)
+        for index in [0, 100, 300, 400, 499]:
+            self.assertIn(history[index], downsampled)
+        self.assertEqual(sorted(downsampled, key=lambda s: s['timestamp_utc']), downsampled)
+
+    def test_downsample_history_wrong_senses(self):
+        history = [state(i, {'OW-1': 'wrong' if i % 2 else i, 'time': '10:%02d' % (i % 60)}) for i in range(200)]
+
+        downsampled = downsample.downsample_history(history, 20)
+
+        # the points of the sense and the newest state, wrong as it is
+        self.assertEqual(21, len(downsampled))
+        self.assertEqual(history[-1], downsampled[-1])
+
+    def when_reducing(self, reducer, times, values, points):
+        self.kept = list(reducer(times, np.asarray(values, dtype=float), points))
+
+    def then_kept(self, expected):
+        self.assertEqual(sorted(expected), self.kept)
+
+    def then_kept_ends(self, count):
+        self.assertEqual(0, self.kept[0])
+        self.assertEqual(count - 1, self.kept[-1])
+
+    def then_sorted(self):
+        self.assertEqual(sorted(self.kept), self.kept)
+
+if __name__ == '__main__':
+    unittest.main()
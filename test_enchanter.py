@@ -3,6 +3,8 @@ import enchanter
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import json
+import math
+import os
 
 from db_driver import DatabaseDriver, timestamp
 from test_db_driver import timeless
@@ -26,6 +28,9 @@ CUM_AVERAGE_WINDOW_CONFIG = [{"name":"cum-average", "formula": "cum_average", "f
 
 SUM_RESET_CONFIG = [{"name":"sum", "formula": "sum", "from": "OW-1", "reset_at": "20:00"}]
 
+def window_config(formula, minutes=60):
+    return [{"name": "windowed", "formula": formula, "from": "OW-1", "minutes": minutes}]
+
 DISP = {"alias":"","color":"purple","position":"0,0","type":"number","plot":"yes","graph":"yes"}
 
 def colored(d, color):
@@ -68,11 +73,11 @@ class TestEnchanter(unittest.TestCase):
         thing_directory = self.db_directory / THING
         thing_directory.mkdir()
 
-        self.enchanter.start()
         self.config = {}
 
     def tearDown(self):
         self.enchanter.stop()
+        self.enchanter.join()
         self.tmp_directory.cleanup()
 
     def test_scale_up(self):
@@ -91,6 +96,7 @@ class TestEnchanter(unittest.TestCase):
         self.then_decorrelated(20)
 
     def test_enchants_on_reported_file_changed(self):
+        self.enchanter.start()
         reported = senses({"OW-1": {"value": 35}})
         self.when_updating_reported(reported)
 
@@ -98,6 +104,33 @@ class TestEnchanter(unittest.TestCase):
 
         self.then_state_exists('enchanted', {'state': reported})
 
+    def test_watching_enchants_before_polling_would(self):
+        self.enchanter.start()
+        reported = senses({"OW-1": {"value": 35}})
+        started = time.monotonic()
+        self.when_updating_reported(reported)
+
+        self.then_enchanted_within(0.5)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.then_state_exists('enchanted', {'state': reported})
+
+    def test_watching_enchants_new_thing(self):
+        self.enchanter.start()
+        self.when_updating_reported(senses({"OW-1": {"value": 35}}), thing=THING2)
+
+        self.then_enchanted_within(0.5, thing=THING2)
+
+    def test_polling_enchants_on_reported_file_changed(self):
+        self.enchanter = enchanter.Enchanter(self.tmp_directory.name, watch=False)
+        self.enchanter.start()
+        reported = senses({"OW-1": {"value": 35}})
+        self.when_updating_reported(reported)
+
+        self.then_enchanted_within(2)
+
+        self.then_state_exists('enchanted', {'state': reported})
+
     def test_first_enchant_creates_displayables(self):
         reported = senses({"1": 0})
         self.given_state("reported", state(reported))
@@ -294,6 +327,178 @@ class TestEnchanter(unittest.TestCase):
 
         self.then_enchanted(state(senses({'OW-1': 27, 'cum-average': {"value":26, "count": 2}})))
 
+    def test_window_max_forgets_values_older_than_window(self):
+        values = self.when_enchanting_reports(window_config("window_max"), [(0, 30), (10, 20), (50, 10), (65, 5)])
+
+        self.assertEqual([30, 30, 30, 20], values)
+
+    def test_window_min(self):
+        values = self.when_enchanting_reports(window_config("window_min"), [(0, 10), (10, 20), (50, 5), (70, 30)])
+
+        self.assertEqual([10, 10, 5, 5], values)
+
+    def test_window_mean_is_of_the_window_not_of_the_reports(self):
+        values = self.when_enchanting_reports(window_config("window_mean"), [(0, 10), (1, 10), (2, 10), (30, 20), (90, 30)])
+
+        self.assertEqual([10, 10, 10, 12.5, 30], values)
+
+    def test_ema_weighs_by_time(self):
+        values = self.when_enchanting_reports(window_config("ema"), [(0, 10), (60, 20), (61, 10)])
+
+        self.assertEqual(10, values[0])
+        self.assertAlmostEqual(10 + 10 * (1 - math.exp(-1)), values[1])
+        self.assertAlmostEqual(values[1] + (10 - values[1]) * (1 - math.exp(-1/60)), values[2])
+
+    def test_window_moves_on_without_values(self):
+        values = self.when_enchanting_reports(window_config("window_max"), [(0, 30), (30, None), (70, None), (80, 10)])
+
+        self.assertEqual([30, 30, None, 10], values)
+
+    def test_window_state_is_bounded(self):
+        # every ten seconds for two hours, falling so each is a maximum until it leaves the window
+        reports = [(index / 6, 1000 - index) for index in range(6 * 120)]
+
+        for formula in ("window_max", "window_mean"):
+            enchanted = self.when_enchanting_reports(window_config(formula, minutes=30), reports, values=False)
+            buckets = enchanted['state']['senses']['windowed'].get('extremes') or enchanted['state']['senses']['windowed']['sums']
+            self.assertEqual(enchanter.WINDOW_BUCKETS, len(buckets))
+
+    def test_compile_rejects_window_without_minutes(self):
+        self.then_compile_fails(window_config("window_mean", minutes=0), 'minutes')
+        self.then_compile_fails([{"name": "x", "formula": "ema", "from": "OW-1"}], 'minutes')
+
+    def test_enchant_orders_formulas_by_dependency(self):
+        self.given_config(DECORRELATE_CONFIG + SCALE_CONFIG)
+
+        reported_senses = {"I2C-8": {"value": 512}, "OW-1": {"value": 35}}
+        enchanted = senses(updated(reported_senses, {"I2C-8-scaled": 50, "I2C-8-decorrelated": 20}))
+
+        self.given_state("reported", state(senses(reported_senses)))
+        self.when_enchanting(alias=False)
+
+        self.then_enchanted(state(enchanted))
+
+    def test_compile_rejects_unknown_formula(self):
+        self.then_compile_fails([{"name": "x", "formula": "median", "from": "OW-1"}], 'median')
+
+    def test_compile_rejects_missing_parameter(self):
+        config = [dict(SCALE_CONFIG[0])]
+        config[0].pop('to_high')
+
+        self.then_compile_fails(config, 'to_high')
+
+    def test_compile_rejects_cycle(self):
+        config = [{"name": "a", "formula": "scale", "from": "b", "from_low": 0, "from_high": 1, "to_low": 0, "to_high": 2},
+                {"name": "b", "formula": "average", "from": ["a", "OW-1"]}]
+
+        self.then_compile_fails(config, 'a -> b -> a')
+
+    def test_compile_rejects_bad_reset_at(self):
+        self.then_compile_fails([dict(CUM_AVERAGE_RESET_CONFIG[0], reset_at="1am")], 'reset_at')
+
+    def test_enchant_without_formulas_when_config_has_errors(self):
+        self.given_config([{"name": "x", "formula": "median", "from": "OW-1"}])
+        self.given_state("reported", state(senses({"OW-1": 1})))
+
+        self.when_enchanting(alias=False)
+
+        self.then_enchanted(state(senses({"OW-1": 1})))
+
+    def test_enchant_recompiles_changed_config(self):
+        self.given_config(SCALE_CONFIG)
+        self.given_settled_config()
+        self.given_state("reported", state(senses({"I2C-8": 512})))
+        self.when_enchanting(alias=False)
+        self.given_state("enchanted", self.enchanted)
+
+        self.given_config([dict(SCALE_CONFIG[0], to_high=200)])
+        self.when_enchanting(alias=False)
+
+        self.then_enchanted(state(senses({"I2C-8": 512, "I2C-8-scaled": 100})))
+
+    def test_enchant_reuses_result_of_unchanged_inputs(self):
+        self.given_config(SCALE_CONFIG)
+        self.given_settled_config()
+        self.given_state("reported", state(senses({"I2C-8": 512})))
+        self.when_enchanting(alias=False)
+
+        # a result that could not have been calculated shows it was reused
+        self.given_state("enchanted", state(senses({"I2C-8": 512, "I2C-8-scaled": 49})))
+        self.when_enchanting(alias=False)
+        self.then_enchanted(state(senses({"I2C-8": 512, "I2C-8-scaled": 49})))
+
+        self.given_state("reported", state(senses({"I2C-8": 1024})))
+        self.when_enchanting(alias=False)
+        self.then_enchanted(state(senses({"I2C-8": 1024, "I2C-8-scaled": 100})))
+
+    def test_other_thing_senses_are_read_once(self):
+        self.given_config(SCALE_CONFIG + DECORRELATE_CONFIG_FROM_THING2)
+        self.given_state('enchanted', state(senses({'OW-1': 35})), thing=THING2)
+        self.given_state('reported', state(senses({'I2C-8': 512})))
+        self.when_enchanting(alias=False)
+
+        self.given_state('enchanted', state(senses({'OW-1': 40})), thing=THING2)
+        self.when_enchanting(alias=False)
+
+        self.then_enchanted(state(senses({'I2C-8': 512, 'I2C-8-scaled': 50, 'I2C-8-decorrelated': 20, '%s:OW-1' % THING2: 35})))
+
+    def test_dependency_order_puts_referenced_things_first(self):
+        self.given_state('enchanter', [{"name": "OW-average", "formula": "average", "from": ["OW-2", "%s:OW-1" % THING]}], thing=THING2)
+        self.given_state('enchanter', [], thing='a-thing')
+
+        order = self.enchanter.dependency_order([THING2, THING, 'a-thing'])
+
+        self.assertEqual(['a-thing', THING, THING2], order)
+
+    def test_pool_enchants_flagged_things(self):
+        pool_enchanter = self.given_pool_enchanter()
+        things = ['thing-%d' % i for i in range(8)]
+        for index, thing in enumerate(things):
+            self.given_state('enchanter', [], thing=thing)
+            self.given_state('reported', state(senses({'OW-1': index})), thing=thing)
+            self.given_flag(thing)
+
+        pool_enchanter.enchant_flagged()
+
+        for index, thing in enumerate(things):
+            self.then_state_exists('enchanted', state(senses({'OW-1': index})), thing=thing)
+
+    def test_pool_enchants_referenced_things_first(self):
+        pool_enchanter = self.given_pool_enchanter()
+        self.given_config(SCALE_CONFIG + DECORRELATE_CONFIG_FROM_THING2)
+        self.given_state('enchanter', [], thing=THING2)
+        self.given_state('enchanted', state(senses({'OW-1': 0})), thing=THING2)
+        self.given_state('reported', state(senses({'OW-1': 35})), thing=THING2)
+        self.given_state('reported', state(senses({'I2C-8': 512})))
+        self.given_flag(THING)
+        self.given_flag(THING2)
+
+        self.assertEqual([[THING2], [THING]], pool_enchanter.dependency_levels([THING, THING2]))
+        pool_enchanter.enchant_flagged()
+
+        enchanted = json.loads((self.db_directory / THING / 'enchanted.json').read_text(encoding='utf-8'))
+        self.assertEqual(20, enchanter.get_value(enchanted['state']['senses']['I2C-8-decorrelated']))
+
+    def test_pool_enchants_a_thing_one_at_a_time(self):
+        running = []
+        overlapped = []
+        def enchant_thing(thing):
+            if thing in running:
+                overlapped.append(thing)
+            running.append(thing)
+            time.sleep(0.05)
+            running.remove(thing)
+        pool = enchanter.EnchantPool(enchant_thing, workers=4, max_pending=2)
+        self.addCleanup(pool.shutdown)
+
+        first = pool.submit(THING)
+        time.sleep(0.01) # started
+        futures = [pool.submit(THING) for i in range(5)]
+
+        self.assertEqual(1, len(set(futures)))
+        futures[0].result()
+        first.result()
+        self.assertEqual([], overlapped)
 
     def given_state(self, state, value, thing=THING):
         thing_directory = self.db_directory / thing
@@ -304,30 +509,61 @@ class TestEnchanter(unittest.TestCase):
         with p.open('w', encoding='utf-8') as f:
             f.write(json.dumps(value))
 
+    # not started, so nothing else enchants the flagged things
+    def given_pool_enchanter(self):
+        pool_enchanter = enchanter.Enchanter(self.tmp_directory.name, watch=False, workers=4)
+        self.addCleanup(pool_enchanter.stop)
+        return pool_enchanter
+
+    def given_flag(self, thing):
+        (self.db_directory / thing / enchanter.SHOULD_ENCHANT_FLAG).touch()
+
     def given_config(self, config):
         p = self.db_directory / THING / "enchanter.json"
         
         with p.open('w', encoding='utf-8') as f:
             f.write(json.dumps(config))
 
+    # compiled formulas are only kept once enchanter.json is a second old
+    def given_settled_config(self):
+        p = self.db_directory / THING / "enchanter.json"
+        a_minute_ago = time.time() - 60
+        os.utime(str(p), (a_minute_ago, a_minute_ago))
+
     def given_alias(self, key, value):
         p = self.db_directory / THING / "displayables.json"
         
         with p.open('w', encoding='utf-8') as f:
             f.write(json.dumps({key : aliased(DISP, value)}))
 
+    def then_compile_fails(self, config, message):
+        with self.assertRaises(enchanter.FormulaError) as raised:
+            enchanter.compile_formulas(config)
+        self.assertIn(message, str(raised.exception))
+
     def when_calculating_average(self, values):
         self.average = enchanter.average(values)
 
     def when_calculating_cum_average(self, new, old, old_count):
         self.cum_average = enchanter.cum_average(new, old, old_count)
 
-    def when_updating_reported(self, reported):
-        self.db.update('reported', THING, reported)
+    def when_updating_reported(self, reported, thing=THING):
+        self.db.update('reported', thing, reported)
 
     def when_enchanting(self, thing=THING, alias=True):
         self.enchanted = self.enchanter.enchant(thing, alias=alias)
 
+    # reports are (minutes, OW-1 value or None), each enchanted on the one before
+    def when_enchanting_reports(self, config, reports, values=True):
+        start = datetime(2018, 3, 1, 12)
+        enchanted_values = []
+        enchanted = {}
+        for minutes, value in reports:
+            reported = state(senses({} if value is None else {'OW-1': value}), start + timedelta(minutes=minutes))
+            enchanted = self.enchanter.enchant(THING, reported=reported, config=config, alias=False, old_enchanted=enchanted)
+            enchanted_values.append(enchanter.get_value(enchanted['state']['senses'].get('windowed')))
+        return enchanted_values if values else enchanted
+
     def when_scaling(self, value, from_low, from_high, to_low, to_high):
         self.scaled = enchanter.scale(value, from_low, from_high, to_low, to_high)
 
@@ -346,8 +582,21 @@ class TestEnchanter(unittest.TestCase):
     def then_decorrelated(self, expected):
         self.assertEqual(expected, self.decorrelated)
 
-    def then_state_exists(self, state, expected_value):
-        p = self.db_directory / THING / state 
+    def then_enchanted_within(self, seconds, thing=THING):
+        enchanted = self.db_directory / thing / 'enchanted.json'
+        deadline = time.monotonic() + seconds
+        while not self.is_written(enchanted) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.is_written(enchanted))
+
+    def is_written(self, p):
+        try:
+            return 'state' in json.loads(p.read_text(encoding='utf-8'))
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def then_state_exists(self, state, expected_value, thing=THING):
+        p = self.db_directory / thing / state 
         p = p.with_suffix('.json')
         with p.open(encoding='utf-8') as f:
             contents = json.loads(f.read())
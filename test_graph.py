@@ -1,30 +1,22 @@
 import unittest
 import datetime
+import os
+import tempfile
+import threading
+import time
 
-from graph import subsample_history 
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
+import db_driver
+import graph
+from graph import max_staleness, cached_graph, single_flight
 
-def today():
-    return datetime.datetime.today()
 
-def today_midnight():
-    return datetime.datetime.combine(datetime.datetime.today(), datetime.time(0, 0))
-
-def yesterday_midnight():
-    return today_midnight() - datetime.timedelta(days=1)
-
-def yesterday():
-    return today() - datetime.timedelta(days=1)
-
-def two_days_ago():
-    return today() - datetime.timedelta(days=2)
-
-def state(timestamp, senses={}):
-    return {'timestamp_utc': timestamp.isoformat(sep=' '), 'senses': senses}
-
-def t(hour, date=today()):
-    time = datetime.time(hour, 0)
-    return datetime.datetime.combine(date, time)
+def image_bytes(image):
+    if isinstance(image, Path):
+        return image.read_bytes()
+    return image
 
 class TestGraph(unittest.TestCase):
     def setUp(self):
@@ -33,54 +25,317 @@ class TestGraph(unittest.TestCase):
     def tearDown(self):
         pass
     
-    def test_subsample_history_preserves_all(self):
-        full_history = [state(t(10)), state(t(11)), state(t(12))]
-        self.given_history(full_history)
+    def test_max_staleness_grows_with_since_days(self):
+        self.assertEqual(60, max_staleness(1))
+        self.assertEqual(5*60, max_staleness(7))
+        self.assertEqual(15*60, max_staleness(30))
+        self.assertEqual(60*60, max_staleness(1000))
+
+    def test_cached_graph_fresh(self):
+        self.given_graph(age=30)
+
+        self.when_loading_cached_graph(staleness=60)
+
+        self.then_cached_graph(self.image_location)
+
+    def test_cached_graph_stale(self):
+        self.given_graph(age=90)
+
+        self.when_loading_cached_graph(staleness=60)
+
+        self.then_cached_graph(None)
+
+    def test_cached_graph_missing(self):
+        self.given_no_graph()
+
+        self.when_loading_cached_graph(staleness=60)
+
+        self.then_cached_graph(None)
+
+    def test_single_flight_renders_once(self):
+        self.given_no_graph()
+
+        self.when_requesting_graph_concurrently(requests=4)
+
+        self.then_rendered_once()
+        self.then_coalesced(3)
+
+    def test_single_flight_serves_fresh_graph(self):
+        self.given_graph(age=0)
+
+        self.when_requesting_graph_concurrently(requests=2)
+
+        self.then_rendered(0)
+
+    def test_single_flight_serves_cached_graph_from_file(self):
+        self.given_graph(age=0)
+
+        self.when_requesting_graph_concurrently(requests=2)
+
+        self.then_served_from_cache()
+
+    def test_single_flight_links_static_image(self):
+        self.given_no_graph()
+        self.given_static_image()
+
+        self.when_requesting_graph_concurrently(requests=2)
+
+        self.then_rendered(1)
+        self.assertTrue(self.image_location.is_symlink())
+        self.assertEqual(b'no data', self.image_location.read_bytes())
+        self.assertEqual(set([b'no data']), set(map(image_bytes, self.served)))
+
+    def test_single_flight_renders_stale_graph(self):
+        self.given_graph(age=120)
+
+        self.when_requesting_graph_concurrently(requests=1)
+
+        self.then_rendered_once()
+
+    def given_graph(self, age):
+        self.given_no_graph()
+        self.image_location.write_bytes(b'png')
+        modified = time.time() - age
+        os.utime(str(self.image_location), (modified, modified))
+
+    def given_no_graph(self):
+        self.temp_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_directory.cleanup)
+        self.image_location = Path(self.temp_directory.name) / 'graph-1-median-3.png'
+
+    def given_static_image(self):
+        static_image = Path(self.temp_directory.name) / 'no-data.png'
+        static_image.write_bytes(b'no data')
+        self.rendered_image = static_image
+
+    def when_loading_cached_graph(self, staleness):
+        self.cached = cached_graph(str(self.image_location), staleness)
+
+    def when_requesting_graph_concurrently(self, requests):
+        self.rendered_image = getattr(self, 'rendered_image', b'rendered')
+        self.renders = 0
+        self.served = []
+        coalesced = graph.GRAPH_STATS['coalesced']
+        started = threading.Barrier(requests)
+
+        def render():
+            self.renders += 1
+            time.sleep(0.2) # long enough for the other requests to find the graph missing
+            return self.rendered_image
+
+        def request():
+            started.wait()
+            self.served.append(single_flight(str(self.image_location), 60, render))
+
+        threads = [threading.Thread(target=request) for _ in range(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.when_cache_written()
+
+        self.coalesced = graph.GRAPH_STATS['coalesced'] - coalesced
+
+    def when_cache_written(self):
+        with graph.GraphLock(str(self.image_location)):
+            pass
+
+    def then_rendered_once(self):
+        self.then_rendered(1)
+        self.assertEqual(set([b'rendered']), set(map(image_bytes, self.served)))
+        self.assertEqual(b'rendered', self.image_location.read_bytes())
+
+    def then_served_from_cache(self):
+        for served in self.served:
+            self.assertEqual(self.image_location, served)
+
+    def then_rendered(self, expected):
+        self.assertEqual(expected, self.renders)
+
+    def then_coalesced(self, expected):
+        self.assertEqual(expected, self.coalesced)
+
+    def then_cached_graph(self, expected):
+        self.assertEqual(expected, self.cached)
+
+THINGS = ['thing-%d' % i for i in range(4)]
+# a render takes a good part of a second on the server, so the soak only runs when asked,
+# e.g. GRAPH_SOAK_RENDERS=3000 python -m pytest test_graph.py -k soak
+SOAK_RENDERS = int(os.environ.get('GRAPH_SOAK_RENDERS', 0))
+SOAK_WARMUP_RENDERS = 50
+SOAK_SAMPLE_EVERY = 100
+SOAK_MAX_GROWTH = 8*1024*1024 # bytes of resident memory
+
+def resident_memory():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+DISPLAYABLES = '{"OW-1": {"alias": "", "color": "green", "position": "0,0", "type": "number", "plot": "yes", "graph": "yes"}}'
+
+class FormValue:
+    def __init__(self, value):
+        self.value = value
+
+def form(**fields):
+    return {name: FormValue(str(value)) for name, value in fields.items()}
+
+class TestGraphRendering(unittest.TestCase):
+    def setUp(self):
+        self.temp_directory = TemporaryDirectory()
+        self.addCleanup(self.temp_directory.cleanup)
+        temp_directory_path = Path(self.temp_directory.name)
+        db_driver.prepare_test_directory(temp_directory_path)
+        (temp_directory_path / 'view' / 'no-data.png').write_bytes(b'no data')
+        self.db = db_driver.DatabaseDriver(working_directory=self.temp_directory.name)
+
+    def test_render_no_data(self):
+        self.given_thing(THINGS[0], readings=0)
+
+        self.when_rendering_sequentially([THINGS[0]])
+
+        self.then_rendered_images({THINGS[0]: self.db.view / 'no-data.png'})
+
+    def test_concurrent_renders_match_sequential(self):
+        for index, thing in enumerate(THINGS):
+            self.given_thing(thing, readings=60, offset=index*5)
+
+        self.when_rendering_sequentially(THINGS)
+        sequential = self.rendered
+        self.when_rendering_concurrently(THINGS, renders_per_thing=2)
+
+        self.then_png_images(sequential)
+        self.then_rendered_images(sequential)
+        self.then_images_differ(sequential)
+
+    def test_concurrent_form_graphs_of_one_thing(self):
+        self.given_thing(THINGS[0], readings=60)
+        forms = [form(since=1, median=3, graphable="OW-1/value"), form(since=1, median=5, graphable="OW-1/value")] * 3
+
+        self.when_posting_graphs_sequentially(THINGS[0], forms)
+        sequential = self.posted
+        self.when_posting_graphs_concurrently(THINGS[0], forms)
+
+        self.then_png_images(dict(enumerate(sequential)))
+        self.assertNotEqual(sequential[0], sequential[1])
+        self.assertEqual(sequential, self.posted)
+        self.then_no_files_left(THINGS[0])
+
+    def test_render_reuses_cleared_figure(self):
+        self.given_thing(THINGS[0], readings=60)
+
+        first = self.render(THINGS[0])
+        figure = graph.figures.figure
+        second = self.render(THINGS[0])
+
+        self.assertIs(figure, graph.figures.figure)
+        self.assertEqual([], figure.axes)
+        self.assertEqual(first, second)
+
+    def test_render_long_graph_from_rollups(self):
+        self.given_enchanted(THINGS[0], days=8)
+        self.db.load_history = lambda *args, **kwargs: self.fail('long graphs read rollups')
+
+        image = graph.render_graph(self.db, THINGS[0], 7, 3, False, {})
+
+        self.then_png_images({THINGS[0]: image})
+
+    @unittest.skipUnless(SOAK_RENDERS, 'set GRAPH_SOAK_RENDERS to soak')
+    def test_soak_memory_stays_flat(self):
+        self.given_thing(THINGS[0], readings=60)
+
+        self.when_soaking(THINGS[0], SOAK_RENDERS)
+
+        self.then_memory_growth_below(SOAK_MAX_GROWTH)
+
+    def given_thing(self, thing, readings, offset=0):
+        thing_directory = self.db.directory / thing
+        thing_directory.mkdir()
+        (thing_directory / 'displayables.json').write_text(DISPLAYABLES, encoding='utf-8')
+        history_directory = thing_directory / 'history'
+        history_directory.mkdir()
+
+        # readings stay half a minute off the minute grid so both renders subsample the same points
+        start = datetime.datetime.utcnow() - datetime.timedelta(minutes=readings, seconds=-30)
+        lines = []
+        for i in range(readings):
+            reading_time = start + datetime.timedelta(minutes=i)
+            value = offset + 20 + (i % 7)
+            lines.append('{"state": {"senses": {"OW-1": {"value": %d}}}, "timestamp_utc": "%s"}' % (value, db_driver.timestamp(reading_time)))
+        history_file = history_directory / ('enchanted.%s.txt' % datetime.date.today().isoformat())
+        history_file.write_text(''.join(line + '\n' for line in lines), encoding='utf-8')
+
+    def given_enchanted(self, thing, days):
+        self.given_thing(thing, readings=0)
+        now = datetime.datetime.utcnow()
+        for hour in range(days * 24, -1, -2):
+            reading_time = now - datetime.timedelta(hours=hour)
+            self.db._update_enchanted(thing, {"state": {"senses": {"OW-1": {"value": 20 + hour % 7}}}, "timestamp_utc": db_driver.timestamp(reading_time)})
+
+    def render(self, thing):
+        return graph.render_graph(self.db, thing, 1, 3, False, {})
 
-        self.when_subsampling([(today_midnight(), 3)])
+    def when_rendering_sequentially(self, things):
+        self.rendered = {thing: self.render(thing) for thing in things}
 
-        self.then_sparse_history(full_history)
+    def when_soaking(self, thing, renders):
+        for _ in range(SOAK_WARMUP_RENDERS):
+            self.render(thing)
 
-    def test_subsample_history_simple(self):
-        today_history = [state(t(10)), state(t(11)), state(t(12))]
+        self.resident = [resident_memory()]
+        for index in range(1, renders + 1):
+            self.render(thing)
+            if index % SOAK_SAMPLE_EVERY == 0:
+                self.resident.append(resident_memory())
 
-        full_history = [state(t(10, yesterday())), state(t(11, yesterday())), state(t(12, yesterday()))]
-        full_history.extend(today_history)
-        self.given_history(full_history)
+    def then_memory_growth_below(self, limit):
+        growth = max(self.resident) - self.resident[0]
+        self.assertLess(growth, limit, self.resident)
 
-        self.when_subsampling([(today_midnight(), 3)])
+    def when_posting_graphs_sequentially(self, thing, forms):
+        self.posted = [graph.handle_graph(self.db, thing, formdata=formdata)[1] for formdata in forms]
 
-        expected = [full_history[0]]
-        expected.extend(today_history)
-        self.then_sparse_history(expected)
+    def when_posting_graphs_concurrently(self, thing, forms):
+        self.posted = [None] * len(forms)
+        started = threading.Barrier(len(forms))
 
-    def test_subsample_history_multiple_conditions(self):
-        today_history = [state(t(10)), state(t(11)), state(t(12))]
+        def post(index):
+            started.wait()
+            self.posted[index] = graph.handle_graph(self.db, thing, formdata=forms[index])[1]
 
-        yesterday_history = [state(t(10, yesterday())), state(t(11, yesterday())), state(t(12, yesterday())), state(t(13, yesterday()))]
+        threads = [threading.Thread(target=post, args=(index,)) for index in range(len(forms))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        full_history = [state(t(10, two_days_ago())), state(t(11, two_days_ago())), state(t(12, two_days_ago()))]
+    def when_rendering_concurrently(self, things, renders_per_thing):
+        self.concurrent = []
+        started = threading.Barrier(len(things) * renders_per_thing)
 
-        full_history.extend(yesterday_history)
-        full_history.extend(today_history)
+        def render(thing, index):
+            started.wait()
+            self.concurrent.append((thing, self.render(thing)))
 
-        self.given_history(full_history)
+        threads = [threading.Thread(target=render, args=(thing, index)) for thing in things for index in range(renders_per_thing)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        self.when_subsampling([(today_midnight(), 2), (yesterday_midnight(), 3)])
+        self.assertEqual(len(threads), len(self.concurrent))
 
-        expected = [full_history[0]]
-        expected.extend(yesterday_history[::2])
-        expected.extend(today_history)
-        self.then_sparse_history(expected)
+    def then_no_files_left(self, thing):
+        self.assertEqual(['displayables.json', 'history'], sorted(p.name for p in (self.db.directory / thing).iterdir()))
 
-    def given_history(self, history):
-        self.history = history
+    def then_png_images(self, rendered):
+        for image_bytes in rendered.values():
+            self.assertTrue(image_bytes.startswith(b'\x89PNG'))
 
-    def when_subsampling(self, conditions):
-        self.sparse_history = subsample_history(self.history, conditions)
+    def then_rendered_images(self, expected):
+        for thing, image_bytes in getattr(self, 'concurrent', self.rendered.items()):
+            self.assertEqual(expected[thing], image_bytes, thing)
 
-    def then_sparse_history(self, expected):
-        self.assertEqual(expected, self.sparse_history)
+    def then_images_differ(self, rendered):
+        self.assertEqual(len(rendered), len(set(rendered.values())))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import inotify
+
+@unittest.skipIf(inotify.Watcher.create() is None, 'inotify is not available')
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_directory = TemporaryDirectory()
+        self.addCleanup(self.temp_directory.cleanup)
+        self.directory = Path(self.temp_directory.name)
+        self.watcher = inotify.Watcher.create()
+        self.addCleanup(self.watcher.close)
+
+    def test_read_times_out_without_changes(self):
+        self.watcher.watch(self.directory, inotify.IN_CREATE)
+
+        self.assertEqual([], self.watcher.read(0.01))
+
+    def test_created_file(self):
+        self.watcher.watch(self.directory, inotify.IN_CREATE)
+
+        (self.directory / 'flag').touch()
+
+        self.then_events([(self.directory, inotify.IN_CREATE, 'flag')])
+
+    def test_touched_file(self):
+        (self.directory / 'flag').touch()
+        self.watcher.watch(self.directory, inotify.IN_CREATE | inotify.IN_ATTRIB)
+
+        (self.directory / 'flag').touch()
+
+        self.then_events([(self.directory, inotify.IN_ATTRIB, 'flag')])
+
+    def test_created_directory(self):
+        self.watcher.watch(self.directory, inotify.IN_CREATE)
+
+        (self.directory / 'thing').mkdir()
+
+        self.then_events([(self.directory, inotify.IN_CREATE | inotify.IN_ISDIR, 'thing')])
+
+    def test_deleted_directory_is_unwatched(self):
+        watched = self.directory / 'thing'
+        watched.mkdir()
+        self.watcher.watch(watched, inotify.IN_CREATE)
+
+        watched.rmdir()
+        self.watcher.read(1)
+
+        self.assertFalse(self.watcher.is_watched(watched))
+
+    def test_watch_missing_directory(self):
+        with self.assertRaises(OSError):
+            self.watcher.watch(self.directory / 'missing', inotify.IN_CREATE)
+
+    def then_events(self, expected):
+        events = self.watcher.read(1)
+        self.assertEqual(expected, [(event.directory, event.mask, event.name) for event in events])
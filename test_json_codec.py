@@ -0,0 +1,84 @@
+import unittest
+import json
+import random
+
+import json_codec
+
+TRICKY = [
+        {"OW-1": {"value": 21.5, "expected": 21, "ssd": 3}},
+        {"small": 1e-05, "smaller": 0.00009, "limit": 0.0001},
+        {"big": 1e16, "bigger": 1.7976931348623157e308, "tiny": 5e-324},
+        {"alias": "светлина", "line": " ", "del": "\x7f", "control": "\x01"},
+        {"nan": float('nan'), "inf": float('inf'), "none": None},
+        {1: "int key"},
+        {"huge": 2**70},
+        [True, False, -0.0, 0.1 + 0.2],
+        ]
+
+def stdlib_compact(o):
+    return json.dumps(o, separators=(',', ':'))
+
+def random_value(depth=0):
+    choice = random.randrange(6 if depth < 3 else 4)
+    if choice == 0:
+        return random.randint(-2**40, 2**40)
+    if choice == 1:
+        return random.uniform(-1, 1) * 10 ** random.randint(-8, 20)
+    if choice == 2:
+        return ''.join(random.choice('abcXYZ|-:w0é') for _ in range(random.randrange(8)))
+    if choice == 3:
+        return random.choice([True, False, None])
+    if choice == 4:
+        return [random_value(depth + 1) for _ in range(random.randrange(4))]
+    return {str(random.randrange(100)): random_value(depth + 1) for _ in range(random.randrange(4))}
+
+class TestJsonCodec(unittest.TestCase):
+    def setUp(self):
+        json_codec.PRETTY_STATES = True
+
+    def tearDown(self):
+        json_codec.PRETTY_STATES = True
+
+    def test_compact_is_identical_to_json_dumps(self):
+        for value in TRICKY:
+            self.assertEqual(stdlib_compact(value), json_codec.dumps_compact(value))
+
+    def test_compact_is_identical_to_json_dumps_random(self):
+        random.seed(7)
+        for _ in range(2000):
+            value = random_value()
+            self.assertEqual(stdlib_compact(value), json_codec.dumps_compact(value))
+
+    def test_compact_without_orjson(self):
+        orjson = json_codec.orjson
+        json_codec.orjson = None
+        try:
+            for value in TRICKY:
+                self.assertEqual(stdlib_compact(value), json_codec.dumps_compact(value))
+        finally:
+            json_codec.orjson = orjson
+
+    def test_loads_round_trips(self):
+        value = {"a": [1, 2.5, "б"], "b": {"c": None}}
+
+        self.assertEqual(value, json_codec.loads(json_codec.dumps_compact(value)))
+
+    def test_loads_accepts_nan(self):
+        loaded = json_codec.loads('{"a": NaN}')
+
+        self.assertNotEqual(loaded['a'], loaded['a'])
+
+    def test_loads_raises_json_error(self):
+        with self.assertRaises(json.decoder.JSONDecodeError):
+            json_codec.loads('{"a", 1}')
+
+    def test_state_is_pretty_by_default(self):
+        self.assertEqual('{\n    "a": 1\n}', json_codec.dumps_state({"a": 1}))
+
+    def test_state_is_compact_unless_pretty(self):
+        json_codec.PRETTY_STATES = False
+
+        self.assertEqual('{"a":1}', json_codec.dumps_state({"a": 1}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import logging
+from logging.handlers import QueueHandler
+
+import logger
+
+class Counted:
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'counted'
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.logger = logger.Logger("test_logger")
+        self.addCleanup(self.logger.logger.setLevel, logging.NOTSET)
+
+    def test_method_loggers_are_kept(self):
+        self.assertIs(self.logger.of('method'), self.logger.of('method'))
+
+    def test_method_logger_has_module_level(self):
+        self.logger.logger.setLevel(logging.WARNING)
+
+        self.assertFalse(self.logger.of('method').is_enabled(logging.INFO))
+        self.assertTrue(self.logger.of('method').is_enabled(logging.WARNING))
+
+    def test_records_are_queued(self):
+        self.assertTrue(any(isinstance(handler, QueueHandler) for handler in self.logger.logger.handlers))
+        self.assertEqual([], self.logger.of('method').logger.handlers)
+
+    def test_disabled_records_are_not_formatted(self):
+        self.logger.logger.setLevel(logging.WARNING)
+        counted = Counted()
+
+        self.logger.of('method').info('value %s', counted)
+
+        self.assertEqual(0, counted.formatted)
+
+    def test_records_are_formatted_when_written(self):
+        self.logger.logger.setLevel(logging.INFO)
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record.getMessage())
+        self.logger.logger.addHandler(handler)
+        self.addCleanup(self.logger.logger.removeHandler, handler)
+
+        self.logger.of('method').info('value %s of %d%%', 'x', 5)
+
+        self.assertEqual(['value x of 5%'], records)
+
+    def test_parse_levels(self):
+        self.assertEqual({'enchanter': 'WARNING', 'db_driver.load_state': 'DEBUG'}, logger.parse_levels('enchanter=warning, db_driver.load_state=DEBUG,,broken'))
+
+if __name__ == '__main__':
+    unittest.main()
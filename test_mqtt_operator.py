@@ -6,6 +6,8 @@ from tempfile import TemporaryDirectory
 from datetime import date
 from zipfile import ZipFile
 import json
+import threading
+import time
 
 THING = "ESP-318885"
 BASE_STATE = '{"state": %s}'
@@ -117,5 +119,106 @@ class TestMqttOperator(unittest.TestCase):
         value = json.loads(contents)['state']
         self.assertEqual(value, json.loads(expected_value))
 
+class TestIngestionPipeline(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.handled_by = {}
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None and self.pipeline.threads:
+            self.pipeline.stop()
+
+    def test_messages_of_a_thing_are_handled_in_order(self):
+        self.given_pipeline(workers=4)
+
+        self.when_submitting({'thing-%d' % i: range(50) for i in range(5)})
+        self.pipeline.stop()
+
+        for i in range(5):
+            self.assertEqual(list(range(50)), [n for thing, n in self.handled if thing == 'thing-%d' % i])
+
+    def test_a_thing_is_handled_by_one_worker(self):
+        self.given_pipeline(workers=4)
+
+        self.when_submitting({'thing-%d' % i: range(10) for i in range(8)})
+        self.pipeline.stop()
+
+        self.assertEqual(8, len(self.handled_by))
+        for names in self.handled_by.values():
+            self.assertEqual(1, len(names))
+
+    def test_stop_handles_queued_messages(self):
+        self.given_pipeline(workers=2, delay=0.001)
+
+        self.when_submitting({'thing-1': range(20), 'thing-2': range(20)})
+        self.pipeline.stop()
+
+        self.assertEqual(40, len(self.handled))
+        self.assertEqual(0, self.pipeline.depth())
+        self.assertEqual(40, self.pipeline.get_status()['handled'])
+
+    def test_full_queue_waits_and_is_counted(self):
+        release = threading.Event()
+        self.given_pipeline(workers=1, queue_size=1, handle=lambda thing, n: release.wait())
+        self.pipeline.submit(THING, THING, 0)
+        self.when_depth_is(0)
+        self.pipeline.submit(THING, THING, 1)
+
+        waiting = threading.Thread(target=self.pipeline.submit, args=(THING, THING, 2))
+        waiting.start()
+        waiting.join(0.1)
+        self.assertTrue(waiting.is_alive())
+        release.set()
+        waiting.join()
+
+        status = self.pipeline.get_status()
+        self.assertEqual(1, status['waited'])
+        self.assertEqual(3, status['queued'])
+
+    def test_failed_message_does_not_stop_worker(self):
+        def handle(thing, n):
+            if n == 1:
+                raise ValueError('broken message')
+            self.handled.append((thing, n))
+        self.given_pipeline(workers=1, handle=handle)
+
+        self.when_submitting({THING: range(3)})
+        self.pipeline.stop()
+
+        self.assertEqual([(THING, 0), (THING, 2)], self.handled)
+        self.assertEqual(1, self.pipeline.get_status()['failed'])
+
+    def test_stopped_pipeline_drops_messages(self):
+        self.given_pipeline(workers=1)
+        self.pipeline.stop()
+
+        self.assertFalse(self.pipeline.submit(THING, THING, 0))
+
+    def given_pipeline(self, workers, queue_size=100, delay=0, handle=None):
+        def record(thing, n):
+            if delay:
+                time.sleep(delay)
+            self.handled.append((thing, n))
+            self.handled_by.setdefault(thing, set()).add(threading.current_thread().name)
+        self.pipeline = mqtt_operator.IngestionPipeline(handle or record, workers=workers, queue_size=queue_size)
+        self.pipeline.start()
+
+    # interleaves the messages of the things
+    def when_submitting(self, messages):
+        iterators = {thing: iter(numbers) for thing, numbers in messages.items()}
+        while iterators:
+            for thing in list(iterators):
+                n = next(iterators[thing], None)
+                if n is None:
+                    del iterators[thing]
+                else:
+                    self.pipeline.submit(thing, thing, n)
+
+    def when_depth_is(self, depth):
+        deadline = time.monotonic() + 5
+        while self.pipeline.depth() != depth and time.monotonic() < deadline:
+            time.sleep(0.01)
+
 if __name__ == '__main__':
     unittest.main()
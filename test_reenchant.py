@@ -0,0 +1,132 @@
+import unittest
+import reenchant
+import db_driver
+import series
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from datetime import date, datetime, time, timedelta
+import json
+
+THING = "thing"
+TODAY = date(2018, 3, 10)
+DAYS = [TODAY - timedelta(days=5), TODAY - timedelta(days=4), TODAY - timedelta(days=3)]
+REPORTS_PER_DAY = 4
+SUM_CONFIG = [{"name": "OW-1-sum", "formula": "sum", "from": "OW-1"}]
+SCALE_CONFIG = [{"name": "OW-1-scaled", "formula": "scale", "from": "OW-1", "from_low": 0, "from_high": 10, "to_low": 0, "to_high": 100}]
+
+class TestReenchant(unittest.TestCase):
+    def setUp(self):
+        self.tmp_directory = TemporaryDirectory()
+        db_driver.prepare_test_directory(Path(self.tmp_directory.name))
+        self.db = db_driver.DatabaseDriver(self.tmp_directory.name)
+        (self.db.directory / THING / 'history').mkdir(parents=True)
+        self.reenchanter = reenchant.Reenchanter(self.tmp_directory.name, workers=2)
+
+    def tearDown(self):
+        self.tmp_directory.cleanup()
+
+    def test_sum_goes_on_across_days(self):
+        self.given_reported_days(DAYS)
+        self.given_config(SUM_CONFIG)
+
+        reports = self.when_reenchanting()
+
+        self.assertEqual(len(DAYS) * REPORTS_PER_DAY, reports)
+        self.then_last_enchanted(DAYS[-1], 'OW-1-sum', {'value': 12 * 13 / 2, 'count': 12})
+
+    def test_enchanted_series_are_rebuilt(self):
+        self.given_reported_days(DAYS)
+        self.given_config(SUM_CONFIG)
+
+        self.when_reenchanting()
+
+        times, values = series.load(series.series_path(self.db.directory / THING, 'enchanted', 'senses', 'OW-1-sum'))
+        self.assertEqual(len(DAYS) * REPORTS_PER_DAY, len(times))
+        self.assertEqual(12 * 13 / 2, values[-1])
+
+    def test_series_outside_reenchanted_days_are_kept(self):
+        self.given_reported_days(DAYS)
+        self.given_config(SUM_CONFIG)
+        later = datetime.combine(TODAY, time(12))
+        self.given_enchanted_series_point('OW-1-sum', later, 5)
+
+        self.when_reenchanting()
+
+        times, values = series.load(series.series_path(self.db.directory / THING, 'enchanted', 'senses', 'OW-1-sum'))
+        self.assertEqual(len(DAYS) * REPORTS_PER_DAY + 1, len(times))
+        self.assertEqual(5, values[-1])
+
+    def test_recent_days_are_left_to_the_enchanter(self):
+        self.given_reported_days(DAYS + [TODAY - timedelta(days=1)])
+        self.given_config(SUM_CONFIG)
+
+        reports = self.when_reenchanting()
+
+        self.assertEqual(len(DAYS) * REPORTS_PER_DAY, reports)
+        self.assertEqual([], self.db._load_archive_for_day(THING, 'enchanted', TODAY - timedelta(days=1)))
+
+    def test_resumes_after_last_written_day(self):
+        self.given_reported_days(DAYS)
+        self.given_config(SUM_CONFIG)
+        self.when_reenchanting()
+        self.given_interrupted_after(DAYS[0])
+
+        reports = self.when_reenchanting()
+
+        self.assertEqual(2 * REPORTS_PER_DAY, reports)
+        self.assertEqual([], self.db._load_archive_for_day(THING, 'enchanted', DAYS[0]))
+        self.then_last_enchanted(DAYS[-1], 'OW-1-sum', {'value': 12 * 13 / 2, 'count': 12})
+
+    def test_changed_config_starts_over(self):
+        self.given_reported_days(DAYS)
+        self.given_config(SUM_CONFIG)
+        self.when_reenchanting()
+        self.given_config(SCALE_CONFIG)
+
+        reports = self.when_reenchanting()
+
+        self.assertEqual(len(DAYS) * REPORTS_PER_DAY, reports)
+        self.then_last_enchanted(DAYS[-1], 'OW-1-scaled', 120)
+
+    def given_reported_days(self, days):
+        value = 1
+        for day in days:
+            states = []
+            for hour in range(REPORTS_PER_DAY):
+                time = datetime.combine(day, datetime.min.time()) + timedelta(hours=6 + hour)
+                states.append({'state': {'senses': {'OW-1': value}}, 'timestamp_utc': db_driver.timestamp(time)})
+                value += 1
+            if day >= TODAY - timedelta(days=2):
+                history_file = self.db.directory / THING / 'history' / ('reported.%s.txt' % day.isoformat())
+                history_file.write_text('\n'.join(map(db_driver.to_compact_json, states)) + '\n')
+            else:
+                self.db._write_archive(THING, 'reported', day, states)
+
+    def given_config(self, config):
+        with (self.db.directory / THING / 'enchanter.json').open('w', encoding='utf-8') as f:
+            f.write(json.dumps(config))
+
+    def given_enchanted_series_point(self, key, time, value):
+        directory = series.series_directory(self.db.directory / THING, 'enchanted', 'senses')
+        series.prepare_directory(directory)
+        series.append(series.series_path(self.db.directory / THING, 'enchanted', 'senses', key), [time], [value])
+
+    # as if the run was interrupted after writing day: the later days are not written yet
+    def given_interrupted_after(self, day):
+        status = self.reenchanter.load_status(THING)
+        status['day'] = day.isoformat()
+        status['enchanted'] = self.db._load_archive_for_day(THING, 'enchanted', day)[-1]
+        self.reenchanter.write_status(THING, status)
+        for archive in (self.db.directory / THING / 'history' / 'archive').glob('*/enchanted.*.zip'):
+            archive.unlink()
+
+    def when_reenchanting(self):
+        return self.reenchanter.reenchant(THING, today=TODAY)
+
+    def then_last_enchanted(self, day, key, expected):
+        enchanted = self.db._load_archive_for_day(THING, 'enchanted', day)
+        self.assertEqual(REPORTS_PER_DAY, len(enchanted))
+        self.assertEqual(expected, enchanted[-1]['state']['senses'][key])
+
+if __name__ == '__main__':
+    unittest.main()
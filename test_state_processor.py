@@ -207,6 +207,52 @@ class TestStateProcessor(unittest.TestCase):
 
         self.then_compact(exploded)
 
+    def test_diff_config_same(self):
+        self.when_diffing_config('{"sleep": 1, "gpio": {"0": "OneWire"}}', '{"sleep": 1, "gpio": {"0": "OneWire"}}')
+
+        self.then_config_diff('{}')
+
+    def test_diff_config_changed_field(self):
+        self.when_diffing_config('{"sleep": 1, "mode": {}}', '{"sleep": 2, "mode": {}}')
+
+        self.then_config_diff('{"sleep": 2}')
+
+    def test_diff_config_new_field(self):
+        self.when_diffing_config('{}', '{"gpio": {"0": "OneWire"}}')
+
+        self.then_config_diff('{"gpio": {"0": "OneWire"}}')
+
+    def test_diff_config_ignores_removed_field(self):
+        self.when_diffing_config('{"sleep": 1}', '{}')
+
+        self.then_config_diff('{}')
+
+    def test_diff_config_nested_fields(self):
+        self.when_diffing_config('{"gpio": {"0": "OneWire", "2": "DHT11", "4": "OneWire"}}', '{"gpio": {"0": "DHT11", "2": "DHT11", "4": "DHT22"}}')
+
+        self.then_config_diff('{"gpio": {"0": "DHT11", "4": "DHT22"}}')
+
+    def test_diff_config_actions_whole(self):
+        self.when_diffing_config('{"actions": ["a|4|H|10|1", "b|4|H|10|1"]}', '{"actions": ["a|4|H|10|1", "b|4|H|10|2"]}')
+
+        self.then_config_diff('{"actions": ["a|4|H|10|1", "b|4|H|10|2"]}')
+
+    def test_diff_config_removed_actions(self):
+        self.when_diffing_config('{"actions": ["a|4|H|10|1", "b|4|H|10|1", "c|4|H|10|1"]}', '{"actions": ["b|4|H|10|1"]}')
+
+        self.then_config_diff('{"actions": ["b|4|H|10|1"]}')
+
+    def test_diff_config_all_actions_removed(self):
+        self.when_diffing_config('{"actions": ["a|4|H|10|1"]}', '{"actions": []}')
+
+        self.then_config_diff('{"actions": []}')
+
+    def when_diffing_config(self, compact_from, compact_to):
+        self.config_diff = state_processor.diff_config(json.loads(compact_from), json.loads(compact_to))
+
+    def then_config_diff(self, expected_json_string):
+        self.assertEqual(self.config_diff, json.loads(expected_json_string))
+
     def when_exploding(self, json_string, previous_exploded = "{}"):
         self.exploded = state_processor.explode(json.loads(json_string), json.loads(previous_exploded))
 
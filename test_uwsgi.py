@@ -0,0 +1,74 @@
+import unittest
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import uwsgi
+
+class FileWrapper:
+    def __init__(self, f, block_size):
+        self.f = f
+        self.block_size = block_size
+
+class TestUwsgi(unittest.TestCase):
+    def setUp(self):
+        self.tmp_directory = TemporaryDirectory()
+        self.addCleanup(self.tmp_directory.cleanup)
+        working_directory = os.getcwd()
+        os.chdir(self.tmp_directory.name)
+        self.addCleanup(os.chdir, working_directory)
+
+        self.image = Path('db') / 'thing' / 'graph-1-median-3.png'
+        self.image.parent.mkdir(parents=True)
+        self.image.write_bytes(b'png')
+
+    def test_serve_file_with_accel_redirect(self):
+        self.when_serving_file({'ZELENIK_ACCEL_REDIRECT': '/internal/'}, self.image)
+
+        self.then_headers_include(('X-Accel-Redirect', '/internal/db/thing/graph-1-median-3.png'))
+        self.assertEqual([b''], self.body)
+
+    def test_serve_file_outside_working_directory(self):
+        with TemporaryDirectory() as outside:
+            image = Path(outside) / 'no-data.png'
+            image.write_bytes(b'no data')
+
+            self.when_serving_file({'ZELENIK_ACCEL_REDIRECT': '/internal/', 'wsgi.file_wrapper': FileWrapper}, image)
+
+            self.then_no_accel_redirect()
+            self.then_file_wrapped(b'no data')
+
+    def test_serve_file_with_file_wrapper(self):
+        self.when_serving_file({'wsgi.file_wrapper': FileWrapper}, self.image)
+
+        self.then_no_accel_redirect()
+        self.then_file_wrapped(b'png')
+
+    def test_serve_file_without_file_wrapper(self):
+        self.when_serving_file({}, self.image)
+
+        self.then_no_accel_redirect()
+        self.assertEqual(b'png', b''.join(self.body))
+
+    def when_serving_file(self, env, path):
+        def start_response(status, headers):
+            self.status = status
+            self.headers = headers
+        self.body = uwsgi.serve_file(env, start_response, 'image/png', path, [('Cache-Control', 'max-age=60')])
+
+    def then_headers_include(self, header):
+        self.assertEqual('200 OK', self.status)
+        self.assertIn(('Content-Type', 'image/png'), self.headers)
+        self.assertIn(('Cache-Control', 'max-age=60'), self.headers)
+        self.assertIn(header, self.headers)
+
+    def then_no_accel_redirect(self):
+        self.assertNotIn('X-Accel-Redirect', dict(self.headers))
+
+    def then_file_wrapped(self, expected):
+        self.assertIsInstance(self.body, FileWrapper)
+        with self.body.f:
+            self.assertEqual(expected, self.body.f.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import re
+import os
 import db_driver
 import datetime
 import cgi
@@ -8,6 +9,8 @@ import graph
 
 import urllib.parse
 
+from pathlib import Path
+
 from logger import Logger
 logger = Logger("uwsgi")
 
@@ -42,6 +45,28 @@ def parse_graph_attributes(url_path):
 
     return since_days, median_kernel, wrongs
 
+FILE_BLOCK_SIZE = 64*1024
+
+# nginx sets ZELENIK_ACCEL_REDIRECT to an internal location serving the working directory. Files
+# outside it, or without nginx, go through wsgi.file_wrapper. Either way the worker copies no bytes.
+def serve_file(env, start_response, content_type, path, headers):
+    relative_path = os.path.relpath(str(path))
+    accel_redirect = env.get('ZELENIK_ACCEL_REDIRECT')
+    if accel_redirect and not relative_path.startswith('..'):
+        start_response('200 OK', [('Content-Type', content_type), ('X-Accel-Redirect', accel_redirect + relative_path)] + headers)
+        return [b'']
+
+    f = open(str(path), 'rb')
+    start_response('200 OK', [('Content-Type', content_type)] + headers)
+    file_wrapper = env.get('wsgi.file_wrapper')
+    if file_wrapper:
+        return file_wrapper(f, FILE_BLOCK_SIZE)
+
+    def read_blocks():
+        with f:
+            yield from iter(lambda: f.read(FILE_BLOCK_SIZE), b'')
+    return read_blocks()
+
 def application(env, start_response):
     method = env['REQUEST_METHOD']
     raw_uri = env['REQUEST_URI']
@@ -53,6 +78,7 @@ def application(env, start_response):
 
     content_type = None
     data = None
+    headers = []
     if not thing:
         start_response('200 OK', [('Content-Type', "text/plain")])
         data = "Could not parse thing from uri %s" % raw_uri
@@ -79,12 +105,17 @@ def application(env, start_response):
     else:
         since_days, median_kernel, wrongs = parse_graph_attributes(url.path)
         content_type, data = graph.handle_graph(db, thing, since_days, median_kernel, wrongs)
+        # browsers may keep a graph as long as the graph cache would
+        headers.append(('Cache-Control', 'max-age=%d' % graph.max_staleness(since_days)))
 
     if content_type is None or data is None:
         content_type = "text/html"
         data = gui_update.HTML % "Нищо за вършене."
 
-    start_response('200 OK', [('Content-Type', content_type)])
+    if isinstance(data, Path):
+        return serve_file(env, start_response, content_type, data, headers)
+
+    start_response('200 OK', [('Content-Type', content_type)] + headers)
     if 'text' in content_type:
         data = data.encode('utf-8')
     return data
@@ -86,7 +86,7 @@ function fetch_and_redraw() {
   if (since_hours)
     query = "since_hours=" + since_hours 
 
-  d3.csv("history?" + query, type, redraw)
+  d3.csv("history?" + query + "&points=" + width, type, redraw)
   d3.select(".graph-since[disabled]").attr("disabled", null);
   d3.select(this).attr("disabled", true);
 };
@@ -94,7 +94,7 @@ function fetch_and_redraw() {
 d3.selectAll(".graph-since").on("click", fetch_and_redraw);
 
 d3.select(".loading").classed("hidden", false);
-d3.csv("history?since_days=1", type, redraw);
+d3.csv("history?since_days=1&points=" + width, type, redraw);
 
 function unwrap(wrapped) {
   return wrapped.split("(")[1].split(")")[0]